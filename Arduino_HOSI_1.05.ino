@@ -18,6 +18,18 @@ _________________________HOSI Arduino Firmware_____________________________
  hyperspectral measurement: send "h" followed by comma-delineated values as follows:
  panLeft,panRight,panResolution,tiltBottom,tiltTop,tiltResolution,maxIntegrationTime(microseconds),boxcar,darkRepeatTimer(milliseconds)
  e.g.: "h-200,200,10,400,600,10,2000000,2,120000"
+ exposure hints: during a hyperspectral measurement the host may send "e" followed by a microsecond number, a
+ comma, the tilt of the row it is for and a newline, e.g. "e4000,520", as each row finishes; auto-exposure for that
+ row then starts one step below it rather than at the minimum. Hints for another row are ignored (without a tilt
+ they are used for the next row). Once a hint has come in, each row waits up to hintWait ms for its own, as the
+ short move between serpentine rows can start the row before the hint arrives. Replies "e: " and the hint at the
+ start of the row it is used for.
+ serpentine scanning: send "z1,<backlash>," to scan alternate rows from right to left rather than swinging back to
+ the left each row (backlash is the pan steps of slack in the gears, taken off the right-to-left positions), "z0," to
+ go back. Replies "zigzag: " with the mode and backlash.
+ binary spectra: send "b1" to send each spectrum as a binary frame instead of a line of text (about half the
+ bytes, see HOSI_serial.py for the layout), "b0" to go back to text. Replies "bin: 1" or "bin: 0". Text is
+ the default after a reset.
   
  
  Modify the unit number below if desired, and upload this script to an Arduino Nano or similar.
@@ -69,6 +81,16 @@ AccelStepper stepper_tilt(4, 7, 9, 6, 8); // 8=HALF4WIRE, then input pin 1, 2, 3
 
 int boxcar = 1;
 
+bool serpentine = false; // alternate left-to-right and right-to-left rows (z command)
+long backlash = 0; // pan steps of slack in the gears, taken off the right-to-left rows
+bool rowLeftward = false;
+long rowHint = 0; // auto-exposure starts one step below this during a scan row (0 = from minIntTime)
+bool hinted = false; // the host has sent an exposure hint during this scan
+#define hintWait 100 // ms to wait for the exposure hint at the start of a row, once the host is sending them
+bool binaryMode = false; // send spectra as binary frames (b1) rather than text (b0)
+uint16_t frameSeq = 0;
+uint16_t frameCrc = 0xFFFF;
+
 
 
 void setup() {
@@ -179,12 +201,24 @@ void radianceMeasure(){
 
   // ----------------- AUTO EXPOSURE-----------
   if(manIntTime == 0){ 
+    long nextTime = intStep;
     intTime = minIntTime; // microsecond exposure
-    readSpectrometer(); // read to dim0
+    if(darkLight == 1 && rowHint/2 >= intStep && rowHint/2 < maxIntTime){
+      intTime = rowHint/2; // start one step below the exposure hint
+      readSpectrometer(); // read to dim0
+      if(satN == 0)
+        nextTime = intTime*2;
+      else { // brighter than the hint, run the whole ladder
+        resetData();
+        intTime = minIntTime;
+      }
+    }
+    if(intTime == minIntTime)
+      readSpectrometer(); // read to dim0
     //data[0][dataLoc] = -1; // debugging
     prevSatN = satN;
     prevIntTime = intTime;
-    intTime = intStep;
+    intTime = nextTime;
     if(satN > 0)
       switchDim(); // required if first exposure is over-exposed
 
@@ -213,18 +247,64 @@ void radianceMeasure(){
     prevIntTime = intTime;
   }
  
-  Serial.print(String(panVal) + "," + String(tiltVal) + "," + String(darkLight) + "," + String(prevIntTime) + "," + String(prevSatN) );
+  if(binaryMode){
+    sendFrame();
+  } else {
+    Serial.print(String(panVal) + "," + String(tiltVal) + "," + String(darkLight) + "," + String(prevIntTime) + "," + String(prevSatN) );
+
+    for (int i = 0; i < nSites; i+=boxcar){
+      int tSum = 0;
+      for(int j = 0; j < boxcar; j++)
+        if(i+j < nSites)
+            tSum += data[i+j][dataLoc];
+      Serial.print("," + String(tSum));
+    }
+    Serial.print("\n");
+  }
+  delay(1);
+ 
+}
+
 
+// CRC-16/CCITT (polynomial 0x1021, starting from 0xFFFF) of everything after the sync bytes
+void frameWrite(const void *p, int n){
+  const uint8_t *b = (const uint8_t *) p;
+  for(int i = 0; i < n; i++){
+    frameCrc ^= (uint16_t) b[i] << 8;
+    for(int k = 0; k < 8; k++)
+      frameCrc = (frameCrc & 0x8000) ? (frameCrc << 1) ^ 0x1021 : frameCrc << 1;
+  }
+  Serial.write(b, n);
+}
+
+// binary version of the spectrum line: sync, header, counts & CRC, all little-endian
+void sendFrame(){
+  uint16_t n = (nSites + boxcar - 1) / boxcar;
+  int16_t p = panVal;
+  int16_t t = tiltVal;
+  uint8_t ty = darkLight;
+  uint32_t it = prevIntTime;
+  uint16_t sn = prevSatN;
+  Serial.write(0xA5);
+  Serial.write(0x5A);
+  frameCrc = 0xFFFF;
+  frameWrite(&n, 2);
+  frameWrite(&p, 2);
+  frameWrite(&t, 2);
+  frameWrite(&ty, 1);
+  frameWrite(&it, 4);
+  frameWrite(&sn, 2);
+  frameWrite(&frameSeq, 2);
   for (int i = 0; i < nSites; i+=boxcar){
-    int tSum = 0;
+    uint16_t tSum = 0;
     for(int j = 0; j < boxcar; j++)
-      if(i+j <= nSites)
+      if(i+j < nSites)
           tSum += data[i+j][dataLoc];
-    Serial.print("," + String(tSum));
+    frameWrite(&tSum, 2);
   }
-  Serial.print("\n");
-  delay(1);
- 
+  uint16_t c = frameCrc;
+  Serial.write((uint8_t *) &c, 2);
+  frameSeq ++;
 }
 
 
@@ -307,6 +387,22 @@ void loop() {
       Serial.println("tilt: " + String((int) arg.toFloat()));
       delay(5);
 
+    // serpentine scanning
+    } else if(arg.startsWith("z") == true){
+      arg.replace("z", "");
+      serpentine = arg.toInt() == 1;
+      backlash = 0;
+      if(arg.indexOf(",") != -1)
+        backlash = arg.substring(arg.indexOf(",")+1).toInt();
+      Serial.println("zigzag: " + String(serpentine ? 1 : 0) + "," + String(backlash));
+
+    // binary or text spectra
+    } else if(arg.startsWith("b") == true){
+      arg.replace("b", "");
+      binaryMode = arg.toInt() == 1;
+      frameSeq = 0;
+      Serial.println("bin: " + String(binaryMode ? 1 : 0));
+
     // Manual spec measure
     } else if(arg.startsWith("r") == true){ // radiance
 
@@ -339,6 +435,8 @@ void loop() {
       tilt(0);
 
       //-----------Dark Measure at start------------
+      rowLeftward = false;
+      hinted = false;
       startMeasure();
       darkMeasure();
 
@@ -357,7 +455,6 @@ void loop() {
         }
 
         tilt(tiltVal);
-        pan(hyperVals[0]-10);// overshoot - pan left a bit to use up excess in gears
 
         //--------reduce measurement frequency at high elevations
         int panShift = 1;
@@ -369,29 +466,56 @@ void loop() {
         }
         panShift *= hyperVals[2];
         panStart *= hyperVals[2];
-            
-        /*
-        if(panVal >= hyperVals[1]){
-          //----------pan from right to left-----------
-          for(panVal = hyperVals[1]-panStart; panVal >= hyperVals[0]; panVal -= panShift){ 
-            pan(panVal);
+        long panFirst = hyperVals[0]+panStart;
+        long panLast = panFirst + ((hyperVals[1]-panFirst)/panShift)*panShift; // last position of the row
+
+        if(serpentine && rowLeftward)
+          pan(panLast-backlash+10);// overshoot - pan right a bit to use up excess in gears
+        else
+          pan(hyperVals[0]-10);// overshoot - pan left a bit to use up excess in gears
+
+        //--------exposure hint for this row from the host, "e<microseconds>,<tilt>" (sent as the row before finished)
+        rowHint = 0;
+        unsigned long hintEnd = millis() + (hinted ? hintWait : 0);
+        do{
+          while(Serial.available()){
+            String e = Serial.readStringUntil('\n');
+            if(e.startsWith("e")){
+              hinted = true;
+              int c = e.indexOf(',');
+              if(c < 0 || e.substring(c+1).toInt() == tiltVal) // a hint for a row gone by is too late
+                rowHint = e.substring(1).toInt();
+            }
+          }
+        } while(rowHint == 0 && millis() < hintEnd);
+        if(rowHint > 0)
+          Serial.println("e: " + String(rowHint));
+
+        if(serpentine && rowLeftward){
+          //----------pan from right to left, same positions less the backlash in the gears-----------
+          for(panVal = panLast; panVal >= panFirst; panVal -= panShift){ 
+            pan(panVal-backlash);
             radianceMeasure();
           }
         } else {
-        */
           //----------pan from left to right-----------
-          for(panVal = hyperVals[0]+panStart; panVal <= hyperVals[1]; panVal += panShift){ 
+          for(panVal = panFirst; panVal <= hyperVals[1]; panVal += panShift){ 
             pan(panVal);
             radianceMeasure();
           }
-        //}
+        }
+        if(serpentine)
+          rowLeftward = !rowLeftward;
 
       }
 
 
       //-----------Dark Measure at end------------
+      rowHint = 0;
       pan(0);
       darkMeasure();
+      while(Serial.available() && Serial.peek() == 'e')
+        Serial.readStringUntil('\n'); // a hint that came too late for its row, so it isn't taken as the next command
 
       stepper_pan.disableOutputs();
       stepper_tilt.disableOutputs();
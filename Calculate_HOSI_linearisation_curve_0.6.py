@@ -16,7 +16,7 @@
 ## then copy the two coeffients from the log to the linCoefs in calibration_data.txt
 
 
-import serial, time
+import serial, time, os
 import serial.tools.list_ports
 import numpy as np
 import matplotlib.pyplot as plt
@@ -28,6 +28,8 @@ ports = serial.tools.list_ports.comports()
 com_list = []
 for p in ports:
 	com_list.append(p.device)
+if os.environ.get("HOSI_PORT"): # e.g. the pseudo-terminal of HOSI_simulator.py
+	com_list = [os.environ["HOSI_PORT"]]
 
 print(com_list)
 #serialName = '/dev/ttyUSB0'
@@ -26,14 +26,23 @@
 
 
 
+import time
+startTime = time.time() # for the start-up time printed once the window is drawn
 from tkinter import *
 from tkinter import filedialog as fd
 import numpy as np
-from PIL import Image, ImageTk, ImageOps
-import string, time, os, sys, math
+from PIL import Image, ImageTk, ImageOps, ImageDraw
+import string, os, sys, math, re
+import HOSI_core as core
+coreTime = time.time() - startTime
+import HOSI_storage as storage
+import HOSI_serial as hserial
+import HOSI_preview
+import HOSI_adaptive
 
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+## matplotlib is slow to import (especially on phones), so the spectrum plot is only
+## created the first time a spectrum is shown (see specAxes)
+startupBudget = 3.0 # seconds to first frame before a warning is printed
 
 
 platform = "lin"
@@ -50,6 +59,7 @@ else:
 	import serial.tools.list_ports
 
 ser = None
+reader = None # background thread reading lines from the HOSI (see HOSI_serial)
 
 
 
@@ -63,17 +73,12 @@ root.title('HOSI')
 np.set_printoptions(suppress=False, precision=3, threshold=sys.maxsize, linewidth=sys.maxsize)
 
 cieWav = []
-chlA = []
-chlB = []
-nIR = []
-cieX = []
-cieY = []
-cieZ = []
-nUV = []
+sensFull = {} # sensitivity curves & receptors at each photosite (see core.SensitivityStore)
+sensBoxed = {} # ... and at each boxcar bin
 
 
-pixels = int(288)
-baseInt = int(550) # specifies the minimum hardware integration time in microseconds. 
+pixels = core.pixels
+baseInt = core.baseInt # specifies the minimum hardware integration time in microseconds. 
 wavCoef = []
 radSens = []
 linCoefs = []
@@ -81,20 +86,16 @@ wavelength = []
 wavelengthBins = []
 wavelengthBoxcar = []
 unitNumber = int(0)
-cieXt = [0.0] * pixels
-cieYt = [0.0] * pixels
-cieZt = [0.0] * pixels
-chlAt = [0.0] * pixels
-chlBt = [0.0] * pixels
-nIRt = [0.0] * pixels
-nUVt = [0.0] * pixels
 saveLabel = StringVar()
-dataString = ""
+scanWriter = None # streams raw serial data to the scan file as it arrives
+exposureHintsOn = True # send the HOSI a starting exposure for each row, based on the row before (see core.ExposureHints)
+exposureHints = None
 output = ""
 serialName = ""
 visSystems = []
 receptorNames = []
 receptorVals = []
+engine = None # calibration engine for the current unit & boxcar
 
 def connect():
 	global ser, serialName
@@ -121,6 +122,8 @@ def connect():
 		com_list = []
 		for p in ports:
 			com_list.append(p.device)
+		if os.environ.get("HOSI_PORT"): # e.g. the pseudo-terminal of HOSI_simulator.py
+			com_list = [os.environ["HOSI_PORT"]]
 
 		print(com_list)
 		#serialName = '/dev/ttyUSB0'
@@ -131,98 +134,19 @@ def connect():
 		else:
 			serialName = 0
 
-try:
-	connect()
-except:
-	print("Not connected")
-	print("Check connection, and that the code is using the correct serial port")
-	
-print(ser)
-
-def readLine(ta):
-	ta.pop(0)
-	ta.pop(0)
-	ta = list(filter(None, ta))
-	ta = [float(i) for i in ta]
-	#print(ta)
-	return ta
-	
-
 
 def unitSetup():
-	global unitNumber, wavCoef, radSens, linCoefs, wavelength, wavelengthBins, wavelengthBoxcar, cieXt, cieYt, cieZt, chlAt, chlBt, nIRt, nUVt, cieWav, chlA, chlB, nIR, cieX, cieY, cieZ, nUV, receptorNames, receptorVals
+	global unitNumber, wavCoef, radSens, linCoefs, wavelength, wavelengthBins, wavelengthBoxcar, cieWav, receptorNames, receptorVals, sensFull, sensBoxed, engine
 
 
-	if(len(wavCoef) != pixels or len(radSens) != pixels): # only load values from file the first time the code runs (to work out unit number)
-		for line in open("./calibration_data.txt"):
-			row = line.split(',')
-			#print(row)
-			try:
-				int(row[0])
-			except:
-				print(" ")
-			else:
-				if(int(row[0]) == unitNumber):
-##					print(row)
-					if(row[1] == "wavCoef"):
-						wavCoef = row
-						wavCoef.pop(0)
-						wavCoef.pop(0)
-						wavCoef = list(filter(None, wavCoef))
-						wavCoef.pop(len(wavCoef)-1)
-##						print("waveCoef: " + str(len(wavCoef)))
-						wavCoef = [float(i) for i in wavCoef]
-					if(row[1] == "radSens"):
-						radSens = row
-						radSens.pop(0)
-						radSens.pop(0)
-						radSens = list(filter(None, radSens))
-						radSens.pop(len(radSens)-1)
-##						print("radSens: " + str(len(radSens)))
-						radSens = [float(i) for i in radSens]
-##						print(radSens)
-					if(row[1] == "linCoefs"):
-						linCoefs = row
-						linCoefs.pop(0)
-						linCoefs.pop(0)
-						linCoefs = list(filter(None, linCoefs))
-						linCoefs.pop(len(linCoefs)-1)
-##						print("linCoefs: " + str(len(linCoefs)))
-						linCoefs = [float(i) for i in linCoefs]
-						
-		for line2 in open("./sensitivity_data.csv"):
-			row = line2.split(',')
-			# ~ print(row)
-			if(row[0] == "base"):
-				if(row[1] == "cieWav"):
-					cieWav = row
-					cieWav.pop(0)
-					cieWav.pop(0)
-					cieWav = list(filter(None, cieWav))
-					cieWav = [int(i) for i in cieWav]
-	##				print(cieWav)
-				elif(row[1] == "chlA"):
-					chlA = readLine(row)
-				elif(row[1] == "chlB"):
-					chlB = readLine(row)
-				elif(row[1] == "nIR"):
-					nIR = readLine(row)
-				elif(row[1] == "cieX"):
-					cieX = readLine(row)
-				elif(row[1] == "cieY"):
-					cieY = readLine(row)
-				elif(row[1] == "cieZ"):
-					cieZ = readLine(row)
-				elif(row[1] == "nUV"):
-					nUV = readLine(row)
-			
-			else:
-					receptorNames.append(row[0] +"_" + row[1])
-					floatVals = row[2:]
-					floatVals = [float(value) for value in floatVals if value.replace('.', '', 1).isdigit()]
-					receptorVals.append(floatVals)
+	# all units are held by the calibration registry (compiled once, reloaded if calibration_data.txt changes)
+	wavCoef, radSens, linCoefs = core.loadCalibration(unitNumber)
+
+	sens = core.sensitivityStore() # reloaded if sensitivity_data.csv has changed
+	cieWav = sens.cieWav
+	receptorNames = sens.receptorNames
+	receptorVals = sens.receptorVals
 
-	
 	receptorListbox.delete(0, "end")  # Clear current listbox
 	for item in receptorNames:  # Insert new options
 		# ~ print(item)
@@ -240,33 +164,21 @@ def unitSetup():
 		print("linCoefs: " + str(len(linCoefs)))
 
 
-	wavelength = []
-	for i in range(0,pixels):
-		wavelength.append(wavCoef[0]+wavCoef[1]*i+wavCoef[2]*i**2+wavCoef[3]*i**3+wavCoef[4]*i**4+wavCoef[5]*i**5)
+	wavelength = core.wavelengthsFromCoefs(wavCoef)
 
 	#---set up wavelength bin widths array-------
-	wavelengthBins = []
-	for i in range(0,pixels-1):
-		wavelengthBins.append(wavelength[i+1]-wavelength[i])
-	wavelengthBins.append(wavelength[pixels-1]-wavelength[pixels-2])
+	wavelengthBins = core.wavelengthBinWidths(wavelength)
 
 	# creare array of wavelengths matching boxcar scale for plotting
-	wavelengthBoxcar = []
-	for i in range(0, pixels, boxcarN): #increment in boxcar size
-		wavelengthBoxcar.append(wavCoef[0]+wavCoef[1]*i+wavCoef[2]*i**2+wavCoef[3]*i**3+wavCoef[4]*i**4+wavCoef[5]*i**5)
+	wavelengthBoxcar = wavelength[::boxcarN]
 
 
-	#------resample spectral sensitivities at spectrometer wavelengths---------
-	for i in range(0,pixels):
-		for j in range(0, len(cieWav)):
-			if(round(wavelength[i]) == cieWav[j]):
-				cieXt[i] = cieX[j]
-				cieYt[i] = cieY[j]            
-				cieZt[i] = cieZ[j]
-				chlAt[i] = chlA[j]
-				chlBt[i] = chlB[j]            
-				nIRt[i] = nIR[j]
-				nUVt[i] = nUV[j]
+	#------resample spectral sensitivities at spectrometer wavelengths (cached per unit & boxcar)---------
+	if len(wavCoef) == 6:
+		sensFull, sensBoxed = sens.resampled(unitNumber, wavCoef, boxcarN)
+
+		#------precompute calibration weights for this unit & boxcar (also cached)---------
+		engine = core.makeEngine(unitNumber, boxcarN)
 
 
 panFrom = StringVar()
@@ -295,9 +207,14 @@ reflVal.set("99")
 specOutVal.set("")
 
 reflFlag = 0
+recalVal = IntVar() # 1 = recalibrate loaded scans from their raw data rather than using the saved le values
+serpentineVal = IntVar() # Zigzag box, see serpentineOn
+backlashVal = StringVar()
+backlashVal.set("0")
 
-darkTimes = []
-darkVals = []
+darkStore = core.DarkStore() # dark ladders by integration time
+renderer = HOSI_preview.PreviewRenderer() # cached 8-bit preview images
+specPos = 0 # position of the current spectrum in the scan (for interpolating darks)
 
 ## RGB image
 imLum = []
@@ -326,6 +243,7 @@ imNDVI = []
 hspec = []
 hspecPan = []
 hspecTilt = []
+provenance = [] # pass each spectrum in hspec is from: 0 the scan, 1... rescans, -1 none, core.filledPass copied from the nearest measured pixel
 
 
 
@@ -342,9 +260,26 @@ scanningFlag = int(0)
 stopFlag = int(0)
 fileImportFlag = int(0);
 loadPath = ""
-loadLine = 0
-lines = ("")
 ct = '' # savepath
+serialBatch = 1000 # max queued serial lines handled per poll
+pollInterval = 20 # ms between polls of the serial queue
+bootDelay = 2500 # ms, the Arduino resets when the port is opened
+setupWait = 1500 # ms to wait for the reply to each setup command
+serpentineOn = False # scan alternate rows right to left rather than swinging back to the left for every row
+backlashSteps = 0 # pan steps of slack in the gears, taken off the right-to-left rows by the firmware
+hostBacklash = 0.0 # pan steps the right-to-left rows still point right of where they're reported, measured at the end of each serpentine scan and allowed for when placing them (as HOSI_batch --backlash)
+passPans = None # (panLeft, panRight, panRes) of the h command being scanned, for the positions along each row
+rowLeftward = False # the row being scanned runs right to left (serpentine scans)
+moveQueue = [] # (command, reply) pairs for manual moves
+rescanQueue = [] # h commands for the regions of a rescan still to be sent
+rescanPass = 0 # pass being measured by a rescan (see core.scanPasses), 0 when not rescanning
+rescanFiner = False # the rescan is on a finer grid than the scan, so gaps are filled at the end
+roi = None # (tilt0, tilt1, pan0, pan1) hspec indices of the region selected with shift-drag
+roiAnchor = None
+rowTilt = None # tilt of the row being scanned, the scan file is synced to disk as each row finishes
+resumePath = None # scan cut off by a lost connection, resumed when the HOSI is back
+reconnectWait = 5000 # ms between attempts to reopen a lost serial port
+moveButton = None
 
 
 boxcarN = int(1)
@@ -352,6 +287,12 @@ focusPos = 0
 preview = 1
 plotImX = 100
 plotImY = 100
+zoom = 1.0 # preview magnification, 1 shows the whole scan
+maxZoom = 64
+viewX = 0.5 # centre of the preview, as a fraction of the scan's width & height
+viewY = 0.5
+dragAnchor = None # (x, y, viewX, viewY) where a click on the preview started
+dragged = False # the preview was dragged since, so letting go doesn't select a pixel
 selX = -1
 selY = -1
 refs = [] #100% reflectance vals
@@ -372,47 +313,9 @@ def plotGraph(status):
 	if len(imR) > 0:
 		
 		br = 100/brightnessScale.get()
-		if preview <= 2:
-                        ## avoid raising negative numbers to power (numpy doesn't like it)
-			nImR = np.sign(imR) * ((np.abs(imR * wbR)/maxRGB)**0.42) * 255 * br
-			nImG = np.sign(imG) * ((np.abs(imG * wbG)/maxRGB)**0.42) * 255 * br
-			nImB = np.sign(imB) * ((np.abs(imB * wbB)/maxRGB)**0.42) * 255 * br
-			
-			nImR = np.clip(nImR, 0, 255)
-			nImG = np.clip(nImG, 0, 255)
-			nImB = np.clip(nImB, 0, 255)
-
-			if preview <= 1: ## RGB images
-				imCol = np.dstack((nImR, nImG, nImB))
-			else: ## saturation image
-
-				nImR = nImG ## where saturated turn red, otherwise grey (match green)
-				nImB = nImG - imSatR ## where saturated turn red
-				nImG = nImG - imSatR ## where saturated turn red
-				nImB = np.clip(nImB, 0, 255)
-				nImB = nImB + (imSatB * 5) ## add blue to show degere of saturation across wavelengths, so magenta will be fully saturated
-				nImR = np.clip(nImR, 0, 255)
-				nImG = np.clip(nImG, 0, 255)
-				nImB = np.clip(nImB, 0, 255)
-				imCol = np.dstack((nImR, nImG, nImB))
-
-		if preview == 3:  ## IGU (extreme spectral range image)
-			nImI = np.sign(imI) * ((np.abs(imI * wbI)/maxIGU)**0.42) * 255 * br
-			nImGG = np.sign(imGG) * ((np.abs(imGG * wbGG)/maxIGU)**0.42) * 255 * br
-			nImU = np.sign(imU) * ((np.abs(imU * wbU)/maxIGU)**0.42) * 255 * br
-						
-			nImI = np.clip(nImI, 0, 255)
-			nImGG = np.clip(nImGG, 0, 255)
-			nImU = np.clip(nImU, 0, 255)
-
-			imCol = np.dstack((nImI, nImGG, nImU))
-
-		if preview == 4:  ## NDVI
-			nImB = imChlB * 255
-			nImR = ((255-nImB)*2)* imChlA
-			nImG = ((255-nImB)*2)* (1-imChlA)
-
-			imCol = np.dstack((nImR, nImG, nImB))
+		# only the pixels changed since the last frame are tone-mapped again (see HOSI_preview)
+		images = {"R":imR, "G":imG, "B":imB, "satR":imSatR, "satB":imSatB, "I":imI, "GG":imGG, "U":imU, "chlA":imChlA, "chlB":imChlB}
+		imCol = renderer.render(preview, images, maxRGB, maxIGU, (wbR, wbG, wbB, wbI, wbGG, wbU), br)
 
 		# width: plot_frame.bbox(plot)[2] height: plot_frame.bbox(plot)[3]
 		
@@ -426,13 +329,26 @@ def plotGraph(status):
 		if(plotSize < 50):
 			plotSize = 50 ## set min plot size to avoid drawing errors
 			
-		tImCol = imCol.astype(np.uint8)
-		plotIm = Image.fromarray(tImCol, "RGB")
+		# only the part in view is scaled, from the pyramid level nearest the screen's resolution
+		c0, r0, w, h, scale = previewWindow()
+		pyramid = renderer.pyramid(preview)
+		level = min(max(int(math.floor(math.log2(1/scale))), 0), pyramid.levels()-1)
+		f = 2**level
+		rows, cols = pyramid.shapes[level]
+		lr0 = int(r0/f)
+		lc0 = int(c0/f)
+		crop = pyramid.window(level, lr0, min(int(math.ceil((r0+h)/f)), rows), lc0, min(int(math.ceil((c0+w)/f)), cols))
+		plotIm = Image.fromarray(np.ascontiguousarray(crop), "RGB")
 ##		plotImt = ImageOps.contain(plotIm, (plotSize,plotSize), method=0)
-		plotImt = ImageOps.contain(plotIm, (plotImX,plotImY), method=0)
-		plotImResized = ImageTk.PhotoImage(plotImt)
-		plot.config(image=plotImResized)
-		plot.image = plotImResized
+		plotImt = plotIm.resize((max(int(round(w*scale)), 1), max(int(round(h*scale)), 1)), resample=0, box=(c0/f-lc0, r0/f-lr0, (c0+w)/f-lc0, (r0+h)/f-lr0))
+		if(roi is not None and roi[1] < tiltDim and roi[3] < panDim): # region selected for a rescan
+			ImageDraw.Draw(plotImt).rectangle([(roi[2]-c0)*scale, (tiltDim-1-roi[1]-r0)*scale, (roi[3]+1-c0)*scale-1, (tiltDim-roi[0]-r0)*scale-1], outline=(255, 255, 0))
+		if(getattr(plot, "image", None) is not None and (plot.image.width(), plot.image.height()) == plotImt.size):
+			plot.image.paste(plotImt) # same size, so update the existing PhotoImage in place
+		else:
+			plotImResized = ImageTk.PhotoImage(plotImt)
+			plot.config(image=plotImResized)
+			plot.image = plotImResized
 
 		#statusLabel.config(text=status)
 	   # print(root.bbox(0, 1))
@@ -454,130 +370,192 @@ def updatePlotRes(event):
 
 
 def getSpec():
-	global tt, unitNumber, imLum, imR, imG, imB, imCol, imSatR, imSatB, panStart, panStop, pan_Res, panDim, tiltDim, tiltStart, tiltStop, tilt_Res, tiltRes, scanningFlag, dataString, boxcarN, maxRGB, output, focusPos
-	global imI, imU, imGG, imChlA, imChlB, imNDVI, maxIGU, hspec, hspecPan, hspecTilt, fileImportFlag, loadPath, loadLine, lines, selX, selY, wavelengthBoxcar, stopFlag, ct
+	global tt, unitNumber, imLum, imR, imG, imB, imCol, imSatR, imSatB, panStart, panStop, pan_Res, panDim, tiltDim, tiltStart, tiltStop, tilt_Res, tiltRes, scanningFlag, scanWriter, boxcarN, maxRGB, focusPos
+	global imI, imU, imGG, imChlA, imChlB, imNDVI, maxIGU, hspec, hspecPan, hspecTilt, fileImportFlag, loadPath, selX, selY, wavelengthBoxcar, stopFlag, ct, specPos
 	if(scanningFlag == 0 and fileImportFlag == 0): # start scanning
 		# note addition of 000 to convert max int to microseconds
 		ts = "h" + str(panLeft.get()) + "," + str(panRight.get()) + "," + str(panRes.get()) + "," + str(tiltBot.get()) + "," + str(tiltTop.get()) + "," + str(tiltRes.get()) + "," + str(maxInt.get()) + "000," + str(boxcar.get()) + "," + str(darkRep.get()) + "000," # note addition of three zeros for darkRep as it's expecing milliseconds
 		#print(ts)
-		if(int(panRight.get()) > int(panLeft.get()) and int(tiltTop.get()) > int(tiltBot.get())): # check pan & tilt coords make sense
+		if(reader is None):
+			statusLabel.config(text="Not connected")
+		elif(int(panRight.get()) > int(panLeft.get()) and int(tiltTop.get()) > int(tiltBot.get())): # check pan & tilt coords make sense
 			boxcarN = int(boxcar.get())
 			#updateStatus(ts)
 			statusLabel.config(text="Starting")
-			ser.write(str.encode( ts ))
+			reader.clear() # drop anything left over from before
+			reader.write(ts)
 			#btStart["state"] = "disabled"
 			btLoad["state"] = "disabled"
 			btStart["text"] = "Stop"
 			print("starting")
 			scanningFlag = 1
+
+			# raw data goes straight to disk so an interrupted scan isn't lost
+			ts = saveLabel.get()
+			t = time.localtime()
+			ct = "./scans/" + str(t.tm_year) + "-" + str(t.tm_mon) + "-" + str(t.tm_mday) + "_" + time.strftime("%H-%M-%S", t) + "_" + ts
+			os.makedirs("./scans", exist_ok=True)
+			scanWriter = storage.ScanWriter(ct + ".csv")
 			tt = time.time()
 			maxRGB = 1E-10
 			maxIGU = 1E-10
 		else:
 			statusLabel.config(text="Invalid pan/tilt")
-			return
+		return # lines from the HOSI are handled by pollSerial
 
-##	specLength = math.ceil(pixels/int(boxcar.get()))
-		
-	serFlag = 0
+	if(stopFlag == 1):
+		handleLine("x\n")
+		return
 
-	if(fileImportFlag == 1 and loadLine == 0):
-##		print("loading spec")
-		f=open(loadPath)
-		lines=f.readlines()
 
-	while (serFlag == 0 or fileImportFlag == 1):
-		if(stopFlag == 1):
-			output = "x"
-			dataString += output
-		else:
-			if(fileImportFlag == 0):
-				output = ser.readline()
+def pollSerial():
+	# handle the lines queued by the serial thread, runs on a timer so the GUI never waits for the HOSI
+	global moveQueue
+	for rec in reader.drain(serialBatch):
+		if(scanningFlag == 1):
+			handleLine(rec.line, rec.meta, rec.counts)
+		elif(len(moveQueue) > 0 and rec.kind == moveQueue[0][1]): # reply to a manual move
+			moveQueue.pop(0)
+			nextMove()
+	if(reader.error is not None):
+		print(reader.error)
+		connectionLost()
+		return
+	root.after(pollInterval, pollSerial)
+
+def connectionLost():
+	# the HOSI has gone (USB unplugged, phone asleep...). A scan in progress is kept on disk
+	# as it is, and resumed from its first unfinished row once the port opens again
+	global ser, reader, scanWriter, scanningFlag, stopFlag, rescanPass, rescanQueue, rowTilt, exposureHints, resumePath, moveQueue
+	if(scanningFlag == 1 and scanWriter is not None):
+		scanWriter.close()
+		if(stopFlag == 0):
+			resumePath = scanWriter.path
+			print("Connection lost, the scan will resume when the HOSI is back: " + resumePath)
+		scanWriter = None
+	scanningFlag = 0
+	stopFlag = 0
+	rescanPass = 0
+	rescanQueue = []
+	rowTilt = None
+	exposureHints = None
+	if(len(moveQueue) > 0):
+		moveQueue = []
+		moveButton["state"] = "active"
+	try:
+		ser.close()
+	except:
+		pass
+	ser = None
+	reader = None
+	btStart["text"] = "Start"
+	btStart["state"] = "disabled"
+	btLoad["state"] = "active"
+	btRescan["state"] = "active"
+	statusLabel.config(text="Disconnected")
+	root.after(reconnectWait, reconnect)
+
+def reconnect():
+	# keep trying to reopen the serial port after connectionLost
+	try:
+		connect()
+	except:
+		pass
+	if ser is None:
+		root.after(reconnectWait, reconnect)
+		return
+	print("Reconnected: " + str(ser))
+	startReader()
+
+
+def handleLine(output, meta=None, counts=None):
+	# one line from the HOSI: scan header, spectrum, or 'x' at the end of a scan
+	# meta & counts are the parsed spectrum if the serial thread has already done it
+	# returns True once the scan has finished
+	global tt, unitNumber, imLum, imR, imG, imB, imCol, imSatR, imSatB, panStart, panStop, pan_Res, panDim, tiltDim, tiltStart, tiltStop, tilt_Res, tiltRes, scanningFlag, scanWriter, boxcarN, maxRGB, focusPos
+	global imI, imU, imGG, imChlA, imChlB, imNDVI, maxIGU, hspec, hspecPan, hspecTilt, fileImportFlag, loadPath, selX, selY, wavelengthBoxcar, stopFlag, ct, specPos, exposureHints
+	global provenance, rescanQueue, rescanPass, rescanFiner, rowTilt, rowLeftward, passPans, hostBacklash
+	nextRegion = output.startswith('x') and rescanPass > 0 and len(rescanQueue) > 0 and stopFlag == 0
+	if(scanWriter is not None and not nextRegion): # the rescan file ends with the last region's 'x'
+		scanWriter.write(output)
+
+	if(nextRegion): # on to the next region of a rescan
+		reader.write(rescanQueue.pop(0))
+		rescanPass += 1
+		return False
+
+	if(output.startswith('x')):
+##		print("a")
+		statusLabel.config(text="Done")
+		if(exposureHints is not None and exposureHints.rows > 0):
+			print("Exposure hints: %d rows, %d ladder steps (%.1f s) saved" % (exposureHints.rows, exposureHints.stepsSaved, exposureHints.timeSaved/1e6))
+		exposureHints = None
+		## loop to add hspec le values
+		hspec = np.nan_to_num(hspec)# convert NaNs to zeros
+		#-------finish output file--------
+		if(rescanPass > 0):
+			finishRescan()
+		elif(scanWriter is not None):
+			ctt = ct + ".csv"
+			scanWriter.flush()
+			#-------recalibrate from the whole transcript (as HOSI_batch would)--------
+			# live spectra could only use the dark ladders measured before them, now each gets darks
+			# interpolated between the ladders either side. The live values were only the preview
+			s = None
+			try:
+				s = core.replayScan(core.readRawLines(ctt), engine, backlash=hostBacklash)
+			except Exception as e:
+				print("Error recalibrating scan: " + str(e))
+			if s is not None:
+				showScan(s)
+			scanWriter.finish(core.formatLeBlock(hspec, hspecPan, hspecTilt, wavelengthBoxcar))
+			scanWriter = None
+
+			#-------save binary copy (memory-mappable, see HOSI_storage)--------
+			if s is not None:
 				try:
-					output = output.decode('utf-8', 'replace')
-					dataString += output
-				except:
-					output = "0"
-					print("Error reading line")
-			else:
-				output = lines[loadLine]
-	##			print(output)
-	##			print(loadLine)
-				loadLine +=1
-			
-			### load file & read first line
-
-		if(output.startswith('x')):
-##			print("a")
-			statusLabel.config(text="Done")
-			## loop to add hspec le values
-			hspec = np.nan_to_num(hspec)# convert NaNs to zeros
-			if(fileImportFlag == 0):
-##				print("b")
-				dataString2 = "le values\npan,tilt,wavelength\n,"
-				for i in range(0, len(wavelengthBoxcar)):
-					dataString2 += "," + str(int(wavelengthBoxcar[i]))
-##				print("c") ## FAILS after this point... WHY!?
-##				dataString2 += str(hspec)
-				for i in range(0, len(hspecTilt)):
-					for j in range(0, len(hspecPan)):
-						dataString2 += '\n' + str(hspecPan[j]) + ',' + str(hspecTilt[i]) + ','
-						dataString3 = str(hspec[i, j])
-##						dataString3 = dataString3.replace('\n', ',')
-						dataString3 = dataString3.replace(' ', ',')
-						dataString3 = dataString3.replace('[', '')
-						dataString3 = dataString3.replace(']', '')
-						dataString3 = dataString3.replace('0.000e+00', '0')
-
-						dataString2 += dataString3
-
-##			print("d")
-			#-------save output file--------
-			if(fileImportFlag == 0):
-				ts = saveLabel.get()
-				t = time.localtime()
-				ct = "./scans/" + str(t.tm_year) + "-" + str(t.tm_mon) + "-" + str(t.tm_mday) + "_" + time.strftime("%H-%M-%S", t) + "_" + ts
-				ctt = ct + ".csv"
-##				print("e")
-				file_object = open(ctt, 'a')
-				file_object.write(dataString)
-				file_object.write(dataString2)
-				file_object.close()
-##				print("f")
-				statusLabel.config(text="Ready")
-				plotGraph("")
-				ctf = ct + "_sRGB.png"
-	##            plt.imsave(ctf, imCol)
-
-				#save image
-				nImR = ((imR/maxRGB)**0.42) * 255
-				nImG = ((imG/maxRGB)**0.42) * 255
-				nImB = ((imB/maxRGB)**0.42) * 255
-				imCol = np.dstack((nImR, nImG, nImB))
-				
-				tImCol = imCol.astype(np.uint8)
-				img = Image.fromarray(tImCol, "RGB")
-				#img.show()
-				img.save(ctf)
-##				print("g")
-			
-			dataString = ""
-			scanningFlag = 0
-			btStart["text"] = "Start"
-			btStart["state"] = "active"
-			btLoad["state"] = "active"
-			focusPos = 0 # reset focus position in case it was previously up
-			#statusLabel.config(text="Ready")
-			serFlag = 1
-			#fileImportFlag = 0
-			loadLine = 0
-			selX = -1
-			selY = -1 # reset these values to clear reflectance too
-			stopFlag = 0
-			print("h - done")
-			return
-		#output = output.decode('utf-8')
+					storage.saveScanBinary(ct + ".npz", s.raw, s.hspec, s.hspecPan, s.hspecTilt, s.wavelengthBoxcar, storage.scanImages(s), s.provenance)
+					b = s.measureBacklash()
+					if b is not None: # serpentine scan, on top of the whole pixels already allowed for (see processSpec)
+						hostBacklash = b + round(hostBacklash/pan_Res)*pan_Res
+						print("Right-to-left rows point %.1f pan steps right of the others, allowed for in the next scans (backlashSteps + this is about right)" % hostBacklash)
+					elif s.isSerpentine():
+						print("Warning: couldn't measure the offset of the right-to-left rows within %d pixels, placed as before" % core.backlashSearch)
+				except Exception as e:
+					print("Error saving binary scan: " + str(e))
+##			print("f")
+			statusLabel.config(text="Ready")
+			plotGraph("")
+
+			#save image, as HOSI_batch does
+			if s is not None:
+				Image.fromarray(core.srgbImage(s), "RGB").save(ct + "_sRGB.png")
+##			print("g")
+		
+		scanningFlag = 0
+		rescanPass = 0
+		rescanQueue = []
+		rescanFiner = False
+		rowTilt = None
+		rowLeftward = False
+		btStart["text"] = "Start"
+		btStart["state"] = "active"
+		btLoad["state"] = "active"
+		btRescan["state"] = "active"
+		focusPos = 0 # reset focus position in case it was previously up
+		#statusLabel.config(text="Ready")
+		selX = -1
+		selY = -1 # reset these values to clear reflectance too
+		stopFlag = 0
+		print("h - done")
+		return True
+
+	if(output.startswith('h')):
 		output = output.split(',')
+		passPans = [int(float(v)) for v in output[2:5]]
+		if(rescanPass > 0): # a region of a rescan, placed in the cube on show
+			exposureHints = core.ExposureHints(output) if exposureHintsOn else None
+			return False
 ##		specLength = math.ceil(pixels/boxcarN)
 		if(output[0] == 'h'):
 			unitNumber = int(output[1])
@@ -598,6 +576,10 @@ def getSpec():
 			if(reflFlag == 1):
 				clearRefl()
 			unitSetup()
+			darkStore.clear()
+			renderer.reset()
+			resetView()
+			specPos = 0
 
 			tiltStart = int(output[5])
 			tiltFrom.set(str(tiltStart))
@@ -628,160 +610,96 @@ def getSpec():
 			hspec = np.zeros([tiltDim, panDim, specLength])
 			hspecPan = np.zeros([panDim])
 			hspecTilt = np.zeros([tiltDim])
+			provenance = np.full([tiltDim, panDim], -1, dtype=np.int16)
+			exposureHints = core.ExposureHints(output) if exposureHintsOn and reader is not None else None
+
+
+		return False
+
+	if(output.startswith('e') and exposureHints is not None): # the HOSI took an exposure hint
+		exposureHints.acknowledge(output)
+		return False
+
+	if meta is None:
+		parsed = core.parseLine(output)
+		if parsed is None:
+			return False
+		meta, counts = parsed
+	if(meta[2] == 1 and meta[1] != rowTilt):
+		if(rowTilt is not None and scanWriter is not None):
+			scanWriter.sync() # the row before is complete, a scan cut off from here resumes after it
+		rowTilt = meta[1]
+		pans = core.rowPans(passPans[0], passPans[1], passPans[2], int(meta[1])) if passPans is not None else []
+		rowLeftward = len(pans) > 1 and meta[0] > pans[0] # a right-to-left row starts at its last position
+	if(meta[2] == 1 and exposureHints is not None):
+		hint = exposureHints.add(meta) # at the end of a row
+		if hint is not None:
+			reader.write(hint)
+	if(np.ndim(hspec) == 3 and len(counts) == hspec.shape[2]):
+		processSpec(meta, counts)
+	return False
+
+
+def processSpec(meta, counts):
+	global tt, darkStore, specPos, panStart, panStop, pan_Res, panDim, tiltDim, tiltStart, tiltStop, tilt_Res, tiltRes, linCoefs,  wavelength, wavelengthBins, maxRGB, boxcarN, maxIGU, hspec, engine, provenance
+	# meta: pan, tilt, type, intTime, satN; counts: raw counts (see core.parseLine)
+	specPos += 1
+	if(meta[2] == 0): # start or restart dark measurement
+		# a shorter integration time than the previous dark starts a new ladder (older ladders are kept for interpolation)
+		darkStore.add(int(meta[3]), counts, specPos)
+
+	if(meta[2] == 1): # light measurement
+		tempTime = int(meta[3])
+		dark = darkStore.dark(tempTime, specPos) # dark with the same integration time
+		if dark is not None:
+			#-----------calculate radiance-----------------
+			le, channels = engine.calibrate(counts, dark, tempTime)
+			vals = core.deriveImages(channels)
+
+			pan = int((int(meta[0]) - panStart) / pan_Res)
+			tilt = int((int(meta[1]) - tiltStart) / tilt_Res)
+			if(rowLeftward and hostBacklash != 0): # placed at the nearest pixel to where it points, as core.Scan.addSpectra does
+				pan = min(max(int(round((int(meta[0]) + hostBacklash - panStart) / pan_Res)), 0), panDim-1)
+				hspecPan[pan] = panStart + pan*pan_Res
+			else:
+				hspecPan[pan] = int(meta[0])
+			hspecTilt[tilt] = int(meta[1])
+			hspec[tilt, pan] = le[0] # this is watts per nanometer (i.e. not controlled for AUC), a rescan replaces it
+			provenance[tilt, pan] = rescanPass
+
+			ts = str(round(float(pan + (tilt * panDim)) / float(tiltDim * panDim) * 100.0)) + "% done"
+			imLum[tiltDim-1-tilt, pan] = vals["lum"][0]
+
+			imRt = vals["R"][0]
+			imGt = vals["G"][0]
+			imBt = vals["B"][0]
+			imR[tiltDim-1-tilt, pan] = imRt
+			imG[tiltDim-1-tilt, pan] = imGt
+			imB[tiltDim-1-tilt, pan] = imBt
+			maxRGB = max(maxRGB, imRt, imGt, imBt)
+
+			if int(meta[4]) > 0:
+				imSatR[tiltDim-1-tilt, pan] = 255
+			imSatB[tiltDim-1-tilt, pan] = int(meta[4])
+
+			imI[tiltDim-1-tilt, pan] = vals["I"][0]
+			imGG[tiltDim-1-tilt, pan] = vals["GG"][0]
+			imU[tiltDim-1-tilt, pan] = vals["U"][0]
+			maxIGU = max(maxIGU, vals["I"][0], vals["GG"][0], vals["U"][0])
+
+			imChlA[tiltDim-1-tilt, pan] = vals["chlA"][0]
+			imChlB[tiltDim-1-tilt, pan] = vals["chlB"][0]
+			renderer.touch(tiltDim-1-tilt, pan)
+
+			ct = time.time()
+			#print("time: " + str(tt-ct))
+			if ct > tt:
+				tt = ct + 1 # time to next plot in seconds
+				statusLabel.config(text=ts)
+				plotGraph("")
+				#root.after(1, plotGraph(ts))
 
 
-		if(len(output) == hspec.shape[2]+5):
-			if(int(output[2]) == 0 or int(output[2]) == 1 or int(output[2]) == 2 ):
-				#time.sleep(0.01)
-				#processSpec()
-				if(preview > 0): ## live update
-						root.after(1, processSpec) # 10 seems to work
-				else:
-						processSpec()
-				#statusLabel.config(text="Running")
-				return
-		
-
-def processSpec():
-	global tt, darkTimes, darkVals, panStart, panStop, pan_Res, panDim, tiltDim, tiltStart, tiltStop, tilt_Res, tiltRes, linCoefs,  wavelength, wavelengthBins, maxRGB, boxcarN, output, maxIGU, hspec
-	boxedLength = len(output) - 5
-	updateDuringDark = 0
-	if(int(output[2]) == 0): # start or restart dark measurement
-		#if(int(output[3]) <= minIntTime): # start of new dark measurement when int time = 1 (might be better to comapre to previous value)
-		if(len(darkTimes) == 0 or int(output[3]) < darkTimes[len(darkTimes)-1]):
-			darkTimes = []
-			darkVals = []
-			#print("new dark measurements")
-
-		if int(output[3]) > 100000:
-				updateDuringDark = 1
-		darkTimes.append(int(output[3]))
-		#for i in range(0,pixels):
-		for i in range(5,boxedLength+5):
-			darkVals.append(output[i])
-
-		  
-
-	if(int(output[2]) == 1): # light measurement
-		for j in range(0, len(darkTimes)): # search through dark integration times
-			tempTime = int(output[3])
-##            if(tempTime < 0):
-##                    tempTime = 1
-			if(tempTime == darkTimes[j]): # found corresponding integration time, microsecond values assumed to be equal to 1ms
-				#print("int " + row[3])
-
-			   #-----------calculate radiance-----------------
-				lum = 0.0
-				intTime = float(output[3])
-##                if(intTime < 0):
-##                        intTime = float(intTime/-1000.0)
-				#if(intTime < 0):
-				#        intTime = 0.032 # intTime of -1 = 32 microseconds
-				intTime += baseInt #was 550 # compensation for minimum microsecond exposure  0.382, 1200 makes the butterfly scan gradients look most smooth (implying it must be close)
-##				le = [0] * pixels
-				cieXval = 0.0
-				cieYval = 0.0
-				cieZval = 0.0
-				chlAval = 0.0
-				chlBval = 0.0
-				nIRval = 0.0
-				nUVval = 0.0
-				
-				#ts = "Radiance W/(sr*sqm*nm)\nInt.: "  + str(intTime)  + "ms Scans: " +  str(nScans)
-				pan = int((int(output[0]) - panStart) / pan_Res)
-				tilt = int((int(output[1]) - tiltStart) / tilt_Res)
-				hspecPan[pan] = int(output[0])
-##				hspecTilt[tiltDim-1-tilt] = int(output[1])
-				hspecTilt[tilt] = int(output[1])
-				loc = 0;
-				for i in range(0, pixels, boxcarN): #increment in boxcar size
-					xSum = 0
-					for k in range(0, boxcarN): #repeat boxcar window
-						if(i+k < pixels):
-							if radSens[i+k] > 0 and len(output) > loc+5 :
-
-								x = (float(output[loc+5])-float(darkVals[loc+boxedLength*j])) / boxcarN # subtract corresponding dark value
-								if(x > 0):
-										#linMultiplier = linCoefs[0]*math.log((x+1)*linCoefs[1])
-									x = math.exp(math.log(x)*linCoefs[0] + linCoefs[1])
-								if(x < 0):
-									x = -1 * math.exp(math.log(-x)*linCoefs[0] + linCoefs[1])
-
-								x = (x) / (radSens[i+k] * intTime)		
-
-								xSum += x
-##								if loc == 0 or loc == 1 or loc ==2:
-##								if loc == pixels-1:
-##									print("dark:" + darkVals[loc+boxedLength*j] + " light:" + output[loc+5] + " sens:" + str(radSens[i+k]) + " x:"+ str(x))
-								x = x * wavelengthBins[i+k] # the following values are adjusted for namometer bin width
-								cieXval += x * cieXt[i+k]
-								cieYval += x * cieYt[i+k]
-								cieZval += x * cieZt[i+k]
-								chlAval += x * chlAt[i+k]
-								chlBval += x * chlBt[i+k]
-								nIRval += x * nIRt[i+k]
-								nUVval += x * nUVt[i+k]
-								
-								lum += x * cieYt[i+k]
-					hspec[tilt, pan, loc-1] += xSum/boxcarN # this is watts per nanometer (i.e. not controlled for AUC)
-					loc += 1
-				lum = lum * 683 * 117.159574150716 #luminance: W/(sr*sqm*nm), scaling factor calculated by comaring JETI to HOSI - the input isn't scaled to the same as OSpRad
-				#ts = "Scanning " +  str(float(pan + (tilt * panDim)) / float(tiltDim * panDim) + "% done")
-				#print(str(tiltDim) + ", " + str(panDim))
-				ts = str(round(float(pan + (tilt * panDim)) / float(tiltDim * panDim) * 100.0)) + "% done"
-				#print(ts)
-				imLum[tiltDim-1-tilt, pan] = lum
-
-				# convert to sRGB * set white balance to match computer screen
-				imRt = 3.24*cieXval -1.54*cieYval - 0.50*cieZval
-				imGt = (-0.97*cieXval + 1.88*cieYval + 0.04*cieZval) * 1.44
-				imBt = (0.06*cieXval -0.20*cieYval + 1.06*cieZval) *  1.71
-
-				imR[tiltDim-1-tilt, pan] = imRt
-				imG[tiltDim-1-tilt, pan] = imGt
-				imB[tiltDim-1-tilt, pan] = imBt
-
-				if(imRt > maxRGB):
-					maxRGB = imRt
-				if(imGt > maxRGB):
-					maxRGB = imGt
-				if(imBt > maxRGB):
-					maxRGB = imBt
-
-				if int(output[4]) > 0:
-					imSatR[tiltDim-1-tilt, pan] = 255
-				imSatB[tiltDim-1-tilt, pan] = int(output[4])
-
-				imI[tiltDim-1-tilt, pan] = nIRval
-				imGG[tiltDim-1-tilt, pan] = cieYval
-				imU[tiltDim-1-tilt, pan] = nUVval
-
-				if(nIRval > maxIGU):
-					maxIGU = nIRval
-				if(cieYval > maxIGU):
-					maxIGU = cieYval
-				if(nUVval > maxIGU):
-					maxIGU = nUVval
-
-				imChlA[tiltDim-1-tilt, pan] = chlAval / (chlAval+nIRval)
-				imChlB[tiltDim-1-tilt, pan] = chlBval / (chlBval+nIRval)
-
-				
-
-				ct = time.time()
-				#print("time: " + str(tt-ct))
-				if ct > tt:
-					tt = ct + 1 # time to next plot in seconds
-					statusLabel.config(text=ts)
-					plotGraph("")
-					#root.after(1, plotGraph(ts))
-
-	if updateDuringDark == 1:
-		root.after(1, getSpec)
-	else:
-		getSpec()
-		
-
 
 def togglePreview():
 	global preview
@@ -806,102 +724,35 @@ def togglePreview():
 		
 
 
+def moveTo(tilt, pan, bt):
+	# queue a tilt then pan move, pollSerial sends the next command when the HOSI replies
+	global moveQueue, moveButton
+	if(scanningFlag == 0 and reader is not None and len(moveQueue) == 0):
+		moveButton = bt
+		bt["state"] = "disabled"
+		moveQueue = [("l" + str(tilt), 't'), ("p" + str(pan), 'p')]
+		reader.write(moveQueue[0][0])
+
+def nextMove():
+	if(len(moveQueue) > 0):
+		root.after(100, lambda: reader.write(moveQueue[0][0]) if len(moveQueue) > 0 else None)
+	else:
+		moveButton["state"] = "active"
+
 def goTL():
-	if(scanningFlag == 0):
-		btTL["state"] = "disabled"
-		ts = "l" + tiltTop.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for tilt to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b't')):
-				serFlag = 1
-		time.sleep(0.1)
-		ts = "p" + panLeft.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for pan to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b'p')):
-				serFlag = 1
-		btTL["state"] = "active"
+	moveTo(tiltTop.get(), panLeft.get(), btTL)
 
 def goTR():
-	if(scanningFlag == 0):
-		btTR["state"] = "disabled"
-		ts = "l" + tiltTop.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for tilt to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b't')):
-				serFlag = 1
-		time.sleep(0.1)
-		ts = "p" + panRight.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for pan to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b'p')):
-				serFlag = 1
-		btTR["state"] = "active"
+	moveTo(tiltTop.get(), panRight.get(), btTR)
 
 def goBL():
-	if(scanningFlag == 0):
-		btBL["state"] = "disabled"
-		ts = "l" + tiltBot.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for tilt to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b't')):
-				serFlag = 1
-		time.sleep(0.1)
-		ts = "p" + panLeft.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for pan to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b'p')):
-				serFlag = 1
-		btBL["state"] = "active"
+	moveTo(tiltBot.get(), panLeft.get(), btBL)
 
 def goBR():
-	if(scanningFlag == 0):
-		btBR["state"] = "disabled"
-		ts = "l" + tiltBot.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for tilt to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b't')):
-				serFlag = 1
-		time.sleep(0.1)
-		ts = "p" + panRight.get()
-		ser.write(str.encode( ts ))
-		serFlag = 0
-		while serFlag == 0: # wait for pan to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b'p')):
-				serFlag = 1
-		btBR["state"] = "active"
+	moveTo(tiltBot.get(), panRight.get(), btBR)
 	
 def goZero():
-	if(scanningFlag == 0):
-		btZero["state"] = "disabled"
-		ser.write(str.encode( "l0" ))
-		serFlag = 0
-		while serFlag == 0: # wait for tilt to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b't')):
-				serFlag = 1
-		ser.write(str.encode( "p0" ))
-		serFlag = 0
-		while serFlag == 0: # wait for pan to get to where it's going
-			output = ser.readline()
-			if(output.startswith(b'p')):
-				serFlag = 1
-		btZero["state"] = "active"
+	moveTo(0, 0, btZero)
 
 def showRes(a,b,c):
 	if(scanningFlag == 0):
@@ -928,43 +779,69 @@ tiltResolution.trace_add('write', showRes)
 
 
 
+def specAxes():
+	# matplotlib figure for the spectrum plot, created on first use
+	global figure, canvas, ax
+	if canvas is None:
+		import matplotlib.pyplot as plt
+		from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+		specPlaceholder.destroy()
+		figure = plt.Figure(figsize=(6,3), facecolor='#d9d9d9', tight_layout=True) #figsize=(3,1.5)
+		canvas = FigureCanvasTkAgg(figure, spec_frame)
+		canvas.get_tk_widget().grid(row=0, column=0, padx=2, pady=2, sticky=N+S+W)
+		ax = [figure.add_subplot(1, 1, x+1) for x in range(1)]
+	return ax
+
+def plotSpectrum(le, zeroMin):
+	specAxes()
+	[ax[i].clear() for i in range(1)]
+	ax[0].plot(wavelengthBoxcar,le)
+	if zeroMin:
+		ax[0].set_ylim(ymin=0)
+	canvas.draw()
+
+def previewWindow():
+	# part of the scan in view: (col, row, width, height) in image pixels (row 0 at the top),
+	# and screen pixels per image pixel. The view is kept inside the scan
+	fit = min(plotImX/panDim, plotImY/tiltDim) ## whole image contained in the frame
+	scale = fit*zoom
+	w = min(panDim, plotImX/scale)
+	h = min(tiltDim, plotImY/scale)
+	c0 = min(max(viewX*panDim - w/2, 0), panDim - w)
+	r0 = min(max(viewY*tiltDim - h/2, 0), tiltDim - h)
+	return c0, r0, w, h, scale
+
+def previewPoint(clickX, clickY):
+	# image position (col, row) under a point on the preview, which is centred in the frame
+	c0, r0, w, h, scale = previewWindow()
+	return c0 + (clickX - (plotImX - w*scale)/2)/scale, r0 + (clickY - (plotImY - h*scale)/2)/scale
+
+def imagePixel(clickX, clickY):
+	# hspec column & row (x, y) under a point on the preview image
+##	print(  plot_frame.bbox(plot) )
+	col, row = previewPoint(clickX, clickY)
+	x = int(math.floor(col))
+	y = tiltDim-int(math.floor(row))-1
+
+	#---ensure selected coordinates match image dimensions---
+	x = min(max(x, 0), panDim-1)
+	y = min(max(y, 0), tiltDim-1)
+	return x, y
+
 def onmouse(event):
 	global panDim, tiltDim, hspec, wavelengthBoxcar
 	global plotImX, plotImY, selX, selY, refs
-	clickX = event.x
-	clickY = event.y
 ##	print("mouse event")
 ##	print('x:' + str(event.x) + ' y:' + str(event.y))
-##	print(  plot_frame.bbox(plot) )
-	imAR = panDim/tiltDim # aspect ratio h/w y/x
-	frameAR = plotImX/plotImY # width is 2, height is 3
-	padding = 2
-	if(imAR > frameAR): ## frame narrower than image, image width scales with frame width
-		scale = (panDim)/(plotImX)
-	else: ## frame wider than image, image height scales with frame height
-		scale = (tiltDim)/(plotImY)
-
-	centreX = plotImX/2
-	centreY = plotImY/2
-	selX = int(math.floor( (panDim/2) + scale*(clickX-centreX)  )) ## offsets between click and centre of image
-	selY = int(math.floor( (tiltDim/2) + scale*(clickY-centreY) ))
-	selY = tiltDim-selY-1
-
-
+	selX, selY = imagePixel(event.x, event.y)
 ##	print("Selection:" + str(selX) + ", " + str(selY))
-	#---ensure selected coordinates match image dimensions---
-	if(selX < 0):
-		selX = 0
-	if(selX > panDim-1):
-		selX = panDim-1
-	if(selY < 0):
-		selY = 0
-	if(selY > tiltDim-1):
-		selY = tiltDim-1
-		
 
 	if(len(hspec)>0):
 		ts = "x:" + str(selX) + " y:" + str(selY) + "\npan:" + str(panStart+pan_Res*selX) + " tilt:" + str(tiltStart+tilt_Res*selY)
+		if(np.ndim(provenance) == 2 and provenance[selY, selX] > 0):
+			ts += "\nrescan " + str(provenance[selY, selX])
+		elif(np.ndim(provenance) == 2 and provenance[selY, selX] == core.filledPass):
+			ts += "\nnot measured, copied"
 		outLabel.config(text=ts)
 		if(imLum[selY, selX] > 0.1):
 			ts = "Lum (cd.m-2):\n" + f'{imLum[selY, selX]:.3f}'
@@ -977,19 +854,240 @@ def onmouse(event):
 		if(reflFlag == 1):
 			with np.errstate(invalid='ignore'):
 				le = le*100*refs
-		[ax[i].clear() for i in range(1)]
-		ax[0].plot(wavelengthBoxcar,le)
-		ax[0].set_ylim(ymin=0)
-		canvas.draw()
+		plotSpectrum(le, True)
 		btSpecOut["state"] = "active"
 
 
 
 
+def clickStart(event):
+	# a click on the preview selects the pixel when the button is let go, unless it was dragged
+	global dragAnchor, dragged
+	dragAnchor = (event.x, event.y, viewX, viewY)
+	dragged = False
+
+def clickEnd(event):
+	global dragAnchor
+	if(dragAnchor is not None and not dragged):
+		onmouse(event)
+	dragAnchor = None
+
+def dragPan(event):
+	# dragging the zoomed-in preview moves the view with the pointer
+	global viewX, viewY, dragged
+	if(dragAnchor is None or zoom <= 1 or len(imR) == 0):
+		return
+	if(not dragged and abs(event.x-dragAnchor[0]) + abs(event.y-dragAnchor[1]) < 4):
+		return ## small movements still count as a click
+	dragged = True
+	scale = previewWindow()[4]
+	viewX = dragAnchor[2] - (event.x-dragAnchor[0])/scale/panDim
+	viewY = dragAnchor[3] - (event.y-dragAnchor[1])/scale/tiltDim
+	clampView()
+	plotGraph("")
+
+def clampView():
+	# keep the centre where previewWindow puts it, so dragging back moves the view straight away
+	global viewX, viewY
+	c0, r0, w, h, scale = previewWindow()
+	viewX = (c0 + w/2)/panDim
+	viewY = (r0 + h/2)/tiltDim
+
+def zoomPreview(event):
+	# the mouse wheel zooms the preview in & out, keeping the point under the pointer still
+	global zoom, viewX, viewY
+	if(len(imR) == 0):
+		return
+	col, row = previewPoint(event.x, event.y)
+	if(event.num == 5 or event.delta < 0):
+		zoom = max(zoom/math.sqrt(2), 1)
+	else:
+		zoom = min(zoom*math.sqrt(2), maxZoom)
+	c0, r0, w, h, scale = previewWindow()
+	viewX = (col - (event.x - (plotImX - w*scale)/2)/scale + w/2)/panDim
+	viewY = (row - (event.y - (plotImY - h*scale)/2)/scale + h/2)/tiltDim
+	clampView()
+	plotGraph("")
+
+def resetView(event=None):
+	# show the whole scan (double-click, and for each new scan)
+	global zoom, viewX, viewY, dragAnchor
+	zoom = 1.0
+	viewX = 0.5
+	viewY = 0.5
+	dragAnchor = None
+	if(event is not None):
+		plotGraph("")
+
+def roiStart(event):
+	# shift-click on the preview starts selecting a region to rescan
+	global roiAnchor, dragAnchor
+	dragAnchor = None
+	if(len(hspec) > 0):
+		roiAnchor = imagePixel(event.x, event.y)
+		roiDrag(event)
+
+def roiDrag(event):
+	global roi
+	if(roiAnchor is None or len(hspec) == 0):
+		return
+	x, y = imagePixel(event.x, event.y)
+	roi = (min(y, roiAnchor[1]), max(y, roiAnchor[1]), min(x, roiAnchor[0]), max(x, roiAnchor[0]))
+	statusLabel.config(text="Region pan %d to %d, tilt %d to %d" % (panStart+pan_Res*roi[2], panStart+pan_Res*roi[3], tiltStart+tilt_Res*roi[0], tiltStart+tilt_Res*roi[1]))
+	plotGraph("")
+
+def rescanBase(path):
+	# raw lines of a saved scan without its 'x' (rebuilt from the raw arrays of a binary container)
+	if path.endswith('.npz'):
+		header, meta, counts, pos = storage.ScanArchive(path).raw()
+		return [",".join(header).strip() + "\n"] + [hserial.formatLine(m, c) for m, c in zip(meta, counts)]
+	return [line for line in core.readRawLines(path) if not line.startswith('x')]
+
+def rescan():
+	# rescan the region selected with shift-drag (or, with none, the saturated pixels) of the scan
+	# on show, one h command per rectangle, and merge the new spectra into it. The result is saved
+	# as <scan>_rescan<n>: the scan's raw lines followed by those of each region. Res. boxes set
+	# finer than the scan (dividing its resolution) rescan the region on that finer grid
+	global rescanQueue, rescanPass, rescanFiner, scanningFlag, scanWriter, ct, specPos, tt, stopFlag
+	if(scanningFlag == 1 or reader is None or len(hspec) == 0):
+		return
+	if(fileImportFlag == 1 and unfinished(loadPath)): # a scan that was cut off carries on instead
+		resumeScan(loadPath)
+		return
+	base = loadPath if fileImportFlag == 1 else ct + ".csv"
+	if(not os.path.exists(base)):
+		statusLabel.config(text="Scan file not found")
+		return
+	if(roi is not None):
+		regions = [roi]
+	else:
+		regions = HOSI_adaptive.refineRegions(np.flipud(imSatR) > 0, 0.5, 1, (tiltDim, panDim))
+	if(len(regions) == 0):
+		statusLabel.config(text="Shift-drag to select a region")
+		return
+	lines = rescanBase(base)
+	header = next((line.strip().split(',') for line in lines if line.startswith('h')), None)
+	if(header is None):
+		statusLabel.config(text="No scan header found")
+		return
+	try:
+		panR = int(panResolution.get())
+		tiltR = int(tiltResolution.get())
+	except ValueError:
+		panR, tiltR = pan_Res, tilt_Res
+	if(panR <= 0 or pan_Res % panR != 0):
+		panR = pan_Res
+	if(tiltR <= 0 or tilt_Res % tiltR != 0):
+		tiltR = tilt_Res
+	kp = pan_Res // panR
+	kt = tilt_Res // tiltR
+	darkRepMs = int(header[10]) if len(header) > 10 and header[10] != "" else 120000
+	grid = [panStart, panStop, panR, tiltStart, tiltStop, tiltR, int(header[8]), boxcarN, darkRepMs]
+	fineTilt = 1 + (tiltStop-tiltStart)//tiltR
+	finePan = 1 + (panStop-panStart)//panR
+	cmds = []
+	for t0, t1, p0, p1 in regions: # each pixel covers the finer positions nearest to it
+		region = (max(0, t0*kt - kt//2), fineTilt-1 if t1 == tiltDim-1 else t1*kt + (kt-1)//2, max(0, p0*kp - kp//2), finePan-1 if p1 == panDim-1 else p1*kp + (kp-1)//2)
+		cmds.append(HOSI_adaptive.scanCommand(HOSI_adaptive.regionValues(grid, region)))
+	area = sum((t1-t0+1)*(p1-p0+1) for t0, t1, p0, p1 in regions)
+	print("Rescanning %d region(s), %.1f%% of the scan" % (len(regions), 100.0*area/(tiltDim*panDim)))
+
+	name = re.sub(r'_rescan\d+$', '', os.path.splitext(base)[0])
+	k = 1
+	while os.path.exists(name + "_rescan" + str(k) + ".csv"):
+		k += 1
+	ct = name + "_rescan" + str(k)
+	scanWriter = storage.ScanWriter(ct + ".csv")
+	rescanFiner = kp > 1 or kt > 1
+	if(rescanFiner): # the merged cube is on the finer grid
+		scanWriter.write("h," + str(unitNumber) + "," + ",".join(str(v) for v in grid) + "\n")
+	for line in lines:
+		scanWriter.write(line)
+	rescanPass = max(1, int(core.scanPasses(core.parseRaw(lines)[1]).max(initial=0)) + 1)
+	rescanQueue = cmds
+	darkStore.clear()
+	specPos = 0
+	stopFlag = 0
+	reader.clear()
+	reader.write(rescanQueue.pop(0))
+	scanningFlag = 1
+	tt = time.time()
+	btStart["text"] = "Stop"
+	btLoad["state"] = "disabled"
+	btRescan["state"] = "disabled"
+	statusLabel.config(text="Rescanning")
+
+def finishRescan():
+	# replay the rescan file (the scan then each rescanned region) into one cube, filling the
+	# gaps of a finer grid from the nearest spectrum, and save & show it
+	global scanWriter, fileImportFlag, loadPath, darkStore, specPos
+	path = scanWriter.path
+	s = core.replayScan(core.readRawLines(path), engine)
+	if s is None:
+		scanWriter.close()
+		scanWriter = None
+		return
+	if(rescanFiner):
+		HOSI_adaptive.fillScan(s, s.provenance >= 0)
+	scanWriter.finish(core.formatLeBlock(s.hspec, s.hspecPan, s.hspecTilt, s.wavelengthBoxcar))
+	scanWriter = None
+	base = os.path.splitext(path)[0]
+	try:
+		storage.saveScanBinary(base + ".npz", s.raw, s.hspec, s.hspecPan, s.hspecTilt, s.wavelengthBoxcar, storage.scanImages(s), s.provenance)
+	except Exception as e:
+		print("Error saving binary scan: " + str(e))
+	Image.fromarray(core.srgbImage(s), "RGB").save(base + "_sRGB.png")
+	darkStore = s.darks
+	specPos = len(s.raw[3])
+	showScan(s)
+	fileImportFlag = 1
+	loadPath = path
+	print("Saved to " + path)
+
+def unfinished(path):
+	# True for a scan csv that was cut off before its last row
+	return path.endswith('.csv') and os.path.exists(path) and core.resumeCommand(core.readRawLines(path)) is not None
+
+def resumeScan(path):
+	# carry on with a scan that was cut off, from its first unfinished row. The new lines are
+	# appended to its file as another pass (see core.resumeCommand), with a fresh dark ladder
+	global resumePath, rescanQueue, rescanPass, scanningFlag, scanWriter, ct, darkStore, specPos, tt, stopFlag
+	resumePath = None
+	if(scanningFlag == 1 or reader is None):
+		return
+	lines = core.readRawLines(path)
+	resume = core.resumeCommand(lines)
+	if resume is None:
+		statusLabel.config(text="Nothing to resume")
+		return
+	command, row, rows = resume
+	s = core.replayScan(lines)
+	if s is None:
+		return
+	showScan(s)
+	darkStore = s.darks
+	specPos = len(s.raw[3])
+	ct = os.path.splitext(path)[0]
+	scanWriter = storage.ScanWriter(path)
+	rescanPass = int(core.scanPasses(s.raw[1]).max(initial=0)) + 1
+	rescanQueue = []
+	stopFlag = 0
+	reader.clear()
+	reader.write(command)
+	scanningFlag = 1
+	tt = time.time()
+	btStart["text"] = "Stop"
+	btStart["state"] = "active"
+	btLoad["state"] = "disabled"
+	btRescan["state"] = "disabled"
+	print("Resuming %s at row %d of %d" % (path, row+1, rows))
+	statusLabel.config(text="Resuming")
+
 def loadFile():
 	global fileImportFlag, loadPath, maxRGB, maxIGU
 	filetypes = (
 		('Hyperspec Files', '*.csv'),
+		('HOSI binary', '*.npz'),
 		('All files', '*.*')
 	)
 
@@ -1002,11 +1100,88 @@ def loadFile():
 		fileImportFlag = 1
 		maxRGB = 1E-10
 		maxIGU = 1E-10
-		getSpec()
+		if loadPath.endswith('.npz'): # binary container, cube & images are memory-mapped
+			showScan(storage.ScanArchive(loadPath).toScan())
+			return
+		importScan(loadPath)
 	except:
 		fileImportFlag = 0
 		return
 
+def importScan(path):
+	# load a saved scan from its le values table, or recalibrate it from the raw lines in one
+	# batched pass if Recal. is ticked (see core.loadScan), then draw it once
+	global darkStore, specPos
+	statusLabel.config(text="Loading")
+	root.update_idletasks()
+	t0 = time.time()
+	s = core.loadScan(path, recalibrate=(recalVal.get() == 1))
+	if s is None:
+		statusLabel.config(text="No scan found")
+		return
+	if hasattr(s, "darks"): # replayed from the raw data
+		darkStore = s.darks
+		specPos = len(s.raw[3])
+	showScan(s)
+	if unfinished(path):
+		btRescan["text"] = "Resume"
+		print("The scan was cut off, Resume carries on from its last complete row")
+	print("Loaded in %.2fs" % (time.time()-t0))
+
+def showScan(s):
+	# display a finished HOSI_core.Scan (e.g. from a binary container) without replaying the raw data
+	global unitNumber, panStart, panStop, pan_Res, panDim, tiltStart, tiltStop, tilt_Res, tiltDim, boxcarN, hspec, hspecPan, hspecTilt, wavelengthBoxcar, maxRGB, maxIGU, selX, selY
+	global imLum, imR, imG, imB, imSatR, imSatB, imI, imGG, imU, imChlA, imChlB, provenance, roi
+	unitNumber = s.unitNumber
+	panStart = s.panStart
+	panStop = s.panStop
+	pan_Res = s.pan_Res
+	panDim = s.panDim
+	tiltStart = s.tiltStart
+	tiltStop = s.tiltStop
+	tilt_Res = s.tilt_Res
+	tiltDim = s.tiltDim
+	boxcarN = s.boxcarN
+	panFrom.set(str(panStart))
+	panTo.set(str(panStop))
+	panResolution.set(str(pan_Res))
+	tiltFrom.set(str(tiltStart))
+	tiltTo.set(str(tiltStop))
+	tiltResolution.set(str(tilt_Res))
+	boxcarVal.set(str(boxcarN))
+	if(reflFlag == 1):
+		clearRefl()
+	unitSetup()
+
+	hspec = s.hspec
+	hspecPan = s.hspecPan
+	hspecTilt = s.hspecTilt
+	wavelengthBoxcar = s.wavelengthBoxcar
+	imLum = s.imLum
+	imR = s.imR
+	imG = s.imG
+	imB = s.imB
+	imSatR = s.imSatR
+	imSatB = s.imSatB
+	imI = s.imI
+	imGG = s.imGG
+	imU = s.imU
+	imChlA = s.imChlA
+	imChlB = s.imChlB
+	maxRGB = s.maxRGB
+	maxIGU = s.maxIGU
+	provenance = getattr(s, "provenance", None)
+	if provenance is None: # saved before rescans were kept track of
+		provenance = np.where(np.any(np.asarray(hspec) != 0, axis=2), 0, -1).astype(np.int16)
+	roi = None
+	btRescan["text"] = "Rescan"
+	renderer.reset()
+	resetView()
+	selX = -1
+	selY = -1
+	statusLabel.config(text="Done")
+	plotGraph("")
+
 def setReflVal():
 	global reflVal, reflFlag, selX, selY, refs, hspec, imR, imG, imB, maxRGB, wbR, wbG, wbB, wbI, wbGG, wbU, maxIGU, tiltDim
 	if(reflFlag == 0):
@@ -1085,9 +1260,7 @@ def clearRefl():
 	if(len(hspec)>0):
 ##		print("plot update")
 		le = hspec[selY][selX]
-		[ax[i].clear() for i in range(1)]
-		ax[0].plot(wavelengthBoxcar,le)
-		canvas.draw()
+		plotSpectrum(le, False)
 	plotGraph("Reflectance cleared")
 
 
@@ -1108,57 +1281,25 @@ def startStop():
 
 def imageOutput():
 	print("Outputting selected cone-catch images");
-	for item in receptorListbox.curselection():
-		#print("item: "+ str(item))
-		print(receptorNames[item])
-	
-		#------resample spectral sensitivities at spectrometer wavelengths---------
-		recept = [0.0] * pixels
-		rSum = 0.0
-		for i in range(0,pixels):
-			# ~ for j in range(0, len(cieWav)):
-			for j in range(0, len(receptorVals[item])):
-				if(round(wavelength[i]) == cieWav[j]):
-					recept[i] = receptorVals[item][j]
-					rSum += recept[i]
-					
-		# ~ for i in range(0,pixels):
-			# ~ recept[i] = recept[i]/rSum #  normalise to area under curve = 1
-		
-		# ~ print(recept)
-		imOut = np.zeros([tiltDim, panDim])
-		
-		# ~ pes = [(6.626E-34 * 2.998E8) / (x*1E-9) for x in wavelengthBoxcar] # energy per photon at each wavelength
-		pes = [(1E18 * 6.626E-34 * 2.998E8) / (x*1E-9) for x in wavelengthBoxcar] # energy per photon at each wavelength - SCALED (multiplied by 1E18 to give more sensible ouput given 32-bit floating point range limits
-		#print(pes)
-		
-		for y in range(0, tiltDim):
-			for x in range(0, panDim):
-				leSum = 0.0
-				le = hspec[y][x]
-				if(reflFlag == 1):
-					with np.errstate(invalid='ignore'):
-						le = le*100*refs
-				# ~ print(str(len(le)))
-				
-				for z in range(0, len(le)):
-					for b in range(0, boxcarN):
-						# ~ leSum += le[z] * recept[b + z*boxcarN] * wavelengthBins[b + z*boxcarN] # correct for differences in bin-width (area-under curve)
-						leSum += (le[z]/pes[z]) * recept[b + z*boxcarN] * wavelengthBins[b + z*boxcarN] # correct for differences in bin-width (area-under curve)
+	items = receptorListbox.curselection()
+	if len(items) == 0 or len(hspec) == 0:
+		return
+	#------resample spectral sensitivities at spectrometer wavelengths---------
+	recepts = [sensFull[receptorNames[item]] for item in items]
 
-				imOut[tiltDim-y-1, x] = leSum
+	# one weight vector per receptor (bin widths, photon energy, boxcar & any reflectance standard), then all catches at once
+	weights = core.coneCatchWeights(recepts, wavelengthBins, wavelengthBoxcar, boxcarN, refs if reflFlag == 1 else None)
+	catches = core.coneCatches(hspec, weights)
 
-				# ~ print("x: "+ str(x) + " y: " + str(y) + " val: " + str(leSum))
-		# ~ print(imOut)
-		img = Image.fromarray(imOut)
-		
-		if fileImportFlag == 1:
-			ts = loadPath.replace('.csv', '')
-		else:
-			ts = ct
-		print(ts)
-		ts = ts + "_" + receptorNames[item] + ".tif"
-		img.save(ts)
+	if fileImportFlag == 1:
+		ts = os.path.splitext(loadPath)[0]
+	else:
+		ts = ct
+	print(ts)
+	for item, imOut in zip(items, catches):
+		print(receptorNames[item])
+		img = Image.fromarray(imOut.astype(np.float32))
+		img.save(ts + "_" + receptorNames[item] + ".tif")
 
 		
 def specOutput():
@@ -1173,7 +1314,7 @@ def specOutput():
 				le = le*100*refs
 				
 		if fileImportFlag == 1:
-			ts = loadPath.replace('.csv', '')
+			ts = os.path.splitext(loadPath)[0]
 		else:
 			ts = ct
 		# ~ print(ts)
@@ -1318,6 +1459,20 @@ boxcar.grid(row=1, column=2, padx=2, pady=2, sticky=N+W)
 darkRep = Entry(frame2, textvariable = darkRepVal, width =11)
 darkRep.grid(row=1, column=3, padx=2, pady=2, sticky=N+W)
 
+recalCheck = Checkbutton(frame2, text="Recal.", variable=recalVal)
+recalCheck.grid(row=1, column=4, padx=2, pady=2, sticky=N+W)
+
+serpentineCheck = Checkbutton(frame2, text="Zigzag", variable=serpentineVal, command= lambda: setSerpentine()) # alternate rows right to left
+serpentineCheck.grid(row=0, column=5, padx=2, pady=2, sticky=N+W)
+
+backlash = Entry(frame2, textvariable = backlashVal, width =6) # pan steps of slack, taken off the right-to-left rows
+backlash.grid(row=1, column=5, padx=2, pady=2, sticky=N+W)
+backlash.bind('<Return>', setSerpentine)
+backlash.bind('<FocusOut>', setSerpentine)
+
+btRescan = Button(frame2, text="Rescan", relief="raised", command= lambda: rescan()) # selected region (shift-drag), or the saturated pixels
+btRescan.grid(row=0, column=4, padx=2, pady=2, sticky=N+W)
+
 ##---------------FRAME3-----------------
 
 frame3 = Frame(root)
@@ -1350,7 +1505,15 @@ gridImResized = ImageTk.PhotoImage(gridImt)
 plot = Label(plot_frame, image = gridImResized, fg="gray", justify="left", cursor= "hand2")
 
 plot.grid(row=0, column=0, padx=0, pady=0, sticky=N+W+E+S)
-plot.bind('<1>', onmouse) ## mouse click event
+plot.bind('<1>', clickStart) ## mouse click event, the pixel is selected on release (see clickEnd)
+plot.bind('<ButtonRelease-1>', clickEnd)
+plot.bind('<B1-Motion>', dragPan) ## drag to pan when zoomed in
+plot.bind('<Double-1>', resetView)
+plot.bind('<MouseWheel>', zoomPreview) ## Windows & macOS
+plot.bind('<Button-4>', zoomPreview) ## Linux
+plot.bind('<Button-5>', zoomPreview)
+plot.bind('<Shift-1>', roiStart) ## shift-drag selects a region to rescan
+plot.bind('<Shift-B1-Motion>', roiDrag)
 plot_frame.grid_propagate(False)
 
 
@@ -1358,10 +1521,11 @@ plot_frame.grid_propagate(False)
 spec_frame = Frame(root)
 spec_frame.grid(row=4, column=0, sticky=N+S+E+W)
 
-figure = plt.Figure(figsize=(6,3), facecolor='#d9d9d9', tight_layout=True) #figsize=(3,1.5)
-canvas = FigureCanvasTkAgg(figure, spec_frame)
-canvas.get_tk_widget().grid(row=0, column=0, padx=2, pady=2, sticky=N+S+W)
-ax = [figure.add_subplot(1, 1, x+1) for x in range(1)]
+figure = None
+canvas = None
+ax = []
+specPlaceholder = Frame(spec_frame, width=600, height=300, bg='#d9d9d9') # same size as the figure, replaced on first plot
+specPlaceholder.grid(row=0, column=0, padx=2, pady=2, sticky=N+S+W)
 
 
 spec_frame.columnconfigure(0, weight=1)
@@ -1410,5 +1574,84 @@ root.columnconfigure(0, weight=1)
 
 root.bind("<Configure>", updatePlotRes) ## resizing the window calls this function
 
+def startSerial():
+	# open the HOSI's serial port once the window is up, so start-up isn't held up by USB
+	try:
+		connect()
+	except:
+		print("Not connected")
+		print("Check connection, and that the code is using the correct serial port")
+	print(ser)
+	if ser is not None:
+		startReader()
+	else:
+		statusLabel.config(text="Disconnected")
+		btStart["state"] = "disabled"
+
+def startReader():
+	global reader
+	reader = hserial.SerialReader(ser)
+	reader.start()
+	root.after(pollInterval, pollSerial)
+	root.after(bootDelay, requestSetup)
+
+def setSerpentine(event=None):
+	# Zigzag box & backlash entry, sent to the HOSI straight away if it's connected (and at each connection)
+	global serpentineOn, backlashSteps, hostBacklash
+	try:
+		b = int(float(backlashVal.get()))
+	except ValueError:
+		b = backlashSteps
+	backlashVal.set(str(b))
+	on = serpentineVal.get() == 1
+	if(on == serpentineOn and b == backlashSteps):
+		return
+	if(b != backlashSteps):
+		hostBacklash = 0.0 # measured with the old setting
+	serpentineOn = on
+	backlashSteps = b
+	if(reader is not None and reader.error is None):
+		requestSetup([hserial.serpentineCommand(serpentineOn, backlashSteps)])
+
+def setupCommands():
+	# settings sent to the HOSI once it has booted, firmware that doesn't know them ignores them
+	cmds = [hserial.binaryRequest] # spectra as binary frames (about half the bytes of text)
+	if serpentineOn:
+		cmds.append(hserial.serpentineCommand(True, backlashSteps))
+	return cmds
+
+def requestSetup(cmds=None):
+	# one command at a time, waiting for each reply, as the firmware would run commands sent
+	# close together into one. Start waits until they're done
+	if cmds is None:
+		cmds = setupCommands()
+	if(reader is None or reader.error is not None):
+		return
+	if(scanningFlag == 1 or len(moveQueue) > 0):
+		root.after(setupWait, lambda: requestSetup(cmds))
+		return
+	if(len(cmds) == 0):
+		setupDone()
+		return
+	btStart["state"] = "disabled"
+	reader.write(cmds[0])
+	root.after(setupWait, lambda: requestSetup(cmds[1:]))
+
+def setupDone():
+	if(reader.error is None):
+		btStart["state"] = "active"
+	print("Binary spectrum frames: " + ("on" if reader.binary else "off"))
+	if(resumePath is not None and reader.error is None):
+		resumeScan(resumePath)
+
+def firstFrame():
+	root.update_idletasks()
+	t = time.time() - startTime
+	print("Start-up: core import %.2fs, first frame %.2fs" % (coreTime, t))
+	if t > startupBudget:
+		print("Warning: start-up took longer than %.1fs" % startupBudget)
+	startSerial()
+
+root.after(0, firstFrame)
 root.mainloop()
 
@@ -0,0 +1,294 @@
+##
+##_________________________HOSI adaptive scanning_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Coarse-to-fine scans. A normal scan samples the whole pan/tilt grid at one resolution,
+## so plain sky and ground take as long as the edges of lamps and leaves. Here a coarse
+## scan (every factor-th pan & tilt step of the grid asked for) is run first, a detail
+## map is worked out from its cube, and fine scans are then only run over the parts of
+## the grid where the detail is above the threshold. The firmware only scans rectangles,
+## so each fine region is an ordinary h command (with its own dark ladders): flagged
+## coarse cells are joined into rectangles, as long as at least minFill of each
+## rectangle is flagged.
+##
+## The detail between two neighbouring coarse spectra is the larger of the difference
+## in their log radiance (0.3 is a 35% step in brightness) and the spectral angle between
+## them in radians (a change of colour), measured on a few broad bands, and both spectra
+## get it. At night most of a scene is close to the noise, so half the median radiance
+## is added before taking logs and the angle is scaled down the same way for dim spectra.
+##
+## All passes are merged into one scan on the fine grid: the transcripts are joined
+## under the fine grid's header, keeping the latest reading where a position was measured
+## twice, so the saved csv replays & recalibrates like any other scan. Pixels only covered
+## by the coarse pass are filled from the nearest measured spectrum in the le values table
+## and images, and marked core.filledPass in the provenance of <scan>.npz (a replay of the
+## csv's raw data leaves them empty); <scan>_step.png gives the sampling step of each
+## pixel (1 where the fine grid was measured, factor in the coarse areas). Example, on the simulator:
+##
+##	python HOSI_adaptive.py --simulate --scan "h-200,200,10,400,600,10,2000000,2,30000," -o adaptive/test
+##
+## or on a HOSI with -p /dev/ttyUSB0 (COM3 etc. on Windows).
+##
+
+
+import argparse, os, sys, time
+import numpy as np
+import HOSI_core as core
+import HOSI_serial as hserial
+import HOSI_storage as storage
+
+
+bootDelay = 2.5 # seconds for the Arduino to restart after the port is opened
+detailBands = 8 # broad bands the spectral angle is measured on
+detailFloor = 0.5 # radiance added before comparing, as a fraction of the median (keeps noise in the dark out)
+
+
+def parseScanCommand(command):
+	# the nine values of an h command, e.g. "h-200,200,10,400,600,10,2000000,2,30000,"
+	vals = [int(float(v)) for v in command.strip().lstrip('h').split(',') if v.strip() != ""]
+	if len(vals) != 9:
+		raise ValueError("expected 9 values in the scan command: " + command)
+	return vals
+
+def scanCommand(vals):
+	return "h" + "".join(str(int(v)) + "," for v in vals)
+
+def coarseValues(vals, factor):
+	# the coarse pass: every factor-th pan & tilt position of the fine grid
+	panL, panR, panRes, tiltB, tiltT, tiltRes = vals[:6]
+	cp = panRes*factor
+	ct = tiltRes*factor
+	return [panL, panL + (panR-panL)//cp*cp, cp, tiltB, tiltB + (tiltT-tiltB)//ct*ct, ct] + list(vals[6:])
+
+
+def detailMap(hspec, bands=detailBands, floor=detailFloor):
+	# (tilt, pan) detail of a cube (see above), 0 where a spectrum or all its neighbours are missing
+	spec = np.clip(np.nan_to_num(np.asarray(hspec, dtype=float)), 0, None)
+	n = spec.shape[-1] // bands * bands
+	spec = spec[..., :n].reshape(spec.shape[:-1] + (bands, -1)).sum(axis=-1)
+	total = spec.sum(axis=-1)
+	measured = total > 0
+	if not measured.any():
+		return np.zeros(total.shape)
+	floor = floor * np.median(total[measured])
+	logL = np.log(total + floor)
+	norm = np.sqrt((spec**2).sum(axis=-1))
+	unit = spec / np.where(measured, norm, 1)[..., None]
+	detail = np.zeros(total.shape)
+	for a, b in (((slice(None), slice(0, -1)), (slice(None), slice(1, None))), ((slice(0, -1), slice(None)), (slice(1, None), slice(None)))):
+		cos = np.clip((unit[a] * unit[b]).sum(axis=-1), -1, 1)
+		low = np.minimum(total[a], total[b])
+		d = np.maximum(np.abs(logL[a] - logL[b]), np.arccos(cos) * low/(low + floor))
+		d[~(measured[a] & measured[b])] = 0
+		detail[a] = np.maximum(detail[a], d)
+		detail[b] = np.maximum(detail[b], d)
+	return detail
+
+def refineRegions(detail, threshold, factor, fineShape, mergeGap=1, minFill=0.5):
+	# rectangles of the fine grid to scan again, (tilt0, tilt1, pan0, pan1) inclusive indices.
+	# Flagged cells in a row are joined across gaps of up to mergeGap cells, and each run is
+	# added to a rectangle from the row below it touches while minFill of that stays flagged
+	# (rectangles that end up overlapping are joined).
+	# Each coarse cell covers the fine pixels closer to it than to the next coarse cell
+	flagged = np.asarray(detail) > threshold
+	boxes = [] # [tilt0, tilt1, pan0, pan1, flagged cells] in coarse cells
+	for i in range(flagged.shape[0]):
+		runs = []
+		for j in np.flatnonzero(flagged[i]):
+			if len(runs) > 0 and j - runs[-1][1] <= mergeGap+1:
+				runs[-1][1] = j
+			else:
+				runs.append([j, j])
+		for j0, j1 in runs:
+			n = int(flagged[i, j0:j1+1].sum())
+			for b in boxes:
+				if b[1] >= i-1 and j0 <= b[3] and j1 >= b[2]:
+					u0, u1 = min(b[2], j0), max(b[3], j1)
+					if b[4]+n >= minFill*(i-b[0]+1)*(u1-u0+1):
+						b[1:] = [i, u0, u1, b[4]+n]
+						break
+			else:
+				boxes.append([i, i, j0, j1, n])
+	merged = True
+	while merged: # rectangles that grew into each other become one
+		merged = False
+		for a in range(len(boxes)):
+			for b in range(a+1, len(boxes)):
+				p, q = boxes[a], boxes[b]
+				if p[0] <= q[1] and q[0] <= p[1] and p[2] <= q[3] and q[2] <= p[3]:
+					boxes[a] = [min(p[0], q[0]), max(p[1], q[1]), min(p[2], q[2]), max(p[3], q[3]), p[4]+q[4]]
+					del boxes[b]
+					merged = True
+					break
+			if merged:
+				break
+
+	tiltDim, panDim = fineShape
+	lastT, lastP = flagged.shape[0]-1, flagged.shape[1]-1
+	regions = []
+	for i0, i1, j0, j1, n in boxes:
+		t0 = max(0, i0*factor - factor//2)
+		t1 = tiltDim-1 if i1 == lastT else min(tiltDim-1, i1*factor + (factor-1)//2)
+		p0 = max(0, j0*factor - factor//2)
+		p1 = panDim-1 if j1 == lastP else min(panDim-1, j1*factor + (factor-1)//2)
+		regions.append((t0, t1, p0, p1))
+	return sorted(regions)
+
+def regionValues(vals, region):
+	# h command values to scan one region of the fine grid
+	t0, t1, p0, p1 = region
+	panL, panR, panRes, tiltB, tiltT, tiltRes = vals[:6]
+	return [panL + p0*panRes, panL + p1*panRes, panRes, tiltB + t0*tiltRes, tiltB + t1*tiltRes, tiltRes] + list(vals[6:])
+
+
+def mergeTranscripts(unitNumber, vals, passes):
+	# one transcript on the fine grid from the lines of each pass: the fine grid's header,
+	# then every line of each pass apart from light spectra measured again by a later pass
+	body = []
+	light = {} # (pan, tilt) -> index in body of the latest light spectrum there
+	for lines in passes:
+		for line in lines:
+			if line.startswith('h'):
+				continue
+			if line.startswith('x'):
+				break
+			m = core.parseMeta(line.split(',', 5)[:5])
+			if m is not None and m[2] == 1:
+				light[(m[0], m[1])] = len(body)
+			body.append(line)
+	keep = set(light.values())
+	lines = ["h," + str(unitNumber) + "," + ",".join(str(int(v)) for v in vals) + "\n"]
+	for k, line in enumerate(body):
+		m = core.parseMeta(line.split(',', 5)[:5])
+		if m is None or m[2] != 1 or k in keep:
+			lines.append(line)
+	lines.append("x\n")
+	return lines
+
+def nearestMeasured(measured):
+	# flat index of the nearest measured pixel to each pixel (spreading out one pixel at
+	# a time to the four neighbours), -1 where nothing is measured
+	src = np.where(measured, np.arange(measured.size).reshape(measured.shape), -1)
+	while (src < 0).any():
+		new = src.copy()
+		for a, b in (((slice(None), slice(1, None)), (slice(None), slice(0, -1))), ((slice(None), slice(0, -1)), (slice(None), slice(1, None))), ((slice(1, None), slice(None)), (slice(0, -1), slice(None))), ((slice(0, -1), slice(None)), (slice(1, None), slice(None)))):
+			new[a] = np.where(new[a] < 0, src[b], new[a])
+		if np.array_equal(new, src):
+			break
+		src = new
+	return src
+
+def fillScan(scan, measured):
+	# fill the cube & images of a Scan where nothing was measured from the nearest measured
+	# pixel, marking them in its provenance. Returns the number of pixels filled
+	src = nearestMeasured(measured)
+	gap = ~measured & (src >= 0)
+	scan.provenance[gap] = core.filledPass
+	flat = scan.hspec.reshape(-1, scan.specLength)
+	scan.hspec[gap] = flat[src[gap]]
+	gapIm = np.flipud(gap) # images are flipped vertically
+	srcIm = np.flipud(src)
+	for name in storage.imageNames:
+		im = getattr(scan, name)
+		im[gapIm] = np.flipud(im).reshape(-1)[srcIm[gapIm]]
+	scan.hspecPan = scan.panStart + np.arange(scan.panDim)*scan.pan_Res
+	scan.hspecTilt = scan.tiltStart + np.arange(scan.tiltDim)*scan.tilt_Res
+	return int(gap.sum())
+
+
+def adaptiveScan(reader, vals, factor=4, threshold=0.3, hints=False, engine=None, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv", mergeGap=1, minFill=0.5, log=print):
+	# run the coarse pass, then the fine passes over the detailed regions, on a started
+	# HOSI_serial.SerialReader. vals: the h command values of the fine grid.
+	# Returns the merged Scan (coarse areas filled), the (tilt, pan) step map & merged lines
+	coarse = coarseValues(vals, factor)
+	log("coarse pass: " + scanCommand(coarse))
+	lines, exposure = reader.collect(scanCommand(coarse), 'x', hints)
+	passes = [lines]
+	coarseScan = core.replayScan(lines, engine, calPath, sensPath)
+	if coarseScan is None:
+		raise ValueError("no scan header in the reply to " + scanCommand(coarse))
+	if engine is None:
+		engine = core.makeEngine(coarseScan.unitNumber, coarseScan.boxcarN, calPath, sensPath)
+	unitNumber = coarseScan.unitNumber
+	fine = core.Scan(["h", str(unitNumber)] + [str(v) for v in vals], allocate=False)
+	regions = refineRegions(detailMap(coarseScan.hspec), threshold, factor, (fine.tiltDim, fine.panDim), mergeGap, minFill)
+	step = np.full((fine.tiltDim, fine.panDim), factor, dtype=np.uint8)
+	for t0, t1, p0, p1 in regions:
+		step[t0:t1+1, p0:p1+1] = 1
+	log("%d fine regions covering %.0f%% of the grid" % (len(regions), 100.0*np.mean(step == 1)))
+
+	for k, region in enumerate(regions):
+		cmd = scanCommand(regionValues(vals, region))
+		log("fine pass %d/%d: %s" % (k+1, len(regions), cmd))
+		lines, exposure = reader.collect(cmd, 'x', hints)
+		passes.append(lines)
+
+	merged = mergeTranscripts(unitNumber, vals, passes)
+	scan = core.replayScan(merged, engine)
+	fillScan(scan, np.any(scan.hspec != 0, axis=2))
+	return scan, step, merged
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Coarse-to-fine HOSI scan")
+	parser.add_argument("--scan", required=True, help="h command of the fine grid, e.g. \"h-200,200,10,400,600,10,2000000,2,30000,\"")
+	parser.add_argument("-o", "--output", required=True, help="base path of the saved files (without .csv)")
+	parser.add_argument("-p", "--port", help="serial port of the HOSI")
+	parser.add_argument("--simulate", action="store_true", help="scan the virtual HOSI (HOSI_simulator) instead")
+	parser.add_argument("--replay", help="with --simulate, recorded scan csv to play back")
+	parser.add_argument("--brightness", type=float, default=1.0, help="with --simulate, scale the synthetic scene")
+	parser.add_argument("-f", "--factor", type=int, default=4, help="coarse pass samples every factor-th step (default 4)")
+	parser.add_argument("-t", "--threshold", type=float, default=0.3, help="detail above which the fine grid is scanned (default 0.3)")
+	parser.add_argument("--min-fill", type=float, default=0.5, help="least flagged fraction of a fine region (default 0.5)")
+	parser.add_argument("--hints", action="store_true", help="send exposure hints for each row")
+	parser.add_argument("-c", "--calibration", default="./calibration_data.txt")
+	parser.add_argument("-s", "--sensitivities", default="./sensitivity_data.csv")
+	args = parser.parse_args(argv)
+
+	vals = parseScanCommand(args.scan)
+	device = None
+	if args.simulate:
+		import HOSI_simulator as sim
+		if args.replay:
+			scene = sim.ReplayScene(args.replay, args.calibration)
+		else:
+			wavCoef, radSens, linCoefs = sim.unitCalibration(sim.unitNumber, args.calibration)
+			scene = sim.SyntheticScene(wavCoef, radSens, brightness=args.brightness)
+		device = sim.VirtualHOSI(scene, speed=0, calPath=args.calibration)
+		ser = sim.LoopbackSerial(device)
+	elif args.port:
+		import serial
+		ser = serial.Serial(args.port, 115200)
+		time.sleep(bootDelay)
+	else:
+		parser.error("give a serial port (-p) or --simulate")
+
+	reader = hserial.SerialReader(ser)
+	reader.start()
+	start = time.time()
+	try:
+		scan, step, merged = adaptiveScan(reader, vals, args.factor, args.threshold, args.hints, None, args.calibration, args.sensitivities, minFill=args.min_fill)
+	finally:
+		reader.stop()
+		ser.close()
+
+	from PIL import Image
+	outDir = os.path.dirname(args.output)
+	if outDir != "":
+		os.makedirs(outDir, exist_ok=True)
+	saved = core.saveOutputs(scan, args.output, rawLines=merged)
+	saved.append(storage.saveScanBinary(args.output + ".npz", scan.raw, scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar, storage.scanImages(scan), scan.provenance))
+	Image.fromarray(np.flipud(step)).save(args.output + "_step.png")
+	saved.append(args.output + "_step.png")
+	spectra = sum(1 for line in merged if core.parseLine(line) is not None)
+	took = device.clock if device is not None else time.time() - start
+	print("%d spectra in %.1f s%s" % (spectra, took, " (device time)" if device is not None else ""))
+	print("%.1f%% of the grid filled from the nearest measured pixel (provenance %d in the .npz)" % (100.0*np.mean(scan.provenance == core.filledPass), core.filledPass))
+	for path in saved:
+		print("  " + path)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
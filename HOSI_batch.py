@@ -0,0 +1,115 @@
+##
+##_________________________HOSI batch reprocessing_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Headless reprocessing of saved HOSI scans, e.g. after a calibration update. No
+## display or HOSI device is needed. Each scan .csv in the input directory is replayed
+## from its raw data using the current calibration_data.txt and sensitivity_data.csv
+## and the following are written to the output directory:
+##
+##	<scan>.csv		raw data plus a new table of calibrated le values
+##	<scan>.npz		binary copy of the raw data & calibrated cube (see HOSI_storage)
+##	<scan>_sRGB.png		sRGB preview image
+##	<scan>_lum.tif		luminance (cd.m-2), 32-bit float
+##	<scan>_<receptor>.tif	cone-catch images for any receptors requested
+##
+## Files are spread across CPU cores with a process pool. Example:
+##
+##	python HOSI_batch.py "Sample scans" -o reprocessed -r bluetit_lw,honeybee_uv
+##
+
+
+import argparse, os, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import HOSI_core as core
+import HOSI_storage as storage
+
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def findScans(inDir):
+	# raw scan csv files (skips spectrum exports written by the GUI)
+	paths = []
+	for name in sorted(os.listdir(inDir)):
+		if name.lower().endswith(".csv") and not name.endswith("_radiance.csv") and not name.endswith("_reflectance.csv"):
+			paths.append(os.path.join(inDir, name))
+	return paths
+
+def receptorCurves(selected, unitNumber, wavCoef, sensPath):
+	# (name, sensitivity at each photosite) for the requested receptors ("all" for every receptor)
+	sens = core.sensitivityStore(sensPath)
+	full, boxed = sens.resampled(unitNumber, wavCoef)
+	out = []
+	for name in sens.receptorNames:
+		if "all" in selected or name in selected:
+			out.append((name, full[name]))
+	return out
+
+def processFile(path, outDir, receptors, calPath, sensPath, backlash=0, backlashRange=core.backlashSearch):
+	# reprocess one scan; runs in a worker process
+	t0 = time.time()
+	lines = core.readRawLines(path)
+	scan = core.replayScan(lines, calPath=calPath, sensPath=sensPath, backlash=backlash, maxShift=backlashRange)
+	if scan is None:
+		raise ValueError("no scan header found")
+	engine = core.makeEngine(scan.unitNumber, scan.boxcarN, calPath, sensPath)
+	if engine is None:
+		raise ValueError("no calibration for unit " + str(scan.unitNumber))
+	curves = receptorCurves(receptors, scan.unitNumber, core.loadCalibration(scan.unitNumber, calPath)[0], sensPath) if len(receptors) > 0 else []
+	basePath = os.path.join(outDir, os.path.splitext(os.path.basename(path))[0])
+	saved = core.saveOutputs(scan, basePath, curves, engine.wavelengthBins, lines)
+	saved.append(storage.saveScanBinary(basePath + ".npz", scan.raw, scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar, storage.scanImages(scan), scan.provenance))
+	ts = "%dx%d in %.2fs" % (scan.panDim, scan.tiltDim, time.time()-t0)
+	if scan.backlash is None:
+		ts += ", warning: couldn't measure the backlash within %d pixels, right-to-left rows not shifted (try --backlash-range)" % backlashRange
+	elif scan.backlash != 0:
+		ts += ", right-to-left rows shifted %.1f pan steps" % scan.backlash
+	return path, saved, ts
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Reprocess a directory of raw HOSI scans without the GUI")
+	parser.add_argument("inDir", help="directory of scan .csv files")
+	parser.add_argument("-o", "--out", default=None, help="output directory (default: <inDir>/reprocessed)")
+	parser.add_argument("-r", "--receptors", default="", help="comma-separated receptor names from sensitivity_data.csv, e.g. bluetit_lw,honeybee_uv, or 'all'")
+	parser.add_argument("-c", "--calibration", default=os.path.join(scriptDir, "calibration_data.txt"))
+	parser.add_argument("-s", "--sensitivity", default=os.path.join(scriptDir, "sensitivity_data.csv"))
+	parser.add_argument("-b", "--backlash", default="0", help="pan steps the right-to-left rows of serpentine scans point right of their reported position, or 'auto' to measure it")
+	parser.add_argument("--backlash-range", type=int, default=core.backlashSearch, help="pixels either way -b auto searches for the offset of the right-to-left rows (default: %(default)s)")
+	parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default: all cores)")
+	args = parser.parse_args(argv)
+
+	outDir = args.out if args.out is not None else os.path.join(args.inDir, "reprocessed")
+	if os.path.realpath(outDir) == os.path.realpath(args.inDir): # the new scan .csv files would replace the originals
+		parser.error("the output directory can't be the input directory")
+	os.makedirs(outDir, exist_ok=True)
+	receptors = [r for r in args.receptors.split(",") if r != ""]
+	if len(receptors) > 0 and "all" not in receptors: # a typo would otherwise give no images and no error
+		unknown = [r for r in receptors if r not in core.sensitivityStore(args.sensitivity).receptorNames]
+		if len(unknown) > 0:
+			parser.error("receptor(s) not in " + args.sensitivity + ": " + ", ".join(unknown))
+	backlash = args.backlash if args.backlash == "auto" else float(args.backlash)
+	paths = findScans(args.inDir)
+	if len(paths) == 0:
+		print("No scans found in " + args.inDir)
+		return 1
+
+	print("Reprocessing " + str(len(paths)) + " scans to " + outDir)
+	t0 = time.time()
+	errors = 0
+	with ProcessPoolExecutor(max_workers=args.workers) as pool:
+		jobs = {pool.submit(processFile, p, outDir, receptors, args.calibration, args.sensitivity, backlash, args.backlash_range): p for p in paths}
+		for job in as_completed(jobs):
+			try:
+				path, saved, ts = job.result()
+				print(os.path.basename(path) + ": " + ts)
+			except Exception as e:
+				errors += 1
+				print("Error in " + os.path.basename(jobs[job]) + ": " + str(e))
+	print("Done in %.2fs" % (time.time()-t0))
+	return 1 if errors > 0 else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
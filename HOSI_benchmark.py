@@ -0,0 +1,254 @@
+##
+##_________________________HOSI benchmarks_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Times each processing stage on the scans in "Sample scans" plus synthetic larger
+## scans built from them, with no HOSI or display needed. For each stage it reports
+## the best time of a few runs, throughput (spectra/s and MB/s where that makes sense)
+## and the peak memory allocated during the stage. Stages:
+##
+##	read		read the raw lines of a scan csv (core.readRawLines)
+##	parse		raw lines to arrays (core.parseRaw)
+##	calibrate	batched calibration of every light spectrum (Scan.addSpectra)
+##	live		the per-spectrum path used during a scan (dark lookup, calibrate, previews)
+##	render		full preview render in every mode, then an incremental update
+##	leWrite		the le values table written at the end of a scan (core.formatLeBlock)
+##	leLoad		loading a saved scan from its le values table (core.loadScan)
+##	export		cone-catch images for every receptor (core.coneCatches)
+##	npzSave		binary container (storage.saveScanBinary)
+##	npzLoad		memory-mapped container back to a Scan, plus single spectrum reads
+##
+## Results can be saved as json and compared against a previous run:
+##
+##	python HOSI_benchmark.py -o baseline.json
+##	python HOSI_benchmark.py --compare baseline.json
+##
+## Synthetic scans are given as pan x tilt steps, e.g. --synthetic 360x90,720x180
+##
+
+
+import argparse, json, os, platform, sys, tempfile, time, tracemalloc
+import numpy as np
+import HOSI_core as core
+import HOSI_storage as storage
+import HOSI_preview
+
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+liveLimit = 5000 # max spectra timed on the (slow, one at a time) live path
+
+
+def synthesise(lines, panDim, tiltDim, path, ladderEvery=2000):
+	# raw scan of panDim x tiltDim spectra built from the spectra of a real scan, with
+	# dark ladders at the start, every ladderEvery spectra and at the end
+	header, meta, counts, pos = core.parseRaw(lines)
+	darkRows = []
+	for i in np.flatnonzero(meta[:, 2] == 0):
+		if len(darkRows) > 0 and meta[i, 3] < meta[darkRows[-1], 3]:
+			break # first ladder only
+		darkRows.append(i)
+	lightRows = np.flatnonzero(meta[:, 2] == 1)
+	def row(p, t, mType, i):
+		return str(p) + "," + str(t) + "," + str(mType) + "," + str(meta[i, 3]) + "," + str(meta[i, 4]) + "," + ",".join([str(int(c)) for c in counts[i]]) + "\n"
+	ladder = "".join([row(0, 0, 0, i) for i in darkRows])
+	with open(path, 'w') as f:
+		f.write("h," + header[1] + ",0," + str(panDim-1) + ",1,0," + str(tiltDim-1) + ",1," + header[8] + "," + header[9] + "," + header[10].strip() + "\n")
+		f.write(ladder)
+		n = 0
+		for t in range(tiltDim):
+			for p in range(panDim):
+				f.write(row(p, t, 1, lightRows[n % len(lightRows)]))
+				n += 1
+				if n % ladderEvery == 0:
+					f.write(ladder)
+		f.write(ladder)
+		f.write("x\n")
+	return path
+
+def measure(func, repeat):
+	# one run under tracemalloc for the peak memory (which also warms up any caches), then best time of repeat runs
+	tracemalloc.start()
+	func()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	best = None
+	for r in range(max(1, repeat)):
+		t0 = time.perf_counter()
+		out = func()
+		t = time.perf_counter() - t0
+		best = t if best is None else min(best, t)
+	return best, peak, out
+
+def runScan(path, repeat, calPath, sensPath, workDir):
+	results = {}
+	mb = os.path.getsize(path) / 1E6
+	def record(name, func, spectra=None, size=None):
+		t, peak, out = measure(func, repeat)
+		r = {"seconds": t, "peakMB": peak / 1E6}
+		if spectra is not None:
+			r["spectraPerS"] = spectra / t if t > 0 else None
+		if size is not None:
+			r["MBPerS"] = size / t if t > 0 else None
+		results[name] = r
+		return out
+
+	lines = record("read", lambda: core.readRawLines(path), size=mb)
+	raw = record("parse", lambda: core.parseRaw(lines), size=mb)
+	header, meta, counts, pos = raw
+	if header is None:
+		return None
+	nLight = int(np.sum(meta[:, 2] == 1))
+	engine = core.makeEngine(int(header[1]), int(header[9]), calPath, sensPath)
+	darks = core.DarkStore()
+	for i in np.flatnonzero(meta[:, 2] == 0):
+		darks.add(meta[i, 3], counts[i], pos[i])
+
+	def calibrate():
+		scan = core.Scan(header)
+		scan.wavelengthBoxcar = engine.wavelengthBoxcar
+		scan.addSpectra(engine, darks, meta, counts, pos)
+		return scan
+	scan = record("calibrate", calibrate, spectra=nLight)
+	scan.hspec = np.nan_to_num(scan.hspec)
+
+	light = np.flatnonzero(meta[:, 2] == 1)[:liveLimit]
+	renderer = HOSI_preview.PreviewRenderer()
+	def live():
+		for i in light:
+			dark = darks.dark(meta[i, 3], pos[i])
+			if dark is None:
+				continue
+			le, channels = engine.calibrate(counts[i], dark, meta[i, 3])
+			vals = core.deriveImages(channels)
+			renderer.touch(0, 0)
+	record("live", live, spectra=len(light))
+
+	images = {"R":scan.imR, "G":scan.imG, "B":scan.imB, "satR":scan.imSatR, "satB":scan.imSatB, "I":scan.imI, "GG":scan.imGG, "U":scan.imU, "chlA":scan.imChlA, "chlB":scan.imChlB}
+	pixelsN = scan.panDim * scan.tiltDim
+	def render():
+		renderer.reset()
+		for mode in (1, 2, 3, 4):
+			renderer.render(mode, images, scan.maxRGB, scan.maxIGU, (1.0,)*6, 1.0)
+		for k in range(100): # then as during a scan: a few new pixels per frame
+			renderer.touch(k % scan.tiltDim, k % scan.panDim)
+		renderer.render(1, images, scan.maxRGB, scan.maxIGU, (1.0,)*6, 1.0)
+	record("render", render, spectra=pixelsN*4)
+
+	block = record("leWrite", lambda: core.formatLeBlock(scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar))
+	results["leWrite"]["MBPerS"] = len(block) / 1E6 / results["leWrite"]["seconds"]
+	savedPath = os.path.join(workDir, "saved.csv")
+	with open(savedPath, 'w') as f:
+		f.write("".join(lines))
+		f.write(block)
+	record("leLoad", lambda: core.loadScan(savedPath, calPath=calPath, sensPath=sensPath), spectra=pixelsN, size=os.path.getsize(savedPath)/1E6)
+
+	sens = core.sensitivityStore(sensPath)
+	full, boxed = sens.resampled(scan.unitNumber, core.calibrationRegistry(calPath).unit(scan.unitNumber).wavCoef)
+	recepts = [full[name] for name in sens.receptorNames]
+	def export():
+		w = core.coneCatchWeights(recepts, engine.wavelengthBins, scan.wavelengthBoxcar, scan.boxcarN)
+		return core.coneCatches(scan.hspec, w)
+	record("export", export, spectra=pixelsN*len(recepts))
+
+	npzPath = os.path.join(workDir, "saved.npz")
+	record("npzSave", lambda: storage.saveScanBinary(npzPath, raw, scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar, storage.scanImages(scan)))
+	results["npzSave"]["MBPerS"] = os.path.getsize(npzPath) / 1E6 / results["npzSave"]["seconds"]
+	def npzLoad():
+		s = storage.ScanArchive(npzPath).toScan()
+		for k in range(100):
+			np.array(s.hspec[k % s.tiltDim, k % s.panDim])
+		return s
+	record("npzLoad", npzLoad, size=os.path.getsize(npzPath)/1E6)
+
+	results["info"] = {"spectra": nLight, "panDim": scan.panDim, "tiltDim": scan.tiltDim, "boxcar": scan.boxcarN, "fileMB": mb}
+	return results
+
+def printResults(name, results):
+	info = results["info"]
+	print("\n" + name + ": %dx%d, boxcar %d, %d spectra, %.1f MB" % (info["panDim"], info["tiltDim"], info["boxcar"], info["spectra"], info["fileMB"]))
+	print("  %-10s %10s %14s %10s %10s" % ("stage", "ms", "spectra/s", "MB/s", "peak MB"))
+	for stage, r in results.items():
+		if stage == "info":
+			continue
+		sps = "%.0f" % r["spectraPerS"] if r.get("spectraPerS") else "-"
+		mbs = "%.1f" % r["MBPerS"] if r.get("MBPerS") else "-"
+		print("  %-10s %10.2f %14s %10s %10.1f" % (stage, r["seconds"]*1000, sps, mbs, r["peakMB"]))
+
+def compare(current, baseline, tolerance, minMs):
+	# returns the number of stages slower than tolerance x the baseline (and by more than minMs, as tiny stages are noisy)
+	slower = 0
+	print("\nCompared with baseline (time ratio, >1 is slower):")
+	for name, results in current.items():
+		if name not in baseline:
+			continue
+		for stage, r in results.items():
+			if stage == "info" or stage not in baseline[name]:
+				continue
+			ratio = r["seconds"] / baseline[name][stage]["seconds"] if baseline[name][stage]["seconds"] > 0 else 1.0
+			flag = ""
+			if ratio > tolerance and (r["seconds"] - baseline[name][stage]["seconds"])*1000 > minMs:
+				flag = "  SLOWER"
+				slower += 1
+			print("  %-28s %-10s %6.2f%s" % (name, stage, ratio, flag))
+	return slower
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark HOSI processing stages on the sample scans (no HOSI or display needed)")
+	parser.add_argument("-d", "--scans", default=os.path.join(scriptDir, "Sample scans"), help="directory of raw scan .csv files")
+	parser.add_argument("--synthetic", default="360x90", help="comma-separated panxtilt sizes of synthetic scans built from the largest sample, '' for none")
+	parser.add_argument("-n", "--repeat", type=int, default=3, help="runs per stage (best time is reported)")
+	parser.add_argument("-o", "--out", default=None, help="save results as json")
+	parser.add_argument("--compare", default=None, help="json from a previous run to compare against")
+	parser.add_argument("--tolerance", type=float, default=1.25, help="time ratio above which a stage counts as a regression")
+	parser.add_argument("--min-ms", type=float, default=2.0, help="ignore slowdowns smaller than this (ms)")
+	parser.add_argument("-c", "--calibration", default=os.path.join(scriptDir, "calibration_data.txt"))
+	parser.add_argument("-s", "--sensitivity", default=os.path.join(scriptDir, "sensitivity_data.csv"))
+	args = parser.parse_args(argv)
+
+	paths = [os.path.join(args.scans, n) for n in sorted(os.listdir(args.scans)) if n.lower().endswith(".csv")]
+	allResults = {}
+	with tempfile.TemporaryDirectory() as workDir:
+		for path in paths:
+			results = runScan(path, args.repeat, args.calibration, args.sensitivity, workDir)
+			if results is None:
+				print("Skipping " + path + " (no scan header)")
+				continue
+			name = os.path.splitext(os.path.basename(path))[0]
+			allResults[name] = results
+			printResults(name, results)
+
+		sizes = [s for s in args.synthetic.split(",") if s.strip() != ""]
+		if len(sizes) > 0 and len(paths) > 0:
+			source = max(paths, key=os.path.getsize)
+			lines = core.readRawLines(source)
+			for size in sizes:
+				panDim, tiltDim = [int(v) for v in size.lower().split("x")]
+				name = "synthetic_" + str(panDim) + "x" + str(tiltDim)
+				path = synthesise(lines, panDim, tiltDim, os.path.join(workDir, name + ".csv"))
+				results = runScan(path, args.repeat, args.calibration, args.sensitivity, workDir)
+				allResults[name] = results
+				printResults(name, results)
+
+	status = 0
+	if args.compare is not None:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		if compare(allResults, baseline.get("results", {}), args.tolerance, args.min_ms) > 0:
+			status = 1
+	if args.out is not None:
+		with open(args.out, 'w') as f:
+			json.dump({
+				"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+				"python": platform.python_version(),
+				"numpy": np.__version__,
+				"machine": platform.machine(),
+				"repeat": args.repeat,
+				"results": allResults,
+			}, f, indent=1)
+		print("\nSaved " + args.out)
+	return status
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,1081 @@
+##
+##_________________________HOSI core_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Calibration maths shared by the HOSI GUI and any scripts that need to turn raw
+## spectrometer counts into radiance. Nothing in here imports tkinter, so it can be
+## used headless (e.g. reprocessing scans on a server).
+##
+## The calibration engine works on whole arrays of spectra at a time. For each unit
+## and boxcar setting it precomputes one weight vector (for the Le values) and one
+## weight matrix (for the XYZ, chlorophyll, nIR and nUV channels), so calibrating
+## a spectrum is a dark subtraction, a linearisation and two array products.
+##
+
+
+import math, os, re
+import numpy as np
+
+
+pixels = int(288)
+baseInt = int(550) # specifies the minimum hardware integration time in microseconds.
+lumScale = 683 * 117.159574150716 # luminance: W/(sr*sqm*nm), scaling factor calculated by comaring JETI to HOSI
+
+## names and order of the channels summed from each spectrum
+channelNames = ("cieX", "cieY", "cieZ", "chlA", "chlB", "nIR", "nUV")
+
+
+def wavelengthsFromCoefs(wavCoef, sites=None):
+	# 5th order polynomial from the chip's wavelength coefficients
+	if sites is None:
+		sites = np.arange(pixels)
+	sites = np.asarray(sites, dtype=float)
+	return np.polyval(np.asarray(wavCoef, dtype=float)[::-1], sites)
+
+def wavelengthBinWidths(wavelength):
+	# width of each photosite in nm, last bin repeats the previous width
+	wavelength = np.asarray(wavelength, dtype=float)
+	bins = np.empty(len(wavelength))
+	bins[:-1] = np.diff(wavelength)
+	bins[-1] = bins[-2]
+	return bins
+
+def linearise(x, linCoefs):
+	# x' = sign(x) * exp(log|x| * a + b), zeros stay zero
+	x = np.asarray(x, dtype=float)
+	ax = np.abs(x)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		out = np.where(ax > 0, np.exp(np.log(np.where(ax > 0, ax, 1.0))*linCoefs[0] + linCoefs[1]), 0.0)
+	return np.sign(x) * out
+
+
+class CalibrationEngine:
+	## Vectorised replacement for the per-sample loop that used to live in processSpec.
+	## Build one per unit/boxcar; calibrate() then takes any number of spectra at once.
+
+	def __init__(self, wavCoef, radSens, linCoefs, boxcarN, curves):
+		self.boxcarN = int(boxcarN)
+		self.linCoefs = [float(linCoefs[0]), float(linCoefs[1])]
+		self.specLength = math.ceil(pixels/self.boxcarN)
+
+		radSens = np.asarray(radSens, dtype=float)
+		self.wavelength = wavelengthsFromCoefs(wavCoef)
+		self.wavelengthBins = wavelengthBinWidths(self.wavelength)
+		self.wavelengthBoxcar = self.wavelength[::self.boxcarN]
+
+		## photosites with no sensitivity are skipped (as before), so give them zero weight
+		invSens = np.zeros(pixels)
+		good = radSens > 0
+		invSens[good] = 1.0 / radSens[good]
+
+		## pad to a whole number of boxcar windows so each window is one row
+		padded = self.specLength * self.boxcarN
+		def boxed(v):
+			t = np.zeros(padded)
+			t[:pixels] = v
+			return t.reshape(self.specLength, self.boxcarN)
+
+		# Le: mean of the boxcar window, with the counts already divided by boxcarN
+		self.leWeights = boxed(invSens).sum(axis=1) / self.boxcarN
+
+		# channels: bin-width corrected sums, one column per channel
+		self.channelWeights = np.zeros([self.specLength, len(channelNames)])
+		for c, name in enumerate(channelNames):
+			curve = np.asarray(curves[name], dtype=float)
+			self.channelWeights[:, c] = boxed(invSens * self.wavelengthBins * curve).sum(axis=1)
+
+	def calibrate(self, counts, darks, intTimes):
+		# counts, darks: (n, specLength) raw counts; intTimes: (n,) firmware integration times
+		# returns le (n, specLength) and channels (n, len(channelNames))
+		counts = np.atleast_2d(np.asarray(counts, dtype=float))
+		darks = np.atleast_2d(np.asarray(darks, dtype=float))
+		intTimes = np.atleast_1d(np.asarray(intTimes, dtype=float)) + baseInt # compensation for minimum microsecond exposure
+
+		x = linearise((counts - darks) / self.boxcarN, self.linCoefs)
+		x /= intTimes[:, None]
+
+		le = x * self.leWeights
+		## Le values have always been stored one bin to the left (hspec[..., loc-1]),
+		## keep that so new scans stay comparable with existing files
+		le = np.roll(le, -1, axis=1)
+
+		channels = x @ self.channelWeights
+		return le, channels
+
+	def channelsFromLe(self, le):
+		# channel sums from stored Le values (e.g. the le table of a saved scan) without the raw counts
+		# exact for boxcar 1, otherwise assumes radiance is flat across each boxcar window
+		le = np.roll(np.atleast_2d(np.asarray(le, dtype=float)), 1, axis=-1) # undo the one bin offset
+		w = np.zeros(self.channelWeights.shape)
+		good = self.leWeights > 0
+		w[good] = self.channelWeights[good] / self.leWeights[good, None]
+		return le @ w
+
+	def leWavelengths(self):
+		# wavelength each stored Le value belongs to: the mean of its boxcar window, which is
+		# one bin to the right of where it's stored (see calibrate)
+		padded = np.full(self.specLength * self.boxcarN, np.nan)
+		padded[:pixels] = self.wavelength
+		return np.roll(np.nanmean(padded.reshape(self.specLength, self.boxcarN), axis=1), -1)
+
+
+def deriveImages(channels):
+	# per-spectrum preview values from the channel sums
+	# returns a dict of 1D arrays: lum, R, G, B, I, GG, U, chlA, chlB
+	channels = np.atleast_2d(channels)
+	cieX, cieY, cieZ, chlA, chlB, nIR, nUV = [channels[:, c] for c in range(len(channelNames))]
+	out = {}
+	out["lum"] = cieY * lumScale
+
+	# convert to sRGB * set white balance to match computer screen
+	out["R"] = 3.24*cieX -1.54*cieY - 0.50*cieZ
+	out["G"] = (-0.97*cieX + 1.88*cieY + 0.04*cieZ) * 1.44
+	out["B"] = (0.06*cieX -0.20*cieY + 1.06*cieZ) *  1.71
+
+	out["I"] = nIR
+	out["GG"] = cieY
+	out["U"] = nUV
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		out["chlA"] = chlA / (chlA + nIR)
+		out["chlB"] = chlB / (chlB + nIR)
+	return out
+
+
+class DarkStore:
+	## Dark ladders indexed by integration time. The firmware sends a ladder of dark
+	## measurements (type 0) at the start, every darkRep ms, and at the end of a scan.
+	## Every ladder is kept together with the scan position it was measured at, so a
+	## light spectrum can be corrected with darks interpolated between the ladder
+	## before and the ladder after it (long darkRep intervals drift less this way).
+	## Positions just need to increase through the scan (line number, time, etc).
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.ladders = [] # list of [position, {intTime: dark vector}]
+		self.lastTime = -1
+		self._series = {}
+
+	def add(self, intTime, counts, position):
+		intTime = int(intTime)
+		if(len(self.ladders) == 0 or intTime < self.lastTime): # start of a new ladder
+			self.ladders.append([float(position), {}])
+		self.ladders[-1][1][intTime] = np.asarray(counts, dtype=float)
+		self.lastTime = intTime
+		self._series.pop(intTime, None)
+
+	def times(self):
+		# integration times present in the most recent ladder
+		if len(self.ladders) == 0:
+			return []
+		return sorted(self.ladders[-1][1].keys())
+
+	def series(self, intTime):
+		# positions (m,) and dark vectors (m, n) of every ladder holding this integration time
+		intTime = int(intTime)
+		if intTime not in self._series:
+			pos = [p for p, d in self.ladders if intTime in d]
+			vals = [d[intTime] for p, d in self.ladders if intTime in d]
+			if len(pos) == 0:
+				self._series[intTime] = None
+			else:
+				self._series[intTime] = (np.asarray(pos), np.vstack(vals))
+		return self._series[intTime]
+
+	def darks(self, intTimes, positions):
+		# dark vectors for many light spectra at once, linearly interpolated by position
+		# between the surrounding ladders (nearest ladder outside that range)
+		# returns (n, len) darks and an (n,) mask of spectra that had a matching integration time
+		intTimes = np.atleast_1d(np.asarray(intTimes)).astype(np.int64)
+		positions = np.broadcast_to(np.asarray(positions, dtype=float), intTimes.shape)
+		out = None
+		found = np.zeros(len(intTimes), dtype=bool)
+		for t in np.unique(intTimes):
+			s = self.series(t)
+			if s is None:
+				continue
+			pos, vals = s
+			if out is None:
+				out = np.zeros([len(intTimes), vals.shape[1]])
+			sel = intTimes == t
+			p = positions[sel]
+			hi = np.searchsorted(pos, p, side='right') # first ladder measured after p
+			lo = hi - 1
+			loC = np.clip(lo, 0, len(pos)-1)
+			hiC = np.clip(hi, 0, len(pos)-1)
+			w = np.zeros(len(p))
+			mid = (lo >= 0) & (hi < len(pos))
+			w[mid] = (p[mid] - pos[loC[mid]]) / (pos[hiC[mid]] - pos[loC[mid]])
+			w[lo < 0] = 1.0
+			out[sel] = vals[loC]*(1-w)[:, None] + vals[hiC]*w[:, None]
+			found[sel] = True
+		return out, found
+
+	def dark(self, intTime, position):
+		# single spectrum version of darks(), returns None if there's no matching dark
+		d, found = self.darks([intTime], [position])
+		if not found[0]:
+			return None
+		return d[0]
+
+
+##______________________calibration & sensitivity files_____________________________
+
+def readLine(ta):
+	ta.pop(0)
+	ta.pop(0)
+	ta = list(filter(None, ta))
+	ta = [float(i) for i in ta]
+	return ta
+
+def parseCalibration(path="./calibration_data.txt"):
+	# every unit in the calibration file: {unitNumber: {"wavCoef": [...], "radSens": [...], "linCoefs": [...]}}
+	units = {}
+	for line in open(path):
+		row = line.split(',')
+		try:
+			unit = int(row[0])
+		except:
+			continue
+		vals = list(filter(None, row[2:]))
+		vals.pop(len(vals)-1)
+		units.setdefault(unit, {})[row[1]] = [float(i) for i in vals]
+	return units
+
+def loadCalibration(unitNumber, path="./calibration_data.txt"):
+	# returns wavCoef, radSens, linCoefs for one unit (empty lists if not found)
+	cal = calibrationRegistry(path).unit(unitNumber)
+	if cal is None:
+		return [], [], []
+	return cal.wavCoef.tolist(), cal.radSens.tolist(), cal.linCoefs.tolist()
+
+def fileStamp(path):
+	# changes whenever the file is edited (None if it's missing)
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_mtime_ns, st.st_size)
+
+def compiledPath(path):
+	# binary cache kept next to a text data file
+	return os.path.splitext(path)[0] + ".cache.npz"
+
+def readCompiled(path, stamp):
+	# arrays from the binary cache of a data file, or None if it's missing or out of date
+	try:
+		with np.load(compiledPath(path), allow_pickle=False) as f:
+			if tuple(int(i) for i in f["stamp"]) != tuple(stamp):
+				return None
+			return {k: f[k] for k in f.files}
+	except Exception:
+		return None
+
+def writeCompiled(path, stamp, arrays):
+	# best effort, e.g. the data files may be on a read-only share
+	try:
+		tmp = compiledPath(path) + ".tmp"
+		with open(tmp, 'wb') as f:
+			np.savez(f, stamp=np.array(stamp, dtype=np.int64), **arrays)
+		os.replace(tmp, compiledPath(path))
+	except OSError:
+		pass
+
+
+class UnitCalibration:
+	## Calibration of one HOSI unit plus the wavelength vectors derived from it.
+
+	def __init__(self, unitNumber, wavCoef, radSens, linCoefs):
+		self.unitNumber = int(unitNumber)
+		self.wavCoef = np.asarray(wavCoef, dtype=float)
+		self.radSens = np.asarray(radSens, dtype=float)
+		self.linCoefs = np.asarray(linCoefs, dtype=float)
+		self.wavelength = wavelengthsFromCoefs(self.wavCoef)
+		self.wavelengthBins = wavelengthBinWidths(self.wavelength)
+
+
+class CalibrationRegistry:
+	## Every unit in calibration_data.txt, parsed once into NumPy arrays. A compiled copy
+	## is saved next to the text file (calibration_data.cache.npz) and used until the
+	## text file's modification time or size changes. Only units with a complete set of
+	## wavCoef (6), radSens (288) and linCoefs (2) are kept.
+
+	def __init__(self, path="./calibration_data.txt"):
+		self.path = path
+		self.stamp = None
+		self.calibrations = {}
+		self.engines = {}
+
+	def load(self):
+		stamp = fileStamp(self.path)
+		if stamp is None:
+			raise FileNotFoundError(self.path)
+		if stamp == self.stamp:
+			return self
+		arrays = readCompiled(self.path, stamp)
+		if arrays is None:
+			units = []
+			wavCoef = []
+			radSens = []
+			linCoefs = []
+			for unit, rows in sorted(parseCalibration(self.path).items()):
+				if(len(rows.get("wavCoef", [])) == 6 and len(rows.get("radSens", [])) == pixels and len(rows.get("linCoefs", [])) == 2):
+					units.append(unit)
+					wavCoef.append(rows["wavCoef"])
+					radSens.append(rows["radSens"])
+					linCoefs.append(rows["linCoefs"])
+			arrays = {
+				"units": np.array(units, dtype=np.int64),
+				"wavCoef": np.array(wavCoef, dtype=float).reshape(-1, 6),
+				"radSens": np.array(radSens, dtype=float).reshape(-1, pixels),
+				"linCoefs": np.array(linCoefs, dtype=float).reshape(-1, 2),
+			}
+			writeCompiled(self.path, stamp, arrays)
+		self.calibrations = {}
+		for i, unit in enumerate(arrays["units"]):
+			self.calibrations[int(unit)] = UnitCalibration(unit, arrays["wavCoef"][i], arrays["radSens"][i], arrays["linCoefs"][i])
+		self.engines = {}
+		self.stamp = stamp
+		return self
+
+	def units(self):
+		return sorted(self.calibrations.keys())
+
+	def unit(self, unitNumber):
+		# UnitCalibration, or None if the unit isn't in the file
+		return self.calibrations.get(int(unitNumber))
+
+	def engine(self, unitNumber, boxcarN, sensPath="./sensitivity_data.csv"):
+		# CalibrationEngine for a unit & boxcar, cached until either data file changes
+		cal = self.unit(unitNumber)
+		if cal is None:
+			return None
+		sens = sensitivityStore(sensPath)
+		key = (cal.unitNumber, int(boxcarN), sens.path, sens.stamp)
+		if key not in self.engines:
+			full, boxed = sens.resampled(cal.unitNumber, cal.wavCoef)
+			self.engines[key] = CalibrationEngine(cal.wavCoef, cal.radSens, cal.linCoefs, boxcarN, full)
+		return self.engines[key]
+
+calibrationRegistries = {}
+
+def calibrationRegistry(path="./calibration_data.txt"):
+	# shared CalibrationRegistry for a file, reloaded if the file has changed
+	path = os.path.abspath(path)
+	if path not in calibrationRegistries:
+		calibrationRegistries[path] = CalibrationRegistry(path)
+	return calibrationRegistries[path].load()
+
+def readValues(fields):
+	# floats from csv fields, skipping empty ones (e.g. the end of the line)
+	# anything that isn't a number becomes 0 so the values stay aligned with cieWav
+	vals = []
+	for v in fields:
+		v = v.strip()
+		if v == "":
+			continue
+		try:
+			vals.append(float(v))
+		except ValueError:
+			vals.append(0.0)
+	return vals
+
+def loadSensitivities(path="./sensitivity_data.csv"):
+	# returns cieWav, a dict of the base curves (cieX, chlA, nIR...), receptorNames and receptorVals
+	cieWav = []
+	curves = {}
+	receptorNames = []
+	receptorVals = []
+	for line in open(path):
+		row = line.split(',')
+		if len(row) < 3:
+			continue
+		if(row[0] == "base"):
+			if(row[1] == "cieWav"):
+				cieWav = [int(i) for i in filter(None, [v.strip() for v in row[2:]])]
+			else:
+				name = row[1]
+				curves[name] = readValues(row[2:])
+		else:
+			receptorNames.append(row[0] +"_" + row[1])
+			receptorVals.append(readValues(row[2:]))
+	return cieWav, curves, receptorNames, receptorVals
+
+def resampleCurve(wavelength, cieWav, vals):
+	# sensitivity at each spectrometer wavelength, linearly interpolated (zero outside the data)
+	n = min(len(cieWav), len(vals))
+	if n == 0:
+		return np.zeros(len(wavelength))
+	return np.interp(np.asarray(wavelength, dtype=float), np.asarray(cieWav[:n], dtype=float), np.asarray(vals[:n], dtype=float), left=0.0, right=0.0)
+
+def packCurves(prefix, names, vals):
+	# ragged lists of values as one zero-padded array plus lengths (for the compiled cache)
+	lengths = np.array([len(v) for v in vals], dtype=np.int64)
+	packed = np.zeros([len(vals), lengths.max() if len(vals) > 0 else 0])
+	for i, v in enumerate(vals):
+		packed[i, :len(v)] = v
+	return {prefix + "Names": np.array(names, dtype=str), prefix + "Vals": packed, prefix + "Lengths": lengths}
+
+def unpackCurves(prefix, arrays):
+	names = [str(n) for n in arrays[prefix + "Names"]]
+	vals = [list(v[:n]) for v, n in zip(arrays[prefix + "Vals"], arrays[prefix + "Lengths"])]
+	return names, vals
+
+
+class SensitivityStore:
+	## Every curve in sensitivity_data.csv (base curves and receptors) resampled onto a
+	## unit's wavelengths, both per photosite and per boxcar bin. Results are cached by
+	## unit number, wavCoef and boxcar, and everything is reloaded if the file changes.
+	## Like CalibrationRegistry, the parsed file is kept in a compiled .cache.npz.
+
+	def __init__(self, path="./sensitivity_data.csv"):
+		self.path = path
+		self.stamp = None
+		self.cache = {}
+		self.cieWav = []
+		self.curves = {}
+		self.receptorNames = []
+		self.receptorVals = []
+
+	def load(self):
+		stamp = fileStamp(self.path)
+		if stamp is None:
+			raise FileNotFoundError(self.path)
+		if stamp == self.stamp:
+			return self
+		arrays = readCompiled(self.path, stamp)
+		if arrays is None:
+			cieWav, curves, receptorNames, receptorVals = loadSensitivities(self.path)
+			arrays = {"cieWav": np.array(cieWav, dtype=np.int64)}
+			arrays.update(packCurves("curve", list(curves.keys()), list(curves.values())))
+			arrays.update(packCurves("receptor", receptorNames, receptorVals))
+			writeCompiled(self.path, stamp, arrays)
+		self.cieWav = [int(w) for w in arrays["cieWav"]]
+		names, vals = unpackCurves("curve", arrays)
+		self.curves = dict(zip(names, vals))
+		self.receptorNames, self.receptorVals = unpackCurves("receptor", arrays)
+		self.stamp = stamp
+		self.cache = {}
+		return self
+
+	def resampled(self, unitNumber, wavCoef, boxcarN=1):
+		# (full, boxed): dicts of name -> sensitivity at each photosite / each boxcar bin
+		# names are the base curves (cieX, chlA...) and receptors (e.g. bluetit_lw)
+		self.load()
+		key = (int(unitNumber), tuple(float(c) for c in wavCoef), int(boxcarN))
+		if key not in self.cache:
+			wavelength = wavelengthsFromCoefs(wavCoef)
+			names = list(self.curves.keys()) + self.receptorNames
+			vals = list(self.curves.values()) + self.receptorVals
+			full = {}
+			boxed = {}
+			for name, v in zip(names, vals):
+				full[name] = resampleCurve(wavelength, self.cieWav, v)
+				boxed[name] = resampleCurve(wavelength[::int(boxcarN)], self.cieWav, v)
+			self.cache[key] = (full, boxed)
+		return self.cache[key]
+
+sensitivityStores = {}
+
+def sensitivityStore(path="./sensitivity_data.csv"):
+	# shared SensitivityStore for a file
+	path = os.path.abspath(path)
+	if path not in sensitivityStores:
+		sensitivityStores[path] = SensitivityStore(path)
+	return sensitivityStores[path].load()
+
+def makeEngine(unitNumber, boxcarN, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv"):
+	# calibration engine for a unit & boxcar (None if calibration data is missing), cached by the registry
+	return calibrationRegistry(calPath).engine(unitNumber, boxcarN, sensPath)
+
+
+##______________________firmware scan pattern & auto-exposure_____________________________
+
+## as in Arduino_HOSI: auto-exposure reads at minIntTime, then intStep, doubling until saturated
+minIntTime = 50
+intStep = 400
+readoutTime = 35000 # microseconds to clock out and read the photosites after each exposure
+## pan spacing is widened near the zenith: from these tilts the step is multiplied by these factors
+panoSteps = (913, 959, 988, 1005)
+panoSpaces = (2, 4, 8, 16)
+
+
+def rowPans(panLeft, panRight, panRes, tilt):
+	# pan positions the firmware measures along one row of a scan
+	panShift = 1
+	panStart = 0
+	for s, sp in zip(panoSteps, panoSpaces):
+		if tilt >= s:
+			panShift = sp
+			panStart = sp//2
+	return list(range(panLeft + panStart*panRes, panRight+1, panShift*panRes))
+
+def ladderTimes(intTime, maxIntTime, start=minIntTime, satN=0):
+	# integration times read by the auto-exposure to report intTime (and satN), starting at
+	# start: the firmware's minIntTime, or one step below an exposure hint
+	if start != minIntTime and intTime < start:
+		return [start] + ladderTimes(intTime, maxIntTime, minIntTime, satN) # brighter than the hint, full ladder
+	if satN > 0:
+		return [start] # the first read was already saturated
+	times = [start]
+	t = intStep if start == minIntTime else start*2
+	while t <= intTime:
+		times.append(t)
+		t *= 2
+	if t < maxIntTime:
+		times.append(t) # the read that saturated
+	return times
+
+
+def rowDirections(meta):
+	# direction of the row each spectrum belongs to: 1 left to right, -1 right to left
+	# (alternate rows of a serpentine scan), from the order of the light spectra in each run
+	# of them at one tilt in one pass, as a rescan or resume can cover a row again either way
+	meta = np.asarray(meta).reshape(-1, 5)
+	out = np.ones(len(meta), dtype=np.int64)
+	light = np.flatnonzero(meta[:, 2] == 1)
+	if len(light) == 0:
+		return out
+	tilts = meta[light, 1]
+	passes = scanPasses(meta)[light]
+	start = np.r_[True, (tilts[1:] != tilts[:-1]) | (passes[1:] != passes[:-1])]
+	first = light[start]
+	last = light[np.r_[start[1:], True]]
+	out[light] = np.where(meta[last, 0] < meta[first, 0], -1, 1)[np.cumsum(start)-1]
+	return out
+
+def reversedRows(meta, tiltStart, tiltRes, tiltDim):
+	# (tiltDim,) bool, True for the rows of a scan that ran right to left (in the last run
+	# over each, whose spectra are the ones left in the cube)
+	meta = np.asarray(meta).reshape(-1, 5)
+	light = meta[:, 2] == 1
+	rev = np.zeros(tiltDim, dtype=bool)
+	tilt = np.trunc((meta[light, 1] - tiltStart) / tiltRes).astype(np.int64)
+	ok = (tilt >= 0) & (tilt < tiltDim)
+	rev[tilt[ok]] = rowDirections(meta)[light][ok] == -1
+	return rev
+
+backlashSearch = 6 # pixels either way estimateBacklash looks for the offset of the right-to-left rows
+
+def estimateBacklash(hspec, reversedRows, panRes, maxShift=backlashSearch):
+	# how many pan steps right of their reported position the right-to-left rows point: the
+	# shift (up to maxShift pixels) that best lines them up with the left-to-right rows either
+	# side, over all rows at once (None if there's nothing to compare or no clear minimum).
+	# reversedRows: (tilt,) bool
+	prof = np.nan_to_num(np.asarray(hspec, dtype=float)).sum(axis=-1)
+	errs = np.zeros(2*maxShift+1)
+	n = 0
+	for i in np.flatnonzero(reversedRows):
+		if i == 0 or i+1 >= len(prof) or reversedRows[i-1] or reversedRows[i+1] or not (prof[i-1:i+2] > 0).all():
+			continue # needs fully measured left-to-right rows either side (not the sparse rows near the zenith)
+		p = np.log(prof[i-1:i+2])
+		ref = (p[0] + p[2]) / 2
+		row = p[1]
+		for j, k in enumerate(range(-maxShift, maxShift+1)):
+			# row at x against ref at x+k, brightness differences between the rows removed
+			a = row[max(0, -k):len(row)-max(0, k)]
+			b = ref[max(0, k):len(ref)-max(0, -k)]
+			errs[j] += np.mean(((a - a.mean()) - (b - b.mean()))**2)
+		n += 1
+	if n == 0:
+		return None
+	k = int(np.argmin(errs))
+	if k == 0 or k == len(errs)-1:
+		return None # no clear minimum within the search
+	d = errs[k-1] - 2*errs[k] + errs[k+1]
+	frac = 0.5*(errs[k-1] - errs[k+1])/d if d > 0 else 0.0 # parabola through the three
+	return float((k - maxShift + frac) * panRes)
+
+
+class ExposureHints:
+	## Host side of the firmware's exposure hints. When a row of a scan is complete, next()
+	## gives the hint for the row after it ("e" + the shortest integration time in the row,
+	## tagged with the tilt of that row so the firmware can tell a late one), which the
+	## firmware uses to start its auto-exposure one step below (rather than at minIntTime),
+	## acknowledging with "e: <hint>". Keeps count of the ladder steps and
+	## exposure time saved against the full ladder.
+
+	def __init__(self, header):
+		# header: fields of the 'h' line
+		self.panLeft, self.panRight, self.panRes = int(header[2]), int(header[3]), int(header[4])
+		self.tiltTop, self.tiltRes = int(header[6]), int(header[7])
+		self.maxIntTime = int(header[8])
+		self.hint = 0 # acknowledged hint for the row in progress
+		self.rowTilt = None
+		self.rowTimes = []
+		self.stepsSaved = 0
+		self.timeSaved = 0 # microseconds, including the readouts
+		self.rows = 0 # rows measured with a hint
+		self.misses = 0 # spectra brighter than their hint, which had to run the full ladder
+
+	def acknowledge(self, line):
+		# "e: <hint>" from the firmware
+		try:
+			self.hint = int(line.split(':')[1])
+			self.rows += 1
+		except (IndexError, ValueError):
+			self.hint = 0
+
+	def add(self, meta):
+		# a light spectrum [pan, tilt, type, intTime, satN]; returns the hint command to send
+		# once its row is complete, otherwise None
+		pan, tilt, intTime, satN = int(meta[0]), int(meta[1]), int(meta[3]), int(meta[4])
+		if tilt != self.rowTilt:
+			self.rowTilt = tilt
+			self.rowTimes = []
+		self.rowTimes.append(intTime)
+		start = self.hint//2
+		if start >= intStep and start < self.maxIntTime:
+			full = ladderTimes(intTime, self.maxIntTime, minIntTime, satN)
+			used = ladderTimes(intTime, self.maxIntTime, start, satN)
+			self.stepsSaved += len(full) - len(used)
+			self.timeSaved += sum(full) - sum(used) + (len(full) - len(used))*readoutTime
+			if intTime < start:
+				self.misses += 1
+		if len(self.rowTimes) < len(rowPans(self.panLeft, self.panRight, self.panRes, tilt)):
+			return None # rows may run either way (serpentine scans), so count them
+		hint = min(self.rowTimes)
+		self.rowTimes = []
+		self.hint = 0 # until the firmware acknowledges the next one
+		if tilt + self.tiltRes > self.tiltTop:
+			return None # last row: a hint now would arrive after the scan, in front of the next command
+		return "e" + str(hint) + "," + str(tilt + self.tiltRes) + "\n"
+
+
+##______________________raw scan data_____________________________
+
+def readRawLines(path):
+	# raw serial transcript of a saved scan, i.e. everything up to the 'x' terminator
+	lines = []
+	for line in open(path):
+		lines.append(line)
+		if line.startswith('x'):
+			break
+	return lines
+
+def parseMeta(output):
+	# [pan, tilt, type, intTime, satN] from the first five fields of a spectrum line
+	# (None if it isn't a usable dark, light or start measurement)
+	try:
+		mType = int(output[2])
+		intTime = int(output[3])
+	except:
+		return None
+	if(mType != 0 and mType != 1 and mType != 2):
+		return None
+	try:
+		pan = int(output[0])
+		tilt = int(output[1])
+		satN = int(output[4])
+	except:
+		if mType == 1:
+			return None # can't place a light measurement without coordinates
+		pan = tilt = satN = 0
+	return [pan, tilt, mType, intTime, satN]
+
+def parseLine(line):
+	# one spectrum line -> (meta, counts), or None for anything else (header, replies, 'x')
+	output = line.strip().split(',')
+	if len(output) < 6 or output[0] == 'h':
+		return None
+	m = parseMeta(output)
+	if m is None:
+		return None
+	try:
+		counts = np.asarray(output[5:], dtype=float)
+	except ValueError:
+		return None # garbled line
+	return np.asarray(m, dtype=np.int64), counts
+
+def parseRaw(lines):
+	# group raw lines by type in one pass
+	# returns the header fields ('h' line) and arrays for the spectrum lines in order:
+	# meta (n,5) int [pan, tilt, type, intTime, satN], counts (n, specLength), pos (n,) position in scan
+	# The first header sets the grid. Any later ones start rescans of part of it (region rescans,
+	# adaptive scans), whose lines follow on (see scanPasses)
+	header = None
+	metas = []
+	counts = []
+	specLength = 0
+	for line in lines:
+		if line.startswith('x'):
+			break
+		output = line.strip().split(',')
+		if(output[0] == 'h'):
+			if header is not None:
+				continue # a rescan of part of the grid
+			header = output
+			specLength = math.ceil(pixels/int(output[9]))
+			continue
+		if header is None or len(output) != specLength+5:
+			continue
+		m = parseMeta(output)
+		if m is None:
+			continue
+		metas.append(m)
+		counts.append(output[5:])
+	meta = np.array(metas, dtype=np.int64).reshape(-1, 5)
+	counts = np.array(counts, dtype=float).reshape(len(metas), specLength) # (0, 0) with no header
+	pos = np.arange(1, len(meta)+1, dtype=float)
+	return header, meta, counts, pos
+
+
+filledPass = -2 # provenance of a pixel that wasn't measured but copied from the nearest one that was
+
+def scanPasses(meta):
+	# pass each spectrum belongs to: 0 for the scan itself, then 1, 2... for each rescan that
+	# follows it in the transcript (every h command starts with a type 2 start measurement)
+	meta = np.asarray(meta).reshape(-1, 5)
+	return np.maximum(np.cumsum(meta[:, 2] == 2) - 1, 0)
+
+def resumeCommand(lines):
+	# where to pick up a scan that was cut off (no 'x'): the h command of the pass in progress
+	# (the last in the transcript) from its first row that isn't complete. Its lines follow on
+	# in the same file as another pass. Returns (command, rows done, rows in the pass), or
+	# None if there's no header, the scan finished or every row was measured
+	header = None
+	done = {}
+	for line in lines:
+		if line.startswith('x'):
+			return None
+		output = line.strip().split(',')
+		if(output[0] == 'h' and len(output) >= 11):
+			header = output
+			done = {}
+			continue
+		if header is None:
+			continue
+		m = parseMeta(output)
+		if m is not None and m[2] == 1:
+			done.setdefault(m[1], set()).add(m[0])
+	if header is None:
+		return None
+	vals = [int(float(v)) for v in header[2:11]]
+	panLeft, panRight, panRes, tiltStart, tiltStop, tiltRes = vals[:6]
+	tilts = list(range(tiltStart, tiltStop+1, tiltRes))
+	for i, tilt in enumerate(tilts):
+		if len(done.get(tilt, ())) < len(rowPans(panLeft, panRight, panRes, tilt)):
+			vals[3] = tilt
+			return "h" + "".join(str(v) + "," for v in vals), i, len(tilts)
+	return None
+
+
+class Scan:
+	## Calibrated hyperspectral cube plus the preview images, built from an 'h' header.
+	## Attribute names follow the GUI globals.
+
+	def __init__(self, header, allocate=True):
+		self.header = header
+		self.unitNumber = int(header[1])
+		self.panStart = int(header[2])
+		self.panStop = int(header[3])
+		self.pan_Res = int(header[4])
+		self.tiltStart = int(header[5])
+		self.tiltStop = int(header[6])
+		self.tilt_Res = int(header[7])
+		self.maxInt = int(header[8])
+		self.boxcarN = int(header[9])
+		self.darkRep = int(header[10]) if len(header) > 10 and header[10].strip() != "" else 0
+		self.specLength = math.ceil(pixels/self.boxcarN)
+		self.panDim = int(1+(self.panStop-self.panStart)/self.pan_Res)
+		self.tiltDim = int(1+(self.tiltStop-self.tiltStart)/self.tilt_Res)
+		self.wavelengthBoxcar = []
+		self.maxRGB = 1E-10
+		self.maxIGU = 1E-10
+		if allocate:
+			self.allocate()
+
+	def allocate(self):
+		dims = [self.tiltDim, self.panDim]
+		self.imLum = np.zeros(dims)
+		self.imR = np.zeros(dims)
+		self.imG = np.zeros(dims)
+		self.imB = np.zeros(dims)
+		self.imSatR = np.zeros(dims)
+		self.imSatB = np.zeros(dims)
+		self.imI = np.zeros(dims)
+		self.imGG = np.zeros(dims)
+		self.imU = np.zeros(dims)
+		self.imChlA = np.zeros(dims)
+		self.imChlB = np.zeros(dims)
+		self.hspec = np.zeros([self.tiltDim, self.panDim, self.specLength])
+		self.hspecPan = np.zeros([self.panDim])
+		self.hspecTilt = np.zeros([self.tiltDim])
+		self.provenance = np.full(dims, -1, dtype=np.int16) # pass each spectrum of hspec is from (see scanPasses), -1 if none
+
+	def addSpectra(self, engine, darks, meta, counts, pos, backlash=0):
+		# calibrate and place many light spectra at once; darks is a DarkStore
+		# backlash: pan steps right of their reported position that right-to-left rows point
+		# (serpentine scans), they are placed at the nearest pixel to that
+		directions = rowDirections(meta) if backlash != 0 else None
+		passes = scanPasses(meta)
+		light = meta[:, 2] == 1
+		meta = meta[light]
+		counts = counts[light]
+		pos = pos[light]
+		passes = passes[light]
+		if len(meta) == 0:
+			return 0
+
+		if directions is None:
+			pan = np.trunc((meta[:, 0] - self.panStart) / self.pan_Res).astype(np.int64)
+		else:
+			pans = meta[:, 0] + np.where(directions[light] == -1, backlash, 0)
+			pan = np.rint((pans - self.panStart) / self.pan_Res).astype(np.int64)
+		tilt = np.trunc((meta[:, 1] - self.tiltStart) / self.tilt_Res).astype(np.int64)
+		dark, found = darks.darks(meta[:, 3], pos)
+		keep = found & (pan >= 0) & (pan < self.panDim) & (tilt >= 0) & (tilt < self.tiltDim)
+		if not keep.any():
+			return 0
+		# a pixel measured more than once (e.g. a rescanned region) keeps its latest spectrum
+		idx = np.flatnonzero(keep)
+		cell = tilt[idx]*self.panDim + pan[idx]
+		latest = len(cell)-1 - np.unique(cell[::-1], return_index=True)[1]
+		keep[:] = False
+		keep[idx[latest]] = True
+		pan = pan[keep]
+		tilt = tilt[keep]
+		meta = meta[keep]
+		passes = passes[keep]
+
+		le, channels = engine.calibrate(counts[keep], dark[keep], meta[:, 3])
+		vals = deriveImages(channels)
+
+		self.hspecPan[pan] = meta[:, 0] if directions is None else self.panStart + pan*self.pan_Res
+		self.hspecTilt[tilt] = meta[:, 1]
+		self.hspec[tilt, pan] = le # this is watts per nanometer (i.e. not controlled for AUC)
+		self.provenance[tilt, pan] = passes
+
+		row = self.tiltDim-1-tilt # images are flipped vertically
+		self.imLum[row, pan] = vals["lum"]
+		self.imR[row, pan] = vals["R"]
+		self.imG[row, pan] = vals["G"]
+		self.imB[row, pan] = vals["B"]
+		self.maxRGB = max(self.maxRGB, np.max(vals["R"]), np.max(vals["G"]), np.max(vals["B"]))
+
+		sat = meta[:, 4] > 0
+		self.imSatR[row[sat], pan[sat]] = 255
+		self.imSatB[row, pan] = meta[:, 4]
+
+		self.imI[row, pan] = vals["I"]
+		self.imGG[row, pan] = vals["GG"]
+		self.imU[row, pan] = vals["U"]
+		self.maxIGU = max(self.maxIGU, np.max(vals["I"]), np.max(vals["GG"]), np.max(vals["U"]))
+
+		self.imChlA[row, pan] = vals["chlA"]
+		self.imChlB[row, pan] = vals["chlB"]
+		return int(keep.sum())
+
+	def imagesFromLe(self, engine):
+		# preview images from the le values in hspec alone (e.g. a saved le table or a mosaic)
+		measured = np.any(self.hspec != 0, axis=2)
+		tiltI, panI = np.nonzero(measured)
+		vals = deriveImages(engine.channelsFromLe(self.hspec[tiltI, panI]))
+		row = self.tiltDim-1-tiltI # images are flipped vertically
+		self.imLum[row, panI] = vals["lum"]
+		self.imR[row, panI] = vals["R"]
+		self.imG[row, panI] = vals["G"]
+		self.imB[row, panI] = vals["B"]
+		self.imI[row, panI] = vals["I"]
+		self.imGG[row, panI] = vals["GG"]
+		self.imU[row, panI] = vals["U"]
+		self.imChlA[row, panI] = vals["chlA"]
+		self.imChlB[row, panI] = vals["chlB"]
+		if len(tiltI) > 0:
+			self.maxRGB = max(self.maxRGB, np.max(vals["R"]), np.max(vals["G"]), np.max(vals["B"]))
+			self.maxIGU = max(self.maxIGU, np.max(vals["I"]), np.max(vals["GG"]), np.max(vals["U"]))
+
+	def isSerpentine(self):
+		# some rows of the raw data ran right to left
+		if getattr(self, "raw", None) is None:
+			return False
+		return bool(reversedRows(self.raw[1], self.tiltStart, self.tilt_Res, self.tiltDim).any())
+
+	def measureBacklash(self, maxShift=backlashSearch):
+		# residual backlash of a serpentine scan's right-to-left rows (see estimateBacklash), None if
+		# not serpentine or it couldn't be measured
+		if getattr(self, "raw", None) is None:
+			return None
+		rev = reversedRows(self.raw[1], self.tiltStart, self.tilt_Res, self.tiltDim)
+		if not rev.any():
+			return None
+		return estimateBacklash(self.hspec, rev, self.pan_Res, maxShift)
+
+
+def readLeBlock(path):
+	# raw lines and the calibrated "le values" table of a saved scan csv
+	# returns (rawLines, pan (n,), tilt (n,), le (n, specLength)), le is None if the scan has no table
+	rawLines = []
+	block = None
+	with open(path) as f:
+		for line in f:
+			if line.startswith("le values"):
+				block = f.read()
+				break
+			rawLines.append(line)
+	if block is None:
+		return rawLines, None, None, None
+	block = block.split('\n', 2) # "pan,tilt,wavelength" and wavelength rows
+	if len(block) < 3 or block[2].strip() == "":
+		return rawLines, None, None, None
+	n = len(block[2].strip().split('\n'))
+	text = block[2].strip().replace('\n', ',')
+	# older versions wrote str(array) with its padding turned into extra commas, so drop empty fields
+	text = re.sub(r',\s*(?=,)', '', text).strip(', ')
+	vals = np.array(text.split(','), dtype=float)
+	if len(vals) % n != 0:
+		return rawLines, None, None, None
+	vals = vals.reshape(n, -1)
+	return rawLines, vals[:, 0], vals[:, 1], vals[:, 2:]
+
+def loadScan(path, engine=None, recalibrate=False, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv"):
+	# Scan from a saved csv. Uses the stored le values table unless recalibrate is set
+	# (or there's no table, e.g. an interrupted scan), in which case the raw lines are replayed
+	rawLines, pan, tilt, le = readLeBlock(path)
+	header = None
+	for line in rawLines:
+		if line.startswith('h'):
+			header = line.split(',')
+			break
+	if header is None:
+		return None
+	scan = Scan(header)
+	if(recalibrate or le is None or le.shape != (scan.tiltDim*scan.panDim, scan.specLength)):
+		return replayScan(rawLines, engine, calPath, sensPath)
+	if engine is None:
+		engine = makeEngine(scan.unitNumber, scan.boxcarN, calPath, sensPath)
+	if engine is None:
+		raise ValueError("calibration data not found for unit #" + str(scan.unitNumber))
+	scan.wavelengthBoxcar = engine.wavelengthBoxcar
+
+	# rows are written tilt by tilt, pan by pan (see formatLeBlock)
+	scan.hspec = le.reshape(scan.tiltDim, scan.panDim, scan.specLength)
+	scan.hspecPan = pan[:scan.panDim].copy()
+	scan.hspecTilt = tilt[::scan.panDim].copy()
+
+	scan.imagesFromLe(engine)
+
+	# saturation & provenance only need the first five fields of each light line
+	scanPass = -1
+	for line in rawLines:
+		m = parseMeta(line.split(',', 5)[:5]) if line[:1] not in ('h', 'x') else None
+		if m is None:
+			continue
+		if m[2] == 2:
+			scanPass += 1
+		if m[2] != 1:
+			continue
+		p = int((m[0] - scan.panStart) / scan.pan_Res)
+		t = int((m[1] - scan.tiltStart) / scan.tilt_Res)
+		if(0 <= p < scan.panDim and 0 <= t < scan.tiltDim):
+			scan.provenance[t, p] = max(scanPass, 0)
+			scan.imSatR[scan.tiltDim-1-t, p] = 255 if m[4] > 0 else 0
+			scan.imSatB[scan.tiltDim-1-t, p] = m[4]
+	return scan
+
+def replayScan(lines, engine=None, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv", backlash=0, maxShift=backlashSearch):
+	# rebuild a calibrated Scan from raw transcript lines in a single batched pass
+	# (backlash: see Scan.addSpectra, "auto" to measure it with estimateBacklash first, searching
+	# up to maxShift pixels; scan.backlash is then None if a serpentine scan's couldn't be measured)
+	header, meta, counts, pos = parseRaw(lines)
+	if header is None:
+		return None
+	scan = Scan(header)
+	if engine is None:
+		engine = makeEngine(scan.unitNumber, scan.boxcarN, calPath, sensPath)
+	if engine is None:
+		raise ValueError("calibration data not found for unit #" + str(scan.unitNumber))
+	scan.wavelengthBoxcar = engine.wavelengthBoxcar
+
+	darks = DarkStore()
+	for i in np.flatnonzero(meta[:, 2] == 0):
+		darks.add(meta[i, 3], counts[i], pos[i])
+	scan.darks = darks
+	scan.raw = (header, meta, counts, pos)
+	scan.addSpectra(engine, darks, meta, counts, pos, 0 if backlash == "auto" else backlash)
+	if backlash == "auto":
+		backlash = scan.measureBacklash(maxShift)
+		if backlash is None and not scan.isSerpentine():
+			backlash = 0
+		if backlash is not None and backlash != 0: # place the spectra again with it
+			scan.allocate()
+			scan.addSpectra(engine, darks, meta, counts, pos, backlash)
+	scan.backlash = backlash
+	scan.hspec = np.nan_to_num(scan.hspec) # convert NaNs to zeros
+	return scan
+
+
+##______________________outputs_____________________________
+
+def formatLeBlock(hspec, hspecPan, hspecTilt, wavelengthBoxcar):
+	# the "le values" table written after the raw data, one pan,tilt row per pixel
+	ts = "le values\npan,tilt,wavelength\n,"
+	ts += "".join(["," + str(int(w)) for w in wavelengthBoxcar])
+	tiltDim, panDim, specLength = hspec.shape
+	tab = np.empty([tiltDim*panDim, specLength+2])
+	tab[:, 0] = np.tile(hspecPan, tiltDim)
+	tab[:, 1] = np.repeat(hspecTilt, panDim)
+	tab[:, 2:] = hspec.reshape(-1, specLength)
+	rowFmt = "\n%.1f,%.1f" + ",%.3e" * specLength
+	body = "".join([rowFmt % tuple(r) for r in tab])
+	return ts + body.replace("-0.000e+00", "0").replace("0.000e+00", "0")
+
+def srgbImage(scan):
+	# 8-bit sRGB preview as saved at the end of each scan
+	with np.errstate(divide='ignore', invalid='ignore'):
+		rgb = np.dstack((scan.imR, scan.imG, scan.imB)) / scan.maxRGB
+		rgb = (np.clip(rgb, 0, None)**0.42) * 255
+	return np.clip(np.nan_to_num(rgb), 0, 255).astype(np.uint8)
+
+def coneCatchWeights(receptors, wavelengthBins, wavelengthBoxcar, boxcarN, refs=None):
+	# (specLength, n) weights turning le values into photon catches for n receptors at once
+	# receptors: sensitivity at each of the 288 photosites for each receptor
+	# refs: optional reflectance standard (le values), folded in so the cube is only read once
+	wavelengthBoxcar = np.asarray(wavelengthBoxcar, dtype=float)
+	specLength = len(wavelengthBoxcar)
+	pes = (1E18 * 6.626E-34 * 2.998E8) / (wavelengthBoxcar*1E-9) # energy per photon at each wavelength - SCALED (multiplied by 1E18 to give more sensible ouput given 32-bit floating point range limits
+	padded = np.zeros([len(receptors), specLength*boxcarN])
+	for r, recept in enumerate(receptors):
+		padded[r, :pixels] = np.asarray(recept, dtype=float)[:pixels] * np.asarray(wavelengthBins, dtype=float) # correct for differences in bin-width (area-under curve)
+	w = padded.reshape(len(receptors), specLength, boxcarN).sum(axis=2) / pes
+	if refs is not None:
+		with np.errstate(invalid='ignore'):
+			w = w * (100*np.asarray(refs, dtype=float))
+	return w.T
+
+def coneCatches(hspec, weights):
+	# (n, tiltDim, panDim) catch images for all receptors in one pass over the cube, flipped like the previews
+	with np.errstate(invalid='ignore'):
+		out = np.tensordot(weights.T, hspec, axes=([1], [2]))
+	return out[:, ::-1, :]
+
+def coneCatch(scan, recept, wavelengthBins, refs=None):
+	# photon catch image for one receptor (recept: sensitivity at each of the 288 photosites)
+	w = coneCatchWeights([recept], wavelengthBins, scan.wavelengthBoxcar, scan.boxcarN, refs)
+	return coneCatches(scan.hspec, w)[0]
+
+def saveOutputs(scan, basePath, receptors=(), wavelengthBins=None, rawLines=None):
+	# write the scan csv (raw + le values), sRGB png, luminance tiff and any cone-catch tiffs
+	# receptors: list of (name, sensitivity at each photosite)
+	from PIL import Image
+	saved = []
+	if rawLines is not None:
+		with open(basePath + ".csv", 'w') as file_object:
+			file_object.write("".join(rawLines))
+			file_object.write(formatLeBlock(scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar))
+		saved.append(basePath + ".csv")
+	Image.fromarray(srgbImage(scan), "RGB").save(basePath + "_sRGB.png")
+	saved.append(basePath + "_sRGB.png")
+	Image.fromarray(scan.imLum.astype(np.float32)).save(basePath + "_lum.tif")
+	saved.append(basePath + "_lum.tif")
+	if len(receptors) > 0:
+		w = coneCatchWeights([recept for name, recept in receptors], wavelengthBins, scan.wavelengthBoxcar, scan.boxcarN)
+		catches = coneCatches(scan.hspec, w)
+		for (name, recept), im in zip(receptors, catches):
+			ts = basePath + "_" + name + ".tif"
+			Image.fromarray(im.astype(np.float32)).save(ts)
+			saved.append(ts)
+	return saved
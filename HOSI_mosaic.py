@@ -0,0 +1,273 @@
+##
+##_________________________HOSI mosaic_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Combines scans of different pan/tilt windows (e.g. a full dome split into several
+## shorter runs, each with its own maxInt or boxcar) into one scan on a common grid.
+##
+## Only the 'h' header of each scan is read up front: its window (its footprint, in motor
+## steps) goes into FootprintIndex, a uniform grid over pan & tilt listing the scans that
+## touch each cell. Mosaic.region() then opens just the scans under the region asked
+## for (the .npz container next to a csv is memory-mapped, so only the rows needed are
+## read) and:
+##
+##	- resamples each onto the mosaic's pan/tilt grid (bilinear, skipping unmeasured
+##	  pixels, e.g. the sparse rows near the zenith)
+##	- resamples its spectra onto the mosaic's wavelengths (those of the scan with the
+##	  widest boxcar, so nothing is upsampled) by the true wavelength of each le value
+##	- blends overlaps with weights that fade out over the last few pixels of each
+##	  window (feather), and almost ignores saturated pixels where another scan has them
+##
+## Pan positions are taken as they are, so windows either side of +-1024 (straight
+## behind) aren't joined up.
+##
+## e.g. python HOSI_mosaic.py scans/dome_*.csv -o scans/dome
+##
+
+import argparse, collections, glob, math, os, sys
+import numpy as np
+import HOSI_core as core
+import HOSI_storage as storage
+
+
+indexCell = 256 # motor steps per side of a spatial index cell
+feather = 4 # pixels over which a scan's weight fades in from the edge of its window
+satWeight = 1E-3 # weight of saturated pixels, relative to unsaturated ones
+tileSize = 64 # mosaic pixels per side of the tiles built at a time
+cacheSize = 4 # scans kept open
+
+
+def readFootprint(path):
+	# unallocated core.Scan from the header of a scan csv or .npz, with its path
+	if path.endswith('.npz'):
+		header = storage.ScanArchive(path).header
+	else:
+		header = None
+		with open(path) as f:
+			for line in f:
+				if line.startswith('h'):
+					header = line.strip().split(',')
+					break
+				if line.startswith('x'):
+					break
+		if header is None:
+			raise ValueError("no scan header in " + path)
+	fp = core.Scan(header, allocate=False)
+	fp.path = path
+	fp.panLast = fp.panStart + (fp.panDim-1)*fp.pan_Res # last measured position, panStop needn't be on the grid
+	fp.tiltLast = fp.tiltStart + (fp.tiltDim-1)*fp.tilt_Res
+	return fp
+
+def overlaps(fp, pan0, pan1, tilt0, tilt1):
+	return fp.panStart <= pan1 and fp.panLast >= pan0 and fp.tiltStart <= tilt1 and fp.tiltLast >= tilt0
+
+def wavelengthMatrix(fromWav, toWav):
+	# (len(toWav), len(fromWav)) linear interpolation between two sets of le wavelengths
+	order = np.argsort(fromWav)
+	m = np.zeros([len(toWav), len(fromWav)])
+	eye = np.eye(len(fromWav))
+	for j in range(len(fromWav)):
+		m[:, order[j]] = np.interp(toWav, fromWav[order], eye[j])
+	return m
+
+
+class FootprintIndex:
+	## Uniform grid over pan & tilt: each cell lists the scans whose window touches it, so
+	## a query only has to check the scans near it.
+
+	def __init__(self, cell=indexCell):
+		self.cell = cell
+		self.cells = collections.defaultdict(list)
+		self.footprints = []
+
+	def _range(self, pan0, pan1, tilt0, tilt1):
+		for i in range(math.floor(pan0/self.cell), math.floor(pan1/self.cell)+1):
+			for j in range(math.floor(tilt0/self.cell), math.floor(tilt1/self.cell)+1):
+				yield i, j
+
+	def add(self, fp):
+		self.footprints.append(fp)
+		for key in self._range(fp.panStart, fp.panLast, fp.tiltStart, fp.tiltLast):
+			self.cells[key].append(len(self.footprints)-1)
+
+	def query(self, pan0, pan1, tilt0, tilt1):
+		# footprints overlapping the window, in the order they were added
+		found = set()
+		for key in self._range(pan0, pan1, tilt0, tilt1):
+			found.update(self.cells.get(key, ()))
+		return [self.footprints[i] for i in sorted(found) if overlaps(self.footprints[i], pan0, pan1, tilt0, tilt1)]
+
+	def bounds(self):
+		return (min(fp.panStart for fp in self.footprints), max(fp.panLast for fp in self.footprints),
+			min(fp.tiltStart for fp in self.footprints), max(fp.tiltLast for fp in self.footprints))
+
+
+class Mosaic:
+	## Scans on one pan/tilt & wavelength grid. The grid defaults to the union of the
+	## windows at the finest pan & tilt resolution among them.
+
+	def __init__(self, paths, panRes=None, tiltRes=None, cell=indexCell, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv"):
+		self.calPath = calPath
+		self.sensPath = sensPath
+		self.index = FootprintIndex(cell)
+		for path in paths:
+			self.index.add(readFootprint(path))
+		if len(self.index.footprints) == 0:
+			raise ValueError("no scans to combine")
+		fps = self.index.footprints
+		target = max(fps, key=lambda fp: fp.boxcarN)
+		self.engine = core.makeEngine(target.unitNumber, target.boxcarN, calPath, sensPath)
+		if self.engine is None:
+			raise ValueError("calibration data not found for unit #" + str(target.unitNumber))
+		self.wavelengths = self.engine.leWavelengths()
+		self.panRes = panRes or min(fp.pan_Res for fp in fps)
+		self.tiltRes = tiltRes or min(fp.tilt_Res for fp in fps)
+		pan0, pan1, tilt0, tilt1 = self.index.bounds()
+		self.header = ["h", str(target.unitNumber), str(pan0), str(pan0 + math.ceil((pan1-pan0)/self.panRes)*self.panRes), str(self.panRes),
+			str(tilt0), str(tilt0 + math.ceil((tilt1-tilt0)/self.tiltRes)*self.tiltRes), str(self.tiltRes),
+			str(max(fp.maxInt for fp in fps)), str(target.boxcarN), str(target.darkRep)]
+		self.grid = core.Scan(self.header, allocate=False)
+		self.cache = collections.OrderedDict()
+
+	def open(self, fp):
+		# the scan of a footprint: (Scan, saturated (tiltDim, panDim) in hspec order, wavelength
+		# matrix), preferring the memory-mapped .npz next to a csv. The last few are kept open
+		if fp.path in self.cache:
+			self.cache.move_to_end(fp.path)
+			return self.cache[fp.path]
+		npz = os.path.splitext(fp.path)[0] + ".npz"
+		if fp.path.endswith('.npz') or os.path.exists(npz):
+			scan = storage.ScanArchive(npz).toScan()
+		else:
+			scan = core.loadScan(fp.path, calPath=self.calPath, sensPath=self.sensPath)
+		engine = core.makeEngine(scan.unitNumber, scan.boxcarN, self.calPath, self.sensPath)
+		if engine is None:
+			raise ValueError("calibration data not found for unit #" + str(scan.unitNumber))
+		sat = np.flipud(np.asarray(scan.imSatR)) > 0 # images are flipped vertically
+		opened = (scan, sat, wavelengthMatrix(engine.leWavelengths(), self.wavelengths))
+		self.cache[fp.path] = opened
+		if len(self.cache) > cacheSize:
+			self.cache.popitem(last=False)
+		return opened
+
+	def axes(self, pan0, pan1, tilt0, tilt1):
+		# mosaic grid positions within a window
+		g = self.grid
+		p = np.arange(max(0, math.ceil((pan0-g.panStart)/g.pan_Res)), min(g.panDim-1, math.floor((pan1-g.panStart)/g.pan_Res))+1)
+		t = np.arange(max(0, math.ceil((tilt0-g.tiltStart)/g.tilt_Res)), min(g.tiltDim-1, math.floor((tilt1-g.tiltStart)/g.tilt_Res))+1)
+		return g.panStart + p*g.pan_Res, g.tiltStart + t*g.tilt_Res
+
+	def region(self, pan0, pan1, tilt0, tilt1):
+		# blended le values on the mosaic grid within a window, reading only the scans under
+		# it. Returns pan & tilt positions, (tilts, pans, wavelengths) le values and the
+		# total weight at each pixel (0 where no scan has it)
+		pans, tilts = self.axes(pan0, pan1, tilt0, tilt1)
+		acc = np.zeros([len(tilts), len(pans), len(self.wavelengths)])
+		wsum = np.zeros([len(tilts), len(pans)])
+		if len(pans) == 0 or len(tilts) == 0:
+			return pans, tilts, acc, wsum
+		for fp in self.index.query(pans[0], pans[-1], tilts[0], tilts[-1]):
+			scan, sat, wmat = self.open(fp)
+			self.contribute(fp, scan, sat, wmat, pans, tilts, acc, wsum)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			le = np.where(wsum[..., None] > 0, acc/wsum[..., None], 0.0)
+		return pans, tilts, le, wsum
+
+	def contribute(self, fp, scan, sat, wmat, pans, tilts, acc, wsum):
+		# add one scan's bilinearly resampled spectra to the running weighted sums
+		fpan = (pans - fp.panStart)/fp.pan_Res
+		ftilt = (tilts - fp.tiltStart)/fp.tilt_Res
+		pIn = (fpan >= 0) & (fpan <= fp.panDim-1)
+		tIn = (ftilt >= 0) & (ftilt <= fp.tiltDim-1)
+		if not pIn.any() or not tIn.any():
+			return
+		fpan = fpan[pIn]
+		ftilt = ftilt[tIn]
+		p0 = np.floor(fpan).astype(np.int64)
+		t0 = np.floor(ftilt).astype(np.int64)
+		pa, pb = p0.min(), min(p0.max()+2, fp.panDim)
+		ta, tb = t0.min(), min(t0.max()+2, fp.tiltDim)
+		sub = np.asarray(scan.hspec[ta:tb, pa:pb], dtype=np.float64) # only the rows under the window are read
+		measured = np.any(sub != 0, axis=2) * np.where(sat[ta:tb, pa:pb], satWeight, 1.0)
+		num = np.zeros([len(ftilt), len(fpan), sub.shape[2]])
+		den = np.zeros([len(ftilt), len(fpan)])
+		for dt in (0, 1):
+			wt = (ftilt - t0) if dt else (1 - (ftilt - t0))
+			ti = np.minimum(t0 + dt - ta, tb - ta - 1)
+			for dp in (0, 1):
+				wp = (fpan - p0) if dp else (1 - (fpan - p0))
+				pi = np.minimum(p0 + dp - pa, pb - pa - 1)
+				w = np.outer(wt, wp) * measured[np.ix_(ti, pi)]
+				num += w[..., None] * sub[np.ix_(ti, pi)]
+				den += w
+		# fade in from the edges of the window, so seams between scans blend
+		edge = np.minimum.outer(np.minimum(ftilt, fp.tiltDim-1-ftilt), np.minimum(fpan, fp.panDim-1-fpan))
+		w = np.clip((edge + 1)/feather, 0, 1)
+		sel = np.ix_(np.flatnonzero(tIn), np.flatnonzero(pIn))
+		acc[sel] += (w[..., None] * num) @ wmat.T
+		wsum[sel] += w * den
+
+	def build(self, pan0=None, pan1=None, tilt0=None, tilt1=None, log=None):
+		# core.Scan of the mosaic (or of a window of it), built a tile at a time
+		g = self.grid
+		pans, tilts = self.axes(g.panStart if pan0 is None else pan0, g.panStop if pan1 is None else pan1, g.tiltStart if tilt0 is None else tilt0, g.tiltStop if tilt1 is None else tilt1)
+		if len(pans) == 0 or len(tilts) == 0:
+			raise ValueError("the window is outside the mosaic")
+		header = list(self.header)
+		header[2:4] = [str(pans[0]), str(pans[-1])]
+		header[5:7] = [str(tilts[0]), str(tilts[-1])]
+		scan = core.Scan(header)
+		scan.hspec = np.zeros([scan.tiltDim, scan.panDim, len(self.wavelengths)])
+		scan.hspecPan = pans.astype(float)
+		scan.hspecTilt = tilts.astype(float)
+		scan.wavelengthBoxcar = self.engine.wavelengthBoxcar
+		coverage = np.zeros([scan.tiltDim, scan.panDim])
+		step = tileSize
+		for ti in range(0, len(tilts), step):
+			for pi in range(0, len(pans), step):
+				tp, tt, le, wsum = self.region(pans[pi], pans[min(pi+step, len(pans))-1], tilts[ti], tilts[min(ti+step, len(tilts))-1])
+				scan.hspec[ti:ti+len(tt), pi:pi+len(tp)] = le
+				coverage[ti:ti+len(tt), pi:pi+len(tp)] = wsum > 0
+			if log is not None:
+				log("%d of %d rows" % (min(ti+step, len(tilts)), len(tilts)))
+		scan.imagesFromLe(self.engine)
+		scan.provenance = np.where(coverage > 0, 0, -1).astype(np.int16)
+		return scan
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Combine HOSI scans of different pan/tilt windows into one")
+	parser.add_argument("scans", nargs="+", help="scan .csv or .npz files (wildcards are expanded)")
+	parser.add_argument("-o", "--output", required=True, help="base path of the saved mosaic (without .csv)")
+	parser.add_argument("-r", "--resolution", help="pan,tilt steps per pixel (default: the finest of the scans)")
+	parser.add_argument("-w", "--window", help="pan0,pan1,tilt0,tilt1: only build this part of the mosaic, e.g. --window=-200,200,400,600")
+	parser.add_argument("-c", "--calibration", default="./calibration_data.txt")
+	parser.add_argument("-s", "--sensitivities", default="./sensitivity_data.csv")
+	args = parser.parse_args(argv)
+
+	paths = []
+	for pattern in args.scans:
+		paths += sorted(glob.glob(pattern)) or [pattern]
+	panRes = tiltRes = None
+	if args.resolution:
+		panRes, tiltRes = [int(v) for v in args.resolution.split(',')]
+	mosaic = Mosaic(paths, panRes, tiltRes, calPath=args.calibration, sensPath=args.sensitivities)
+	for fp in mosaic.index.footprints:
+		print("%s: pan %d to %d by %d, tilt %d to %d by %d, boxcar %d, maxInt %d" % (fp.path, fp.panStart, fp.panLast, fp.pan_Res, fp.tiltStart, fp.tiltLast, fp.tilt_Res, fp.boxcarN, fp.maxInt))
+	window = [int(v) for v in args.window.split(',')] if args.window else [None]*4
+	scan = mosaic.build(*window, log=print)
+	outDir = os.path.dirname(args.output)
+	if outDir != "":
+		os.makedirs(outDir, exist_ok=True)
+	saved = core.saveOutputs(scan, args.output, rawLines=[",".join(scan.header) + "\n"])
+	empty = (scan.header, np.zeros([0, 5], dtype=np.int64), np.zeros([0, scan.specLength]), np.zeros(0))
+	saved.append(storage.saveScanBinary(args.output + ".npz", empty, scan.hspec, scan.hspecPan, scan.hspecTilt, scan.wavelengthBoxcar, storage.scanImages(scan), scan.provenance))
+	print("Mosaic %d by %d, %.1f%% covered" % (scan.panDim, scan.tiltDim, 100.0*(scan.provenance >= 0).mean()))
+	for path in saved:
+		print("  " + path)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,311 @@
+##
+##_________________________HOSI multi_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Runs several HOSI units at once from one computer, e.g. 3-4 units covering different
+## viewpoints of a site. Each serial port gets a DeviceSession on its own thread with its
+## own reader (HOSI_serial), scan file and calibration, looked up from the unit number
+## in the 'h' header, so the units don't wait on each other. A lost link is reopened and
+## the scan resumed from its first unfinished row (see core.resumeCommand). A status
+## line per unit is printed every few seconds, and each scan is saved as it finishes:
+##
+##	<output>_unit<N>.csv		raw data plus le values, as saved by the GUI
+##	<output>_unit<N>.npz		binary container (HOSI_storage)
+##	<output>_unit<N>_sRGB.png & _lum.tif
+##
+## e.g. python HOSI_multi.py --scan "h-1024,1024,24,480,1024,24,2000000,2,120000," -o scans/site -p /dev/ttyUSB0 -p /dev/ttyUSB1
+##
+
+import argparse, os, sys, threading, time
+import HOSI_core as core
+import HOSI_serial as hserial
+import HOSI_storage as storage
+
+
+bootDelay = 2.5 # s, the Arduino resets when its port is opened
+setupWait = 1.5 # s to wait for the reply to each setup command
+reconnectWait = 5.0 # s between attempts to reopen a lost port
+pollWait = 0.02 # s between polls of a session's serial queue
+statusInterval = 10.0 # s between status lines
+sessionLock = threading.Lock() # calibration lookups and output names, shared by the sessions
+claimedPaths = set()
+
+
+def listPorts():
+	import serial.tools.list_ports
+	return [p.device for p in serial.tools.list_ports.comports()]
+
+def claimPath(base):
+	# output path (without extension) no other session, or earlier scan, has taken
+	with sessionLock:
+		path = base
+		k = 2
+		while path in claimedPaths or os.path.exists(path + ".csv"):
+			path = base + "_" + str(k)
+			k += 1
+		claimedPaths.add(path)
+	return path
+
+def scanSpectra(vals):
+	# number of light spectra the firmware measures for the nine values of an h command
+	panLeft, panRight, panRes, tiltStart, tiltStop, tiltRes = vals[:6]
+	return sum(len(core.rowPans(panLeft, panRight, panRes, tilt)) for tilt in range(tiltStart, tiltStop+1, tiltRes))
+
+
+class DeviceSession(threading.Thread):
+	## One HOSI: its port, the scan in progress and where it is saved. openPort() returns a
+	## new pyserial-like port (called again to reconnect). run() takes the scan from the h
+	## command through to saved outputs.
+
+	def __init__(self, label, openPort, command, output, hints=True, binary=True, boot=bootDelay, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv"):
+		threading.Thread.__init__(self, daemon=True)
+		self.label = label
+		self.openPort = openPort
+		self.command = command
+		self.output = output
+		self.hints = hints
+		self.binary = binary
+		self.boot = boot
+		self.calPath = calPath
+		self.sensPath = sensPath
+		self.ser = None
+		self.reader = None
+		self.writer = None
+		self.path = None # of the scan csv, set by the first h header
+		self.unitNumber = None
+		self.engine = None
+		self.state = "starting"
+		self.expected = scanSpectra([int(float(v)) for v in command.strip().lstrip('h').split(',') if v.strip() != ""])
+		self.measured = set() # (pan, tilt) of the light spectra so far
+		self.rowTilt = None
+		self.resumes = 0
+		self.started = None
+		self.finished = None
+		self.stopping = False
+		self.error = None
+		self.saved = []
+
+	def run(self):
+		self.started = time.time()
+		command = self.command
+		try:
+			while command is not None and not self.stopping:
+				if self.connect() and self.scan(command):
+					break
+				self.disconnect()
+				if self.stopping:
+					break
+				if self.path is not None: # carry on from the first unfinished row
+					resume = core.resumeCommand(core.readRawLines(self.path))
+					command = resume[0] if resume is not None else None
+				self.resumes += 1
+				self.state = "reconnecting"
+				time.sleep(reconnectWait)
+			self.disconnect()
+			if not self.stopping and self.path is not None:
+				self.finish()
+		except Exception as e:
+			self.error = e
+			self.state = "failed"
+		finally:
+			if self.writer is not None:
+				self.writer.close()
+				self.writer = None
+			self.finished = time.time()
+
+	def connect(self):
+		# open the port and wait for the HOSI to boot, then the setup commands (which older
+		# firmware ignores, so nothing waits for their replies). False if the port won't open
+		try:
+			self.ser = self.openPort()
+		except Exception as e:
+			self.error = e
+			return False
+		self.error = None
+		time.sleep(self.boot)
+		self.reader = hserial.SerialReader(self.ser)
+		self.reader.start()
+		if self.binary:
+			self.reader.write(hserial.binaryRequest)
+			time.sleep(setupWait if self.boot > 0 else 0.1)
+			self.reader.clear()
+		return self.reader.error is None
+
+	def disconnect(self):
+		if self.reader is not None:
+			self.error = self.reader.error
+			self.reader.stop()
+			self.reader = None
+		if self.ser is not None:
+			try:
+				self.ser.close()
+			except Exception:
+				pass
+			self.ser = None
+
+	def scan(self, command):
+		# send the h command and write what comes back to the scan file, True at the 'x'
+		# (False if the link drops or the session is stopped)
+		self.state = "scanning"
+		exposure = None
+		self.reader.write(command)
+		while self.reader.error is None and not self.stopping:
+			recs = self.reader.drain()
+			for rec in recs:
+				if rec.kind == 'h':
+					self.header(rec.line.strip().split(','))
+					if self.hints:
+						exposure = core.ExposureHints(rec.line.strip().split(','))
+				if self.writer is not None:
+					self.writer.write(rec.line)
+				if rec.kind == 'x':
+					return True
+				if rec.kind == 'e' and exposure is not None:
+					exposure.acknowledge(rec.line)
+				elif rec.kind == 's' and rec.meta[2] == 1:
+					self.measured.add((int(rec.meta[0]), int(rec.meta[1])))
+					if rec.meta[1] != self.rowTilt:
+						if self.rowTilt is not None and self.writer is not None:
+							self.writer.sync() # the row before is complete
+						self.rowTilt = rec.meta[1]
+					hint = exposure.add(rec.meta) if exposure is not None else None
+					if hint is not None:
+						self.reader.write(hint)
+			if len(recs) == 0:
+				time.sleep(pollWait)
+		return False
+
+	def header(self, fields):
+		# the HOSI's reply to the h command: the first sets up the file and calibration,
+		# one after a reconnect appends to them
+		if self.path is None:
+			self.unitNumber = int(fields[1])
+			with sessionLock:
+				self.engine = core.makeEngine(self.unitNumber, int(fields[9]), self.calPath, self.sensPath)
+			self.path = claimPath(self.output + "_unit" + str(self.unitNumber)) + ".csv"
+		if self.writer is None:
+			self.writer = storage.ScanWriter(self.path)
+
+	def finish(self):
+		# calibrate the whole transcript in one pass and save the outputs
+		self.state = "saving"
+		if self.writer is None:
+			self.writer = storage.ScanWriter(self.path)
+		if self.engine is None: # only the raw data can be kept
+			self.writer.close()
+			self.writer = None
+			self.saved = [self.path]
+			self.state = "no calibration"
+			return
+		s = core.replayScan(core.readRawLines(self.path), self.engine)
+		if s is None: # nothing to calibrate, e.g. the header never arrived
+			self.writer.close()
+			self.writer = None
+			self.saved = [self.path]
+			self.error = ValueError("no scan header in " + self.path)
+			self.state = "failed"
+			return
+		self.writer.finish(core.formatLeBlock(s.hspec, s.hspecPan, s.hspecTilt, s.wavelengthBoxcar))
+		self.writer = None
+		base = os.path.splitext(self.path)[0]
+		storage.saveScanBinary(base + ".npz", s.raw, s.hspec, s.hspecPan, s.hspecTilt, s.wavelengthBoxcar, storage.scanImages(s), s.provenance)
+		self.saved = [self.path, base + ".npz"] + core.saveOutputs(s, base)
+		self.state = "done"
+
+	def stop(self):
+		# stop at the next poll, leaving the scan file as it is so it can be resumed later
+		self.stopping = True
+
+	def status(self):
+		unit = "?" if self.unitNumber is None else str(self.unitNumber)
+		done = 100.0*min(len(self.measured), self.expected)/max(self.expected, 1)
+		took = (self.finished or time.time()) - (self.started or time.time())
+		ts = "%-14s unit %-3s %-14s %5.1f%%  %6d spectra  %6.0f s" % (self.label, unit, self.state, done, len(self.measured), took)
+		if self.resumes > 0:
+			ts += "  resumed %d" % self.resumes
+		if self.error is not None and self.state != "done":
+			ts += "  (" + str(self.error) + ")"
+		return ts
+
+
+def printStatus(sessions):
+	print(time.strftime("%H:%M:%S"))
+	for s in sessions:
+		print("  " + s.status())
+	sys.stdout.flush()
+
+def runSessions(sessions, interval=statusInterval):
+	# start every session and print their status until all have finished (Ctrl-C stops them)
+	for s in sessions:
+		s.start()
+	try:
+		while any(s.is_alive() for s in sessions):
+			end = time.time() + interval
+			while time.time() < end and any(s.is_alive() for s in sessions):
+				time.sleep(0.1)
+			printStatus(sessions)
+	except KeyboardInterrupt:
+		print("Stopping, unfinished scans can be resumed from the GUI")
+		for s in sessions:
+			s.stop()
+		for s in sessions:
+			s.join(2*setupWait)
+		printStatus(sessions)
+	return sessions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Scan with several HOSIs at once")
+	parser.add_argument("--scan", required=True, help="h command for every unit, e.g. \"h-200,200,10,400,600,10,2000000,2,30000,\"")
+	parser.add_argument("-o", "--output", required=True, help="base path of the saved files, _unit<N> is added for each HOSI")
+	parser.add_argument("-p", "--port", action="append", default=[], help="serial port of a HOSI (repeat for each)")
+	parser.add_argument("--all", action="store_true", help="use every serial port found")
+	parser.add_argument("--simulate", type=int, metavar="N", help="scan N virtual HOSIs (HOSI_simulator) instead")
+	parser.add_argument("--speed", type=float, default=0, help="with --simulate, time factor of the virtual HOSIs (default 0, no delays)")
+	parser.add_argument("--no-hints", action="store_true", help="don't send exposure hints")
+	parser.add_argument("--text", action="store_true", help="don't ask for binary spectrum frames")
+	parser.add_argument("-i", "--interval", type=float, default=statusInterval, help="seconds between status lines")
+	parser.add_argument("-c", "--calibration", default="./calibration_data.txt")
+	parser.add_argument("-s", "--sensitivities", default="./sensitivity_data.csv")
+	args = parser.parse_args(argv)
+
+	command = args.scan.strip()
+	if not command.startswith('h'):
+		command = "h" + command
+	outDir = os.path.dirname(args.output)
+	if outDir != "":
+		os.makedirs(outDir, exist_ok=True)
+	opts = dict(hints=not args.no_hints, binary=not args.text, calPath=args.calibration, sensPath=args.sensitivities)
+
+	sessions = []
+	if args.simulate:
+		import HOSI_simulator as sim
+		wavCoef, radSens, linCoefs = sim.unitCalibration(sim.unitNumber, args.calibration)
+		for i in range(args.simulate):
+			scene = sim.SyntheticScene(wavCoef, radSens, seed=i) # a different view for each
+			openPort = lambda scene=scene, i=i: sim.LoopbackSerial(sim.VirtualHOSI(scene, speed=args.speed, calPath=args.calibration, seed=i))
+			sessions.append(DeviceSession("sim" + str(i+1), openPort, command, args.output, boot=0, **opts))
+	else:
+		ports = listPorts() if args.all else args.port
+		if len(ports) == 0:
+			parser.error("give the serial ports (-p), --all or --simulate")
+		import serial
+		for port in ports:
+			openPort = lambda port=port: serial.Serial(port, 115200)
+			sessions.append(DeviceSession(port, openPort, command, args.output, **opts))
+
+	start = time.time()
+	runSessions(sessions, args.interval)
+	print("All done in %.1f s" % (time.time() - start))
+	failed = 0
+	for s in sessions:
+		if s.state != "done":
+			failed += 1
+		for path in s.saved:
+			print("  " + path)
+	return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
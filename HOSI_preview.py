@@ -0,0 +1,200 @@
+##
+##_________________________HOSI preview_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Tone-mapping of the preview images (RGB, saturation, IGU and NDVI) to 8-bit, kept
+## separate from tkinter. The GUI used to rebuild the whole image every time it was
+## drawn; PreviewRenderer instead keeps a uint8 buffer per preview mode and only
+## recomputes the pixels that have changed since that mode was last drawn. The full
+## image is only re-tone-mapped when the max value, white balance or brightness change.
+##
+## The power curve (x/max)^0.42 * 255 * brightness is applied with a lookup table
+## (lutSize steps between black and full white) rather than a log & exp per pixel.
+## Output can be one level darker than the exact curve in the deepest shadows.
+##
+## Each buffer also has a TilePyramid: halved copies of it cut into tiles, made as they
+## are first shown, so a zoomed view of a large scan only scales the tiles it shows.
+##
+
+
+import numpy as np
+
+
+gamma = 0.42
+lutSize = 2**20
+maxChanged = 100000 # past this many changed pixels it's quicker to redraw everything
+tileSize = 256 # pixels along each side of a pyramid tile
+
+toneLut = None # built on first use, so importing stays quick
+
+
+def toneMap(x, maxVal, wb, br):
+	# sign(x) * (|x*wb|/maxVal)^gamma * 255 * br as uint8, clipped to 0..255 (wb > 0)
+	# brightness is folded into the scale, as br*t^gamma = (t*br^(1/gamma))^gamma
+	scale = wb / maxVal * br**(1/gamma) * lutSize
+	q = np.nan_to_num(np.asarray(x, dtype=float) * scale, nan=0.0, posinf=lutSize, neginf=0.0)
+	np.clip(q, 0, lutSize, out=q)
+	return getToneLut()[q.astype(np.intp)]
+
+def getToneLut():
+	# 8-bit output of t^gamma * 255 for t = 0..1 in lutSize steps (i.e. the clipped & truncated curve)
+	global toneLut
+	if toneLut is None:
+		toneLut = np.searchsorted((np.arange(1, 256) / 255.0)**(1/gamma), np.arange(lutSize+1) / lutSize, side='right').astype(np.uint8)
+	return toneLut
+
+def toneMapDirect(x, maxVal, wb, br):
+	# same as toneMap without the lookup table (for white balance values <= 0)
+	with np.errstate(invalid='ignore'):
+		v = np.sign(x) * ((np.abs(x * wb)/maxVal)**gamma) * 255 * br
+	return np.nan_to_num(np.clip(v, 0, 255)).astype(np.uint8)
+
+
+class PreviewRenderer:
+	## Call touch() for each pixel that changes during a scan and render() to get the
+	## (rows, cols, 3) uint8 image for a preview mode (1 RGB, 2 saturation, 3 IGU, 4 NDVI).
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		# forget all buffers, e.g. when a new scan starts
+		self.buffers = {} # mode -> uint8 image
+		self.keys = {} # mode -> settings the buffer was drawn with
+		self.seen = {} # mode -> number of entries of changed already drawn
+		self.pyramids = {} # mode -> TilePyramid of the buffer
+		self.changed = []
+
+	def touch(self, row, col):
+		self.changed.append((row, col))
+		if len(self.changed) > maxChanged:
+			self.reset()
+
+	def render(self, mode, images, maxRGB, maxIGU, wb, br):
+		# images: dict of the preview arrays (R, G, B, satR, satB, I, GG, U, chlA, chlB)
+		# wb: (wbR, wbG, wbB, wbI, wbGG, wbU); br: brightness multiplier
+		if mode <= 2:
+			names = ("R", "G", "B", "satR", "satB")
+			maxVal = maxRGB
+			wb = wb[:3]
+		elif mode == 3:
+			names = ("I", "GG", "U")
+			maxVal = maxIGU
+			wb = wb[3:]
+		else:
+			names = ("chlA", "chlB")
+			maxVal = None
+			wb = ()
+		shape = np.shape(images[names[0]])
+		key = (shape, maxVal, tuple(wb), br) + tuple(id(images[n]) for n in names)
+
+		if self.keys.get(mode) != key or mode not in self.buffers:
+			buf = self._draw(mode, images, maxVal, wb, br, None)
+			self.buffers[mode] = buf
+			self.keys[mode] = key
+			self.pyramids.pop(mode, None)
+		elif self.seen.get(mode, 0) < len(self.changed):
+			rows, cols = np.array(self.changed[self.seen.get(mode, 0):]).T
+			self.buffers[mode][rows, cols] = self._draw(mode, images, maxVal, wb, br, (rows, cols))
+			if mode in self.pyramids:
+				self.pyramids[mode].invalidate(rows, cols)
+		self.seen[mode] = len(self.changed)
+		return self.buffers[mode]
+
+	def pyramid(self, mode):
+		# TilePyramid of the buffer last rendered for the mode
+		if mode not in self.pyramids:
+			self.pyramids[mode] = TilePyramid(self.buffers[mode])
+		return self.pyramids[mode]
+
+	def _draw(self, mode, images, maxVal, wb, br, sel):
+		# whole image if sel is None, otherwise just the (rows, cols) pixels
+		def get(name):
+			im = np.asarray(images[name])
+			return im if sel is None else im[sel]
+
+		if mode <= 3:
+			chans = ("R", "G", "B") if mode <= 2 else ("I", "GG", "U")
+			out = []
+			for name, w in zip(chans, wb):
+				if w > 0:
+					out.append(toneMap(get(name), maxVal, w, br))
+				else:
+					out.append(toneMapDirect(get(name), maxVal, w, br))
+			if mode == 2: ## saturation image
+				g = out[1].astype(float)
+				satR = get("satR")
+				satB = get("satB")
+				## where saturated turn red, otherwise grey (match green)
+				## add blue to show degree of saturation across wavelengths, so magenta will be fully saturated
+				gs = np.clip(g - satR, 0, 255)
+				out = [g, gs, np.clip(gs + (satB * 5), 0, 255)]
+			return np.stack(out, axis=-1).astype(np.uint8)
+
+		## NDVI
+		chlA = get("chlA")
+		nImB = get("chlB") * 255
+		nImR = ((255-nImB)*2) * chlA
+		nImG = ((255-nImB)*2) * (1-chlA)
+		with np.errstate(invalid='ignore'):
+			return np.stack((nImR, nImG, nImB), axis=-1).astype(np.uint8)
+
+
+def halve(im):
+	# 2x2 mean of a (rows, cols, 3) uint8 image, the last row & column repeated if odd
+	if im.shape[0] % 2 == 1:
+		im = np.concatenate((im, im[-1:]), axis=0)
+	if im.shape[1] % 2 == 1:
+		im = np.concatenate((im, im[:, -1:]), axis=1)
+	s = im[0::2, 0::2].astype(np.uint16) + im[1::2, 0::2] + im[0::2, 1::2] + im[1::2, 1::2]
+	return ((s + 2) >> 2).astype(np.uint8)
+
+
+class TilePyramid:
+	## Levels of a preview buffer, each half the size of the one below, cut into tileSize
+	## tiles. Level 0 is the buffer itself; the tiles of the levels above are made from the
+	## level below when first asked for and kept until a pixel under them changes, so
+	## zooming & panning around a large scan only scales what is in view.
+
+	def __init__(self, buf):
+		self.buf = buf
+		self.tiles = {} # (level, tile row, tile col) -> uint8 tile
+		self.shapes = [buf.shape[:2]] # (rows, cols) of each level
+		while max(self.shapes[-1]) > tileSize:
+			h, w = self.shapes[-1]
+			self.shapes.append(((h+1)//2, (w+1)//2))
+
+	def levels(self):
+		return len(self.shapes)
+
+	def invalidate(self, rows, cols):
+		# forget the tiles over these pixels of the buffer
+		for level in range(1, len(self.shapes)):
+			tileSpan = tileSize << level
+			for key in set(zip((np.asarray(rows)//tileSpan).tolist(), (np.asarray(cols)//tileSpan).tolist())):
+				self.tiles.pop((level,) + key, None)
+
+	def tile(self, level, tr, tc):
+		if level == 0:
+			return self.buf[tr*tileSize:(tr+1)*tileSize, tc*tileSize:(tc+1)*tileSize]
+		t = self.tiles.get((level, tr, tc))
+		if t is None:
+			h, w = self.shapes[level-1]
+			t = halve(self.window(level-1, 2*tr*tileSize, min(2*(tr+1)*tileSize, h), 2*tc*tileSize, min(2*(tc+1)*tileSize, w)))
+			self.tiles[(level, tr, tc)] = t
+		return t
+
+	def window(self, level, r0, r1, c0, c1):
+		# rows r0..r1-1 & cols c0..c1-1 of a level, put together from its tiles
+		if level == 0:
+			return self.buf[r0:r1, c0:c1]
+		out = np.empty((r1-r0, c1-c0, 3), dtype=np.uint8)
+		for tr in range(r0//tileSize, (r1-1)//tileSize + 1):
+			for tc in range(c0//tileSize, (c1-1)//tileSize + 1):
+				t = self.tile(level, tr, tc)
+				y, x = tr*tileSize, tc*tileSize
+				a0, a1 = max(r0, y), min(r1, y + t.shape[0])
+				b0, b1 = max(c0, x), min(c1, x + t.shape[1])
+				out[a0-r0:a1-r0, b0-c0:b1-c0] = t[a0-y:a1-y, b0-x:b1-x]
+		return out
@@ -0,0 +1,227 @@
+##
+##_________________________HOSI serial_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Serial link to the HOSI on its own thread. SerialReader blocks on readline() so the
+## GUI doesn't have to: each line is parsed (spectra straight into NumPy arrays) and
+## put on a bounded queue, which the GUI drains in batches on a timer. Writes to the
+## HOSI go through the same object so they can be made from any thread.
+##
+## Spectra arrive either as ASCII lines or, once the HOSI has agreed to it (send
+## binaryRequest, the HOSI replies "bin: 1"), as binary frames:
+##
+##	0xA5 0x5A	sync
+##	uint16		n, number of counts
+##	int16		pan
+##	int16		tilt
+##	uint8		type (0 dark, 1 light, 2 start)
+##	uint32		intTime
+##	uint16		satN
+##	uint16		sequence number (counts up from 0 after each binaryRequest)
+##	n x uint16	counts (boxcar sums)
+##	uint16		CRC-16/CCITT (0x1021, from 0xFFFF) of everything after the sync bytes
+##
+## all little-endian. Text (replies, the 'h' header and 'x') stays ASCII, and never
+## contains the first sync byte, so both can be read from the same stream. Frames are
+## decoded straight into NumPy and turned back into the ASCII line for the scan file,
+## so saved scans look the same either way.
+##
+
+
+import binascii, queue, struct, threading, time
+import numpy as np
+import HOSI_core as core
+
+
+frameSync = b'\xa5\x5a'
+frameHeader = struct.Struct('<HhhBIHH') # n, pan, tilt, type, intTime, satN, seq
+binaryRequest = "b1"
+
+
+def serpentineCommand(on, backlash=0):
+	# serpentine scanning on/off, backlash in pan steps (firmware z command, replies "zigzag: ...")
+	return "z" + ("1" if on else "0") + "," + str(int(backlash)) + ","
+
+
+def frameCrc(data):
+	return binascii.crc_hqx(data, 0xFFFF)
+
+def encodeFrame(meta, counts, seq):
+	# meta [pan, tilt, type, intTime, satN] and counts to a frame (as the firmware sends it)
+	body = frameHeader.pack(len(counts), int(meta[0]), int(meta[1]), int(meta[2]), int(meta[3]), int(meta[4]), seq & 0xFFFF)
+	body += np.asarray(counts).astype('<u2').tobytes()
+	return frameSync + body + struct.pack('<H', frameCrc(body))
+
+def decodeFrame(body):
+	# everything after the sync bytes -> (meta, counts, seq), or None if it's short or fails the CRC
+	if len(body) < frameHeader.size + 2:
+		return None
+	n, pan, tilt, mType, intTime, satN, seq = frameHeader.unpack_from(body)
+	end = frameHeader.size + 2*n
+	if len(body) != end + 2 or struct.unpack_from('<H', body, end)[0] != frameCrc(body[:end]):
+		return None
+	meta = np.array([pan, tilt, mType, intTime, satN], dtype=np.int64)
+	counts = np.frombuffer(body, dtype='<u2', count=n, offset=frameHeader.size).astype(float)
+	return meta, counts, seq
+
+def formatLine(meta, counts):
+	# the ASCII line the firmware would have sent for this spectrum
+	return ",".join(map(str, list(meta) + np.asarray(counts, dtype=np.int64).tolist())) + "\n"
+
+
+class SerialRecord:
+	## One line from the HOSI. kind is 'h' (scan header), 's' (spectrum), 'x' (end of scan),
+	## 'p'/'t' (pan/tilt move done), 'i' (integration time set), 'b' (binary mode set),
+	## 'e' (exposure hint taken), 'z' (serpentine mode set) or '' (anything else). For
+	## spectra, meta is [pan, tilt, type, intTime, satN] and counts the raw counts (given
+	## directly for a decoded binary frame).
+	__slots__ = ("line", "kind", "meta", "counts")
+
+	def __init__(self, line, meta=None, counts=None):
+		self.line = line
+		self.meta = meta
+		self.counts = counts
+		parsed = None if meta is not None else core.parseLine(line)
+		if meta is not None:
+			self.kind = 's'
+		elif parsed is not None:
+			self.kind = 's'
+			self.meta, self.counts = parsed
+		elif line[:1] in ('h', 'x', 'p', 't', 'i', 'b', 'e', 'z'):
+			self.kind = line[:1]
+		else:
+			self.kind = ''
+
+
+class SerialReader(threading.Thread):
+
+	def __init__(self, ser, maxQueue=5000):
+		threading.Thread.__init__(self, daemon=True)
+		self.ser = ser
+		self.queue = queue.Queue(maxsize=maxQueue) # bounded, so a stalled GUI holds the data back in the serial buffer
+		self.lock = threading.Lock()
+		self.running = True
+		self.error = None
+		self.binary = False # True once the HOSI has agreed to send binary frames
+		self.seq = None
+		self.badFrames = 0 # frames dropped for a bad CRC or length
+		self.lostFrames = 0 # gaps in the sequence numbers
+
+	def run(self):
+		while self.running:
+			try:
+				rec = self.readRecord()
+			except Exception as e:
+				self.error = e # e.g. USB unplugged
+				self.running = False
+				break
+			if rec is not None:
+				self.queue.put(rec)
+
+	def readRecord(self):
+		first = self.ser.read(1)
+		if not first:
+			return None # read timeout
+		if first == frameSync[:1]:
+			return self.readFrame()
+		line = first + self.ser.readline()
+		try:
+			line = line.decode('utf-8', 'replace')
+		except:
+			line = "0"
+			print("Error reading line")
+		rec = SerialRecord(line)
+		if rec.kind == 'b':
+			self.binary = line.strip().endswith("1")
+			self.seq = None
+		return rec
+
+	def readFrame(self):
+		# rest of a binary frame once its first sync byte has been read
+		if self.ser.read(1) != frameSync[1:]:
+			self.badFrames += 1
+			return self.resync()
+		body = self.ser.read(frameHeader.size)
+		if len(body) == frameHeader.size:
+			n = frameHeader.unpack_from(body)[0]
+			if n > core.pixels: # corrupted length, don't wait for a body that long
+				self.badFrames += 1
+				return self.resync()
+			body += self.ser.read(2*n + 2)
+		frame = decodeFrame(body)
+		if frame is None:
+			self.badFrames += 1
+			return self.resync()
+		meta, counts, seq = frame
+		if self.seq is not None:
+			self.lostFrames += (seq - self.seq - 1) & 0xFFFF
+		self.seq = seq
+		return SerialRecord(formatLine(meta, counts), meta, counts)
+
+	def resync(self):
+		# skip what's left of a bad frame, byte by byte, up to the next frame or a line ending
+		# in a known record (e.g. the 'x'); the counts of a frame can contain newlines too
+		skipped = b''
+		while self.running:
+			c = self.ser.read(1)
+			if not c:
+				return None # read timeout
+			if c == frameSync[:1]:
+				return self.readFrame()
+			if c == b'\n':
+				k = len(skipped)
+				while k > 0 and (32 <= skipped[k-1] < 127 or skipped[k-1] == 13):
+					k -= 1
+				rec = SerialRecord(skipped[k:].decode('ascii') + "\n")
+				if rec.kind != '':
+					return rec
+				skipped = b''
+				continue
+			skipped += c
+		return None
+
+	def write(self, ts):
+		with self.lock:
+			self.ser.write(str.encode(ts))
+
+	def drain(self, maxItems=1000):
+		# up to maxItems records without blocking
+		out = []
+		try:
+			while len(out) < maxItems:
+				out.append(self.queue.get_nowait())
+		except queue.Empty:
+			pass
+		return out
+
+	def collect(self, command, kind='x', hints=False):
+		# headless use (the GUI drains the queue on its own timer): send a command and gather
+		# the reply lines up to the first record of this kind, e.g. 'x' at the end of a scan.
+		# With hints, exposure hints are sent at the end of each row of a scan.
+		# Returns the lines and the core.ExposureHints (None without hints)
+		lines = []
+		exposure = None
+		self.write(command)
+		while self.error is None:
+			for rec in self.drain():
+				lines.append(rec.line.replace("\r\n", "\n"))
+				if hints and rec.kind == 'h':
+					exposure = core.ExposureHints(rec.line.strip().split(','))
+				elif exposure is not None and rec.kind == 'e':
+					exposure.acknowledge(rec.line)
+				elif exposure is not None and rec.kind == 's' and rec.meta[2] == 1:
+					hint = exposure.add(rec.meta)
+					if hint is not None:
+						self.write(hint)
+				if rec.kind == kind:
+					return lines, exposure
+			time.sleep(0.001)
+		raise self.error
+
+	def clear(self):
+		# throw away anything not yet handled
+		self.drain(self.queue.maxsize)
+
+	def stop(self):
+		self.running = False
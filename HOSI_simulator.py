@@ -0,0 +1,723 @@
+##
+##_________________________HOSI simulator_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## A virtual HOSI that speaks the same serial protocol as Arduino_HOSI_1.05.ino, so the
+## GUI, the calibration scripts and the acquisition code can be run and timed without
+## the gimbal or spectrometer. It follows the firmware step by step: the t, p, l, r and
+## h commands, the "h,unit,..." header, the start (type 2), dark ladder (type 0) and
+## light (type 1) lines with pan,tilt,type,intTime,satN and the boxcar sums, the
+## auto-exposure ladder, the panorama spacing near the zenith and the "x" terminator,
+## plus the b command for binary spectrum frames (see HOSI_serial).
+## Quirks of the firmware are kept (e.g. 'r' reports the pan & tilt of the last scan,
+## and when auto-exposure runs out of time it sends the counts of the previous read).
+##
+## Timing follows the hardware too (set speed=0 to turn the delays off, or e.g. 10 to
+## run ten times faster): each byte takes 10 bits at the baud rate, each read takes the
+## integration time plus the readout, moves follow the AccelStepper speed profile
+## (500 steps/s, 5000 steps/s^2) and each command waits for Serial.readString() to
+## time out. The device clock (used for the dark repeat timer) is simulated, so a scan
+## gives the same lines whatever the speed.
+##
+## Light comes from a scene: SyntheticScene (sky, sun & ground patches) or ReplayScene,
+## which plays back a recorded scan csv at the nearest recorded position and re-exposes
+## it for whatever integration time is asked for.
+##
+## Either connect in-process with LoopbackSerial (a pyserial-like object) or run this
+## file to get a pseudo-terminal (Linux/macOS) to point the GUI at:
+##
+##	python HOSI_simulator.py --replay "Sample scans/2024-11-14_01-51-36_woodland.csv"
+##	HOSI_PORT=/dev/pts/5 python HOSI_GUI_0.1.51.py
+##
+## Or run one scan without a serial port and save the transcript:
+##
+##	python HOSI_simulator.py --speed 0 --scan "h-200,200,10,400,600,10,2000000,2,30000," -o sim.csv
+##
+## (add --binary to compare the wire time with binary spectrum frames)
+##
+
+
+import argparse, math, os, re, select, sys, threading, time
+import numpy as np
+import HOSI_core as core
+import HOSI_serial as hserial
+
+
+## firmware constants
+unitNumber = 9
+satVal = 998 # over-exposure value
+adcMax = 1023
+minIntTime = 50
+intStep = 400
+maxIntTime = 3000000
+panoSteps = (913, 959, 988, 1005)
+panoSpaces = (2, 4, 8, 16)
+maxSpeed = 500.0 # stepper steps/s
+acceleration = 5000.0 # stepper steps/s^2
+
+## hardware timing (seconds)
+readoutTime = 0.035 # clocking out and reading the 288 photosites
+commandTimeout = 1.0 # Serial.readString() waits this long after the last character
+minGap = 0.01 # commands are still split by a short pause when the delays are off
+hintWait = 0.1 # how long a row waits for its exposure hint once the host is sending them (firmware hintWait)
+
+## default sensor model (per photosite counts)
+darkLevel = 125.0
+darkCurrent = 0.0005 # counts per microsecond
+readNoise = 1.0
+defaultLinCoefs = (0.91106809, 0.58315014)
+defaultWavCoef = (315.0073901, 2.700335692, -1.370721454E-03, -5.494487172E-06, 1.0E-08, -5.0E-12)
+
+
+def moveTime(steps):
+	# AccelStepper runToNewPosition: trapezoidal speed profile, triangular for short moves
+	steps = abs(steps)
+	if steps == 0:
+		return 0.0
+	if steps >= maxSpeed**2 / acceleration:
+		return steps/maxSpeed + maxSpeed/acceleration
+	return 2*math.sqrt(steps/acceleration)
+
+def delinearise(y, linCoefs):
+	# inverse of core.linearise: raw counts above dark that linearise to y
+	y = np.asarray(y, dtype=float)
+	ay = np.abs(y)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		out = np.where(ay > 0, np.exp((np.log(np.where(ay > 0, ay, 1.0)) - linCoefs[1])/linCoefs[0]), 0.0)
+	return np.sign(y) * out
+
+def unitCalibration(unit, calPath="./calibration_data.txt"):
+	# calibration of the simulated unit, or typical values if it isn't in the file
+	try:
+		cal = core.calibrationRegistry(calPath).unit(unit)
+	except OSError:
+		cal = None
+	if cal is None:
+		return np.asarray(defaultWavCoef), np.full(core.pixels, 10.0), np.asarray(defaultLinCoefs)
+	return cal.wavCoef, cal.radSens, cal.linCoefs
+
+
+class SensorModel:
+	## Raw counts from the C12880MA for a given light level: the dark (interpolated between
+	## the integration times of a dark ladder), plus the signal put back through the
+	## sensor's non-linearity, plus noise, clipped to the 10-bit ADC.
+
+	def __init__(self, linCoefs, darkTimes=None, darkCounts=None, noise=readNoise, seed=0):
+		self.linCoefs = [float(linCoefs[0]), float(linCoefs[1])]
+		if darkTimes is None:
+			## fixed pattern plus dark current
+			pattern = np.random.default_rng(seed+1).normal(0, 2, core.pixels)
+			darkTimes = np.array([0.0, 1e7])
+			darkCounts = np.vstack([darkLevel + pattern, darkLevel + pattern + darkCurrent*1e7])
+		order = np.argsort(darkTimes)
+		self.darkTimes = np.asarray(darkTimes, dtype=float)[order]
+		self.darkCounts = np.asarray(darkCounts, dtype=float)[order]
+		self.noise = noise
+		self.rng = np.random.default_rng(seed)
+
+	def dark(self, intTime):
+		t = self.darkTimes
+		i = int(np.clip(np.searchsorted(t, intTime), 1, max(len(t)-1, 1)))
+		if len(t) == 1:
+			return self.darkCounts[0]
+		w = np.clip((intTime - t[i-1]) / (t[i] - t[i-1]), 0, 1)
+		return self.darkCounts[i-1]*(1-w) + self.darkCounts[i]*w
+
+	def read(self, rate, intTime):
+		# rate: linear counts per microsecond for each photosite (as calibrated by core)
+		signal = delinearise(np.asarray(rate) * (intTime + core.baseInt), self.linCoefs)
+		v = self.dark(intTime) + signal
+		if self.noise > 0:
+			v = v + self.rng.normal(0, 1, core.pixels) * np.sqrt(self.noise**2 + np.abs(signal)*0.05)
+		return np.clip(np.rint(v), 0, adcMax).astype(np.int64)
+
+
+class SyntheticScene:
+	## Blue sky brightening towards the zenith, a sun, and a ground of vegetation and soil
+	## patches. Tilt 0 is straight down, 512 the horizon and 1024 straight up; 2048 steps
+	## make a full turn of either axis.
+
+	def __init__(self, wavCoef=defaultWavCoef, radSens=None, sun=(300, 800), brightness=1.0, seed=0):
+		w = core.wavelengthsFromCoefs(wavCoef)
+		self.radSens = np.full(core.pixels, 10.0) if radSens is None else np.asarray(radSens, dtype=float)
+		self.radSens = self.radSens * brightness
+		self.sun = sun
+		self.sky = (w/450.0)**-4 * np.clip((w-300)/100, 0, 1) * 0.01
+		self.sunSpec = np.exp(-((w-550)/250)**2) * 2.0
+		self.plant = (0.2 + np.exp(-((w-550)/40)**2) + 3/(1 + np.exp(-(w-710)/15))) * 0.001
+		self.soil = (0.5 + (w-300)/400) * 0.002
+		self.darks = (None, None)
+
+	def rate(self, pan, tilt):
+		if tilt <= 0:
+			return np.zeros(core.pixels) # looking into the housing
+		if tilt > 512:
+			elev = (tilt-512)/512.0
+			le = self.sky * (0.5 + elev)
+			d2 = ((pan - self.sun[0])**2 + (tilt - self.sun[1])**2) / 20.0**2
+			if d2 < 25:
+				le = le + self.sunSpec * math.exp(-d2)
+		else:
+			patch = (int(pan//128) + int(tilt//64)) % 3
+			le = self.plant if patch == 0 else self.soil * (0.6 + 0.4*patch)
+			le = le * (0.3 + 0.7*tilt/512.0)
+		return le * self.radSens
+
+
+class ReplayScene:
+	## Plays back a recorded scan csv: the light at any position is that of the nearest light
+	## measurement in the recording (as linear counts per microsecond), and the darks are
+	## the recording's first dark ladder.
+
+	def __init__(self, path, calPath="./calibration_data.txt"):
+		header, meta, counts, pos = core.parseRaw(core.readRawLines(path))
+		if header is None:
+			raise ValueError("no scan header in " + path)
+		self.unitNumber = int(header[1])
+		boxcarN = int(header[9])
+		wavCoef, radSens, linCoefs = unitCalibration(self.unitNumber, calPath)
+
+		def sites(c):
+			# one value per boxcar window back to one per photosite
+			return np.repeat(np.atleast_2d(c), boxcarN, axis=1)[:, :core.pixels]
+
+		store = core.DarkStore()
+		d = meta[:, 2] == 0
+		for m, c, p in zip(meta[d], counts[d], pos[d]):
+			store.add(m[3], c, p)
+		if len(store.ladders) == 0:
+			raise ValueError("no dark measurements in " + path)
+		ladder = store.ladders[0][1]
+		times = sorted(ladder.keys())
+		self.darks = (np.array(times, dtype=float), sites(np.vstack([ladder[t] for t in times]) / boxcarN))
+
+		light = meta[:, 2] == 1
+		darks, found = store.darks(meta[light, 3], pos[light])
+		keep = found
+		m = meta[light][keep]
+		x = core.linearise((counts[light][keep] - darks[keep]) / boxcarN, linCoefs)
+		x /= (m[:, 3] + core.baseInt)[:, None].astype(float)
+		self.pans = m[:, 0].astype(float)
+		self.tilts = m[:, 1].astype(float)
+		self.rates = sites(np.clip(x, 0, None))
+
+	def rate(self, pan, tilt):
+		if tilt <= 0 or len(self.rates) == 0:
+			return np.zeros(core.pixels)
+		i = np.argmin((self.pans - pan)**2 + (self.tilts - tilt)**2)
+		return self.rates[i]
+
+
+class VirtualHOSI(threading.Thread):
+	## The firmware loop on its own thread. Bytes sent to the HOSI go to receive(), lines
+	## from it go to the function given to attach() (see LoopbackSerial and PtyPort).
+
+	def __init__(self, scene=None, unit=None, baud=115200, speed=1.0, calPath="./calibration_data.txt", noise=readNoise, seed=0, gearBacklash=0):
+		threading.Thread.__init__(self, daemon=True)
+		if unit is None:
+			unit = getattr(scene, "unitNumber", unitNumber)
+		wavCoef, radSens, linCoefs = unitCalibration(unit, calPath)
+		if scene is None:
+			scene = SyntheticScene(wavCoef, radSens, seed=seed)
+		darkTimes, darkCounts = scene.darks
+		self.scene = scene
+		self.sensor = SensorModel(linCoefs, darkTimes, darkCounts, noise, seed)
+		self.unitNumber = unit
+		self.gearBacklash = gearBacklash # pan steps of slack in the simulated gears
+		self.baud = baud
+		self.speed = speed
+		self.output = None
+		self.input = bytearray()
+		self.cond = threading.Condition()
+		self.running = True
+		self.clock = 0.0 # simulated device time (s), i.e. millis()/1000
+		self.bytesSent = 0
+		self.linesSent = 0
+
+		## firmware state
+		self.panPos = 0 # stepper positions
+		self.tiltPos = 0
+		self.panVal = 0 # last pan/tilt of a scan, as reported in the spectrum lines
+		self.tiltVal = 0
+		self.darkLight = 1
+		self.manIntTime = 0
+		self.maxIntTime = maxIntTime
+		self.boxcar = 1
+		self.darkRepeat = 30000
+		self.prevIntTime = 100
+		self.prevSatN = 0
+		self.hyperVals = [0]*9
+		self.binary = False
+		self.frameSeq = 0
+		self.rowHint = 0
+		self.hinted = False # a hint has come in during this scan
+		self.serpentine = False
+		self.backlash = 0 # firmware setting (z command)
+		self.rowLeftward = False
+		self.panSlack = 0 # where the head points relative to the pan motor
+
+	def attach(self, output):
+		# output(bytes) is called with everything the HOSI sends
+		self.output = output
+
+	def receive(self, data):
+		with self.cond:
+			self.input += data
+			self.cond.notify_all()
+
+	def stop(self):
+		self.running = False
+		with self.cond:
+			self.cond.notify_all()
+
+	##______________________timing & output_____________________________
+
+	def wait(self, seconds):
+		self.clock += seconds
+		if self.speed > 0:
+			time.sleep(seconds / self.speed)
+
+	def send(self, text):
+		data = text.encode() if isinstance(text, str) else text
+		self.wait(len(data)*10.0/self.baud)
+		self.bytesSent += len(data)
+		self.linesSent += 1
+		if self.output is not None:
+			self.output(data)
+
+	def println(self, text):
+		self.send(text + "\r\n")
+
+	def readString(self):
+		# everything received until the line goes quiet, like Serial.readString()
+		gap = max(commandTimeout/self.speed, minGap) if self.speed > 0 else minGap
+		with self.cond:
+			while self.running and len(self.input) == 0:
+				self.cond.wait(0.1)
+			n = -1
+			while self.running and n != len(self.input):
+				n = len(self.input)
+				self.cond.wait(gap)
+			arg = bytes(self.input)
+			self.input.clear()
+		self.clock += commandTimeout
+		return arg.decode('utf-8', 'replace')
+
+	def takeHint(self, tilt):
+		# exposure hint for the row at this tilt ("e<microseconds>,<tilt>" lines), 0 if none.
+		# Hints for other rows are dropped. Once the host is sending hints, wait up to
+		# hintWait for this row's, as the firmware does
+		hint = 0
+		start = time.time()
+		end = start + ((hintWait/self.speed if self.speed > 0 else hintWait) if self.hinted else 0)
+		while True:
+			with self.cond:
+				if b'\n' not in self.input and time.time() < end:
+					self.cond.wait(end - time.time())
+				lines = bytes(self.input).decode('utf-8', 'replace').split('\n')
+				self.input[:] = lines[-1].encode('utf-8') # an unfinished line stays
+			for line in lines[:-1]:
+				if line.startswith("e"):
+					self.hinted = True
+					fields = line[1:].split(',')
+					if len(fields) < 2 or int(toFloat(fields[1])) == tilt:
+						hint = int(toFloat(fields[0]))
+			if hint > 0 or time.time() >= end:
+				if self.speed > 0: # the device's time spent waiting
+					self.clock += (time.time() - start)*self.speed
+				elif hint == 0 and self.hinted:
+					self.clock += hintWait
+				return hint
+
+	def dropLateHints(self):
+		# throw away hints that came too late for their row, as the firmware does at the end
+		# of a scan. With the delays off, give a host that is sending hints a moment first
+		with self.cond:
+			if self.speed <= 0 and self.hinted:
+				self.cond.wait(hintWait)
+			while self.input.startswith(b'e'):
+				end = self.input.find(b'\n')
+				del self.input[:len(self.input) if end < 0 else end+1]
+
+	def run(self):
+		while self.running:
+			arg = self.readString()
+			if arg:
+				self.command(arg)
+
+	##______________________firmware_____________________________
+
+	def pan(self, pv):
+		self.wait(moveTime(pv - self.panPos))
+		if pv < self.panPos:
+			self.panSlack = self.gearBacklash # moving left, the head lags to the right
+		elif pv > self.panPos:
+			self.panSlack = 0
+		self.panPos = pv
+
+	def tilt(self, tv):
+		self.wait(moveTime(tv - self.tiltPos))
+		self.tiltPos = tv
+
+	def readSpectrometer(self, intTime):
+		self.wait(intTime/1e6 + readoutTime)
+		data = self.sensor.read(self.scene.rate(self.panPos + self.panSlack, self.tiltPos), intTime)
+		return data, int(np.sum(data > satVal))
+
+	def radianceMeasure(self):
+		if self.manIntTime == 0:
+			## two buffers, as in the firmware: each read goes to the other buffer and the
+			## one sent is the buffer before the last read (the last unsaturated read, or the
+			## one before it if the time ran out without saturating)
+			bufs = [None, None]
+			loc = 0
+			nextTime = intStep
+			intTime = minIntTime
+			start = self.rowHint//2
+			if self.darkLight == 1 and start >= intStep and start < self.maxIntTime:
+				bufs[loc], satN = self.readSpectrometer(start) # one step below the exposure hint
+				if satN == 0:
+					intTime = start
+					nextTime = start*2
+			if intTime == minIntTime:
+				bufs[loc], satN = self.readSpectrometer(intTime)
+			self.prevSatN = satN
+			self.prevIntTime = intTime
+			intTime = nextTime
+			if satN > 0:
+				loc = 1
+			while satN == 0 and intTime < self.maxIntTime:
+				loc = 1 - loc
+				bufs[loc], satN = self.readSpectrometer(intTime)
+				if satN == 0:
+					self.prevSatN = satN
+					self.prevIntTime = intTime
+					intTime *= 2
+			data = bufs[1 - loc]
+			if data is None:
+				data = np.zeros(core.pixels, dtype=np.int64) # buffer was cleared but never read
+		else:
+			intTime = self.manIntTime
+			data, satN = self.readSpectrometer(intTime)
+			self.prevSatN = satN
+			self.prevIntTime = intTime
+
+		boxcar = max(self.boxcar, 1)
+		padded = np.zeros(-(-core.pixels//boxcar)*boxcar, dtype=np.int64)
+		padded[:core.pixels] = data
+		sums = padded.reshape(-1, boxcar).sum(axis=1)
+		if self.binary:
+			self.send(hserial.encodeFrame([self.panVal, self.tiltVal, self.darkLight, self.prevIntTime, self.prevSatN], sums, self.frameSeq))
+			self.frameSeq += 1
+		else:
+			self.send(str(self.panVal) + "," + str(self.tiltVal) + "," + str(self.darkLight) + "," + str(self.prevIntTime) + "," + str(self.prevSatN) + "," + ",".join(map(str, sums.tolist())) + "\n")
+		self.wait(0.001)
+
+	def darkMeasure(self):
+		self.tilt(0)
+		self.darkLight = 0
+		tl = self.manIntTime
+		self.manIntTime = minIntTime
+		self.radianceMeasure()
+		i = intStep
+		while i <= self.maxIntTime:
+			self.manIntTime = i
+			self.radianceMeasure()
+			i *= 2
+		self.manIntTime = tl
+		self.darkLight = 1
+
+	def startMeasure(self):
+		self.pan(0)
+		self.tilt(512)
+		self.darkLight = 2
+		self.radianceMeasure()
+		self.darkLight = 1
+
+	def command(self, arg):
+		if arg.startswith("t"):
+			self.manIntTime = min(int(toFloat(arg.replace("t", ""))), self.maxIntTime)
+			self.println("int. time: " + str(self.manIntTime) + "ms")
+		elif arg.startswith("p"):
+			v = int(toFloat(arg.replace("p", "")))
+			self.pan(v)
+			self.println("pan: " + str(v))
+			self.wait(0.005)
+		elif arg.startswith("l"):
+			v = int(toFloat(arg.replace("l", "")))
+			self.tilt(v)
+			self.println("tilt: " + str(v))
+			self.wait(0.005)
+		elif arg.startswith("z"):
+			arg = arg.replace("z", "")
+			self.serpentine = int(toFloat(arg)) == 1
+			self.backlash = int(toFloat(arg[arg.index(",")+1:])) if "," in arg else 0
+			self.println("zigzag: " + ("1" if self.serpentine else "0") + "," + str(self.backlash))
+		elif arg.startswith("b"):
+			self.binary = int(toFloat(arg.replace("b", ""))) == 1
+			self.frameSeq = 0
+			self.println("bin: " + ("1" if self.binary else "0"))
+		elif arg.startswith("r"):
+			self.radianceMeasure()
+		elif arg.startswith("h"):
+			self.hyperScan(arg.replace("h", ""))
+
+	def hyperScan(self, arg):
+		## values are only read up to the last comma, as in the firmware
+		i = 0
+		while "," in arg and i < 9:
+			self.hyperVals[i] = int(toFloat(arg[:arg.index(",")]))
+			i += 1
+			arg = arg[arg.index(",")+1:]
+		hv = self.hyperVals
+		self.hinted = False
+		self.println("h," + str(self.unitNumber) + "," + ",".join(str(v) for v in hv))
+		self.wait(0.005)
+		self.maxIntTime = hv[6]
+		self.boxcar = hv[7]
+		self.darkRepeat = hv[8]
+		self.pan(0)
+		self.tilt(0)
+		self.rowLeftward = False
+		self.startMeasure()
+		self.darkMeasure()
+		eDR = self.clock*1000 + self.darkRepeat
+		self.tiltVal = hv[3]
+		while self.tiltVal <= hv[4] and self.running:
+			if self.clock*1000 >= eDR:
+				self.darkMeasure()
+				eDR = self.clock*1000 + self.darkRepeat
+			self.tilt(self.tiltVal)
+			panShift = 1
+			panStart = 0
+			for s, sp in zip(panoSteps, panoSpaces):
+				if self.tiltVal >= s:
+					panShift = sp
+					panStart = sp//2
+			panShift *= hv[2]
+			panStart *= hv[2]
+			panFirst = hv[0] + panStart
+			panLast = panFirst + int((hv[1]-panFirst)/panShift)*panShift
+			leftward = self.serpentine and self.rowLeftward
+			if leftward:
+				self.pan(panLast-self.backlash+10) # overshoot, to take up the slack in the gears
+			else:
+				self.pan(hv[0]-10)
+			self.rowHint = self.takeHint(self.tiltVal)
+			if self.rowHint > 0:
+				self.println("e: " + str(self.rowHint))
+			if leftward:
+				self.panVal = panLast
+				while self.panVal >= panFirst and self.running:
+					self.pan(self.panVal-self.backlash)
+					self.radianceMeasure()
+					self.panVal -= panShift
+			else:
+				self.panVal = panFirst
+				while self.panVal <= hv[1] and self.running:
+					self.pan(self.panVal)
+					self.radianceMeasure()
+					self.panVal += panShift
+			if self.serpentine:
+				self.rowLeftward = not self.rowLeftward
+			self.tiltVal += hv[5]
+		self.rowHint = 0
+		self.pan(0)
+		self.darkMeasure()
+		self.dropLateHints()
+		self.println("x")
+
+
+def toFloat(s):
+	# Arduino String.toFloat(): the leading number, 0 if there isn't one
+	m = re.match(r'\s*[-+]?(\d+\.?\d*|\.\d+)', s)
+	return float(m.group(0)) if m else 0.0
+
+
+class LoopbackSerial:
+	## pyserial-like end of the link to a VirtualHOSI in the same process, e.g. to hand to
+	## HOSI_serial.SerialReader. timeout as in pyserial (None blocks).
+
+	def __init__(self, device, timeout=None):
+		self.device = device
+		self.timeout = timeout
+		self.buffer = bytearray()
+		self.cond = threading.Condition()
+		self.is_open = True
+		device.attach(self.feed)
+		if not device.is_alive():
+			device.start()
+
+	def feed(self, data):
+		with self.cond:
+			self.buffer += data
+			self.cond.notify_all()
+
+	@property
+	def in_waiting(self):
+		return len(self.buffer)
+
+	def _take(self, test):
+		# wait until test(buffer) gives the number of bytes to return (or the timeout)
+		end = None if self.timeout is None else time.monotonic() + self.timeout
+		with self.cond:
+			while True:
+				if not self.is_open:
+					raise OSError("port closed")
+				n = test(self.buffer)
+				if n:
+					break
+				left = None if end is None else end - time.monotonic()
+				if left is not None and left <= 0:
+					n = len(self.buffer)
+					break
+				self.cond.wait(0.1 if left is None else min(left, 0.1))
+			out = bytes(self.buffer[:n])
+			del self.buffer[:n]
+			return out
+
+	def readline(self):
+		return self._take(lambda b: b.find(b'\n') + 1)
+
+	def read(self, size=1):
+		return self._take(lambda b: size if len(b) >= size else 0)
+
+	def write(self, data):
+		if not self.is_open:
+			raise OSError("port closed")
+		self.device.receive(bytes(data))
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def reset_input_buffer(self):
+		with self.cond:
+			self.buffer.clear()
+
+	def close(self):
+		with self.cond:
+			self.is_open = False
+			self.cond.notify_all()
+		self.device.stop()
+
+
+class PtyPort:
+	## Pseudo-terminal for programs that open a serial port by name (POSIX only). The
+	## device path is in .name; the simulator keeps its own handle open on it so clients
+	## can connect and disconnect.
+
+	def __init__(self, device):
+		import pty, tty
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.name = os.ttyname(self.slave)
+		self.device = device
+		self.running = True
+		device.attach(self.feed)
+		self.thread = threading.Thread(target=self.pump, daemon=True)
+		self.thread.start()
+		if not device.is_alive():
+			device.start()
+
+	def feed(self, data):
+		while data and self.running:
+			n = os.write(self.master, data)
+			data = data[n:]
+
+	def pump(self):
+		while self.running:
+			r, w, e = select.select([self.master], [], [], 0.1)
+			if not r:
+				continue
+			try:
+				data = os.read(self.master, 4096)
+			except OSError:
+				time.sleep(0.1)
+				continue
+			self.device.receive(data)
+
+	def close(self):
+		self.running = False
+		self.device.stop()
+		os.close(self.master)
+		os.close(self.slave)
+
+
+def runScan(device, command, path=None, setup=(), hints=False):
+	# send one command over a loopback link and collect the reply up to the 'x', read the
+	# same way as the GUI (HOSI_serial.SerialReader), optionally with exposure hints.
+	# setup: (command, reply kind) pairs sent first, e.g. binary frames or serpentine mode.
+	# Returns the lines, wall time, simulated device time and the core.ExposureHints
+	# (None without hints)
+	ser = LoopbackSerial(device)
+	reader = hserial.SerialReader(ser)
+	reader.start()
+	for cmd, kind in setup:
+		reader.collect(cmd, kind)
+	start = time.perf_counter()
+	clock = device.clock
+	lines, exposure = reader.collect(command, 'x', hints)
+	wall = time.perf_counter() - start
+	if path is not None:
+		with open(path, "w") as f:
+			f.writelines(lines)
+	reader.stop()
+	ser.close()
+	return lines, wall, device.clock - clock, exposure
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Virtual HOSI speaking the firmware's serial protocol")
+	parser.add_argument("--replay", help="recorded scan csv to play back (default: synthetic scene)")
+	parser.add_argument("--unit", type=int, help="unit number (default: that of the replayed scan, or " + str(unitNumber) + ")")
+	parser.add_argument("--baud", type=int, default=115200)
+	parser.add_argument("--speed", type=float, default=1.0, help="time factor, e.g. 10 for ten times real time, 0 for no delays")
+	parser.add_argument("--noise", type=float, default=readNoise, help="read noise in counts (0 for repeatable counts)")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("-c", "--calibration", default="./calibration_data.txt")
+	parser.add_argument("--scan", help="run this command (e.g. \"h-200,200,10,400,600,10,2000000,2,30000,\") without a port and print timings")
+	parser.add_argument("-o", "--output", help="with --scan, save the transcript here")
+	parser.add_argument("--binary", action="store_true", help="with --scan, ask for binary spectrum frames first")
+	parser.add_argument("--hints", action="store_true", help="with --scan, send exposure hints for each row")
+	parser.add_argument("--serpentine", type=int, metavar="BACKLASH", help="with --scan, serpentine rows with this backlash setting")
+	parser.add_argument("--gear-backlash", type=int, default=0, help="pan steps of slack in the simulated gears")
+	parser.add_argument("--brightness", type=float, default=1.0, help="scale the synthetic scene, e.g. 0.001 for night")
+	args = parser.parse_args(argv)
+
+	if args.replay:
+		scene = ReplayScene(args.replay, args.calibration)
+	else:
+		wavCoef, radSens, linCoefs = unitCalibration(unitNumber if args.unit is None else args.unit, args.calibration)
+		scene = SyntheticScene(wavCoef, radSens, brightness=args.brightness, seed=args.seed)
+	device = VirtualHOSI(scene, args.unit, args.baud, args.speed, args.calibration, args.noise, args.seed, args.gear_backlash)
+
+	if args.scan:
+		setup = []
+		if args.binary:
+			setup.append((hserial.binaryRequest, 'b'))
+		if args.serpentine is not None:
+			setup.append((hserial.serpentineCommand(True, args.serpentine), 'z'))
+		lines, wall, clock, exposure = runScan(device, args.scan, args.output, setup, args.hints)
+		spectra = sum(1 for l in lines if core.parseLine(l) is not None)
+		print(str(spectra) + " spectra, " + str(device.bytesSent) + " bytes")
+		print("device time %.1f s (%.1f s of it sending at %d baud), wall time %.2f s" % (clock, device.bytesSent*10.0/args.baud, args.baud, wall))
+		if exposure is not None:
+			print("exposure hints: %d rows, %d ladder steps (%.1f s) saved, %d spectra brighter than their hint" % (exposure.rows, exposure.stepsSaved, exposure.timeSaved/1e6, exposure.misses))
+		return 0
+
+	port = PtyPort(device)
+	print("Virtual HOSI unit " + str(device.unitNumber) + " on " + port.name + " (Ctrl+C to stop)")
+	print("e.g. HOSI_PORT=" + port.name + " python HOSI_GUI_0.1.51.py")
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	port.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,459 @@
+##
+##_________________________HOSI storage_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Binary scan container, saved next to the usual .csv output. It is an uncompressed
+## .npz file (so numpy's np.load can read it anywhere) holding:
+##
+##	meta			json string: unit, pan/tilt ranges, boxcar, maxInt, darkRep, image names
+##	header			the 'h' line from the HOSI
+##	rawMeta			(n,5) int32 pan, tilt, type, intTime, satN for each spectrum in scan order
+##	rawCounts		(n, specLength) raw counts (uint16 unless the boxcar sums need more)
+##	rawPos			(n,) position of each spectrum in the scan
+##	darkTimes, darkPos, darkVals	the dark ladders (type 0 spectra) pulled out of the raw data
+##	hspec			(tiltDim, panDim, specLength) calibrated le values, float32
+##	hspecPan, hspecTilt	pan & tilt step of each column & row
+##	wavelength		wavelength of each boxcar bin (wavelengthBoxcar)
+##	images			(nImages, tiltDim, panDim) preview images, float32
+##	provenance		(tiltDim, panDim) int16 pass each spectrum of hspec came from: 0 the scan,
+##				1, 2... region rescans merged into it, -1 none (see core.scanPasses),
+##				-2 copied from the nearest measured pixel (core.filledPass)
+##				Only in containers saved with it
+##
+## Because nothing is compressed, ScanArchive memory-maps each array straight out of
+## the file, so single spectra can be read from large scans without loading them.
+##
+## ScanWriter streams the raw serial data to the scan's .csv as it arrives, so a scan
+## that loses power part way through can still be loaded (everything up to the last
+## flushed line is kept). A .idx file alongside holds the byte offset of every line
+## as little-endian int64.
+##
+## A time-lapse (HOSI_timelapse) is kept as one series file instead, a compressed .npz
+## that SeriesWriter appends a frame to as each scan finishes (keeping a copy of the zip
+## directory it writes over until the frame is on disk, so a crash loses at most that frame):
+##
+##	meta			json string: as above, plus frame timing & the residual coding
+##	header, hspecPan, hspecTilt, wavelength		as above, shared by every frame
+##	time0000		time each frame's scan started (s since the epoch, or on the simulator's
+##				clock for HOSI_timelapse --simulate)
+##	key0000			(tiltDim, panDim, specLength) float32 le values of a key frame
+##	delta0001		quantised residuals of the frames in between (see encodeResiduals)
+##	lum0000			(tiltDim, panDim) float32 luminance image of each frame
+##	raw0000			raw serial transcript of each frame, utf-8 (unless left out)
+##
+## One frame in every keyEvery is a key frame, so any frame decodes from the key before
+## it. The residuals are of asinh(le/scale), which is proportional for bright pixels and
+## linear near zero, against the frame before as decoded (so errors don't build up),
+## rounded to seriesStep: about 0.1% of each le value, and runs of unchanged pixels
+## compress to almost nothing.
+##
+
+
+import json, os, time, zipfile
+import numpy as np
+import HOSI_core as core
+
+
+containerVersion = 1
+seriesStep = 0.002 # residual step, in asinh(le/scale) units (about a relative step for bright pixels)
+seriesKeyEvery = 12 # frames between key frames
+imageNames = ("imLum", "imR", "imG", "imB", "imSatR", "imSatB", "imI", "imGG", "imU", "imChlA", "imChlB")
+
+
+def scanImages(scan):
+	# dict of the preview images of a Scan (or anything with the same attribute names)
+	return {name: getattr(scan, name) for name in imageNames}
+
+def saveScanBinary(path, raw, hspec, hspecPan, hspecTilt, wavelengthBoxcar, images, provenance=None):
+	# raw: (header, meta, counts, pos) from core.parseRaw; images: dict of preview images
+	header, meta, counts, pos = raw
+	scan = core.Scan(header, allocate=False)
+	cMax = counts.max() if counts.size > 0 else 0
+	if(cMax < 65536 and counts.min(initial=0) >= 0 and np.all(counts == np.round(counts))):
+		rawCounts = counts.astype(np.uint16)
+	else:
+		rawCounts = counts.astype(np.float32)
+	dark = meta[:, 2] == 0
+
+	names = [n for n in imageNames if n in images]
+	metaDict = {
+		"version": containerVersion,
+		"unitNumber": scan.unitNumber,
+		"panStart": scan.panStart, "panStop": scan.panStop, "pan_Res": scan.pan_Res,
+		"tiltStart": scan.tiltStart, "tiltStop": scan.tiltStop, "tilt_Res": scan.tilt_Res,
+		"panDim": scan.panDim, "tiltDim": scan.tiltDim,
+		"maxInt": scan.maxInt, "boxcarN": scan.boxcarN, "darkRep": scan.darkRep,
+		"images": names,
+		"maxRGB": float(max([1E-10] + [np.nanmax(images[n]) for n in ("imR", "imG", "imB") if n in images])),
+		"maxIGU": float(max([1E-10] + [np.nanmax(images[n]) for n in ("imI", "imGG", "imU") if n in images])),
+	}
+	arrays = {
+		"meta": np.array(json.dumps(metaDict)),
+		"header": np.array(",".join(header).strip()),
+		"rawMeta": meta.astype(np.int32),
+		"rawCounts": rawCounts,
+		"rawPos": pos.astype(np.float64),
+		"darkTimes": meta[dark, 3].astype(np.int64),
+		"darkPos": pos[dark].astype(np.float64),
+		"darkVals": counts[dark].astype(np.float32),
+		"hspec": np.ascontiguousarray(hspec, dtype=np.float32),
+		"hspecPan": np.asarray(hspecPan, dtype=np.float64),
+		"hspecTilt": np.asarray(hspecTilt, dtype=np.float64),
+		"wavelength": np.asarray(wavelengthBoxcar, dtype=np.float64),
+		"images": np.stack([np.asarray(images[n], dtype=np.float32) for n in names]) if len(names) > 0 else np.zeros([0, scan.tiltDim, scan.panDim], np.float32),
+	}
+	if provenance is not None:
+		arrays["provenance"] = np.asarray(provenance, dtype=np.int16)
+	with open(path, 'wb') as f: # file object so numpy doesn't add another .npz extension
+		np.savez(f, **arrays)
+	return path
+
+
+class ScanArchive:
+	## Read-only view of a binary scan container. Arrays are memory-mapped on first use.
+
+	def __init__(self, path):
+		self.path = path
+		self.offsets = {}
+		with zipfile.ZipFile(path) as z:
+			for info in z.infolist():
+				if info.compress_type != zipfile.ZIP_STORED:
+					continue
+				self.offsets[info.filename[:-4]] = info.header_offset
+		self._arrays = {}
+		self.meta = json.loads(str(self["meta"]))
+		self.header = str(self["header"]).split(',')
+
+	def keys(self):
+		return self.offsets.keys()
+
+	def __contains__(self, name):
+		return name in self.offsets
+
+	def __getitem__(self, name):
+		if name not in self._arrays:
+			self._arrays[name] = self._map(name)
+		return self._arrays[name]
+
+	def _map(self, name):
+		# find the .npy data inside the zip & memory-map it
+		with open(self.path, 'rb') as f:
+			f.seek(self.offsets[name])
+			local = f.read(30) # zip local file header
+			nameLen = int.from_bytes(local[26:28], 'little')
+			extraLen = int.from_bytes(local[28:30], 'little')
+			f.seek(self.offsets[name] + 30 + nameLen + extraLen)
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+			else:
+				shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+			if dtype.hasobject:
+				raise ValueError("object arrays are not supported")
+			if len(shape) == 0 or dtype.kind == 'U':
+				return self._read(name)
+			offset = f.tell()
+		return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+	def _read(self, name):
+		# small members (strings) are just read normally
+		with zipfile.ZipFile(self.path) as z:
+			with z.open(name + ".npy") as f:
+				return np.lib.format.read_array(f, allow_pickle=False)
+
+	def spectrum(self, x, y):
+		# le values at image column x, row y (as used by the GUI, i.e. hspec[y][x])
+		return np.array(self["hspec"][y, x])
+
+	def toScan(self):
+		# core.Scan with memory-mapped cube and images
+		scan = core.Scan(self.header, allocate=False)
+		scan.hspec = self["hspec"]
+		scan.hspecPan = np.array(self["hspecPan"])
+		scan.hspecTilt = np.array(self["hspecTilt"])
+		scan.wavelengthBoxcar = np.array(self["wavelength"])
+		images = self["images"]
+		for i, name in enumerate(self.meta["images"]):
+			setattr(scan, name, images[i])
+		scan.maxRGB = self.meta["maxRGB"]
+		scan.maxIGU = self.meta["maxIGU"]
+		if "provenance" in self:
+			scan.provenance = np.array(self["provenance"])
+		return scan
+
+	def raw(self):
+		# (header, meta, counts, pos) as returned by core.parseRaw
+		return self.header, np.array(self["rawMeta"], dtype=np.int64), np.array(self["rawCounts"], dtype=float), np.array(self["rawPos"])
+
+
+class ScanWriter:
+	## Append-only writer for the raw serial lines of a scan in progress. Each line is
+	## written straight to disk (flushed every flushEvery lines, fsync'd every syncEvery
+	## seconds) so memory use doesn't grow with scan length. finish() adds the
+	## calibrated le values once the scan is done. Opening an existing file appends to
+	## it, e.g. to resume a scan that was cut off.
+
+	def __init__(self, path, flushEvery=1, syncEvery=5.0):
+		self.path = path
+		self.flushEvery = flushEvery
+		self.syncEvery = syncEvery
+		self.f = open(path, 'ab')
+		self.idx = open(os.path.splitext(path)[0] + ".idx", 'ab')
+		if self.f.tell() > 0:
+			with open(path, 'rb') as f:
+				f.seek(-1, os.SEEK_END)
+				if f.read(1) != b'\n':
+					self.f.write(b'\n') # a line cut off mid-write, so the next starts on its own
+		self.lines = 0
+		self.pending = 0
+		self.nextSync = time.time() + syncEvery
+
+	def write(self, line):
+		self.idx.write(self.f.tell().to_bytes(8, 'little', signed=True))
+		self.f.write(line.encode('utf-8', 'replace'))
+		self.lines += 1
+		self.pending += 1
+		if self.pending >= self.flushEvery:
+			self.flush()
+		if time.time() >= self.nextSync:
+			self.sync()
+
+	def flush(self):
+		self.f.flush()
+		self.idx.flush()
+		self.pending = 0
+
+	def sync(self):
+		self.flush()
+		os.fsync(self.f.fileno())
+		os.fsync(self.idx.fileno())
+		self.nextSync = time.time() + self.syncEvery
+
+	def finish(self, text=""):
+		# append the calibrated section (e.g. the le values table) and close
+		if len(text) > 0:
+			self.f.write(text.encode('utf-8'))
+		self.sync()
+		self.close()
+
+	def close(self):
+		if not self.f.closed:
+			self.flush()
+			self.f.close()
+			self.idx.close()
+
+
+def readIndex(path):
+	# byte offset of each raw line written by ScanWriter (path of the .csv or .idx)
+	return np.fromfile(os.path.splitext(path)[0] + ".idx", dtype='<i8')
+
+def readRawRows(path, start=0, stop=None):
+	# raw lines start..stop of a (possibly unfinished) scan, using the .idx offsets
+	offsets = readIndex(path)
+	if stop is None or stop > len(offsets):
+		stop = len(offsets)
+	if start >= stop:
+		return []
+	with open(path, 'rb') as f:
+		f.seek(int(offsets[start]))
+		if stop < len(offsets):
+			data = f.read(int(offsets[stop] - offsets[start]))
+		else:
+			data = f.read()
+	lines = data.decode('utf-8', 'replace').splitlines(True)
+	return lines[:stop-start]
+
+
+##______________________time series_____________________________
+
+def encodeResiduals(hspec, prevY, scale, step):
+	# quantised residuals of a frame against the one before (prevY, its asinh(le/scale) as
+	# decoded). Returns the residuals (int16 unless they need more) and this frame's decoded prevY
+	r = np.round((np.arcsinh(np.asarray(hspec, dtype=np.float64)/scale) - prevY)/step)
+	r = r.astype(np.int16) if np.abs(r).max(initial=0) < 32768 else r.astype(np.int32)
+	return r, prevY + r*step
+
+def seriesScale(hspec):
+	# where asinh(le/scale) turns from linear to logarithmic, well below the typical le value
+	vals = np.abs(np.asarray(hspec, dtype=np.float64))
+	vals = vals[vals > 0]
+	return float(np.median(vals)*1E-3) if vals.size > 0 else 1E-12
+
+def syncDir(path):
+	# sync the directory holding path, so a rename or new file in it is on disk too
+	if hasattr(os, 'O_DIRECTORY'):
+		fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+def writeMembers(path, arrays):
+	# add arrays to a compressed .npz, synced to disk before returning. Appending writes the
+	# new members over the zip's directory at the end of the file and a new directory after
+	# them, so the old directory (only a few kB) is kept in path + ".bak" until it's done:
+	# if the power goes part way through, recoverMembers puts it back. A new file is written
+	# alongside and moved into place
+	target = path
+	if not os.path.exists(path):
+		target = path + ".tmp"
+		if os.path.exists(target):
+			os.remove(target) # left by an earlier crash
+	else:
+		recoverMembers(path)
+		with zipfile.ZipFile(path) as z:
+			dirStart = z.start_dir
+		with open(path, 'rb') as f:
+			f.seek(dirStart)
+			old = f.read()
+		with open(path + ".bak.tmp", 'wb') as f:
+			f.write(np.int64(dirStart).tobytes() + old)
+			os.fsync(f.fileno())
+		os.replace(path + ".bak.tmp", path + ".bak")
+		syncDir(path)
+	with zipfile.ZipFile(target, 'a', zipfile.ZIP_DEFLATED) as z:
+		for name, arr in arrays.items():
+			with z.open(name + ".npy", 'w', force_zip64=True) as f:
+				np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
+	with open(target, 'rb+') as f:
+		os.fsync(f.fileno())
+	if target != path:
+		os.replace(target, path)
+	elif os.path.exists(path + ".bak"):
+		os.remove(path + ".bak")
+	syncDir(path)
+
+def recoverMembers(path):
+	# undo an append that didn't finish (see writeMembers): cut the file back to where the
+	# old directory was and put it back. True if there was anything to undo
+	if not os.path.exists(path + ".bak"):
+		return False
+	with open(path + ".bak", 'rb') as f:
+		data = f.read()
+	dirStart = int(np.frombuffer(data[:8], dtype=np.int64)[0])
+	with open(path, 'rb+') as f:
+		f.truncate(dirStart)
+		f.seek(dirStart)
+		f.write(data[8:])
+		os.fsync(f.fileno())
+	os.remove(path + ".bak")
+	syncDir(path)
+	return True
+
+
+class SeriesWriter:
+	## Appends the frames of a time-lapse to a series file, one add() per finished scan.
+	## An existing file is carried on with, after checking it has the same scan grid.
+
+	def __init__(self, path, step=seriesStep, keyEvery=seriesKeyEvery, keepRaw=True):
+		self.path = path
+		self.step = step
+		self.keyEvery = keyEvery
+		self.keepRaw = keepRaw
+		self.frames = 0
+		self.meta = None
+		self.prevY = None
+		if os.path.exists(path):
+			series = SeriesArchive(path)
+			self.meta = series.meta
+			self.step = self.meta["step"]
+			self.keyEvery = self.meta["keyEvery"]
+			self.frames = len(series)
+			if self.frames > 0:
+				self.prevY = series._decode(self.frames-1)
+
+	def add(self, scan, t, rawLines=None):
+		# scan: core.Scan of the frame, t: when it started. Returns the frame number
+		hspec = np.nan_to_num(np.asarray(scan.hspec, dtype=np.float32))
+		arrays = {}
+		if self.meta is None:
+			self.meta = {
+				"version": containerVersion,
+				"unitNumber": scan.unitNumber,
+				"panStart": scan.panStart, "panStop": scan.panStop, "pan_Res": scan.pan_Res,
+				"tiltStart": scan.tiltStart, "tiltStop": scan.tiltStop, "tilt_Res": scan.tilt_Res,
+				"panDim": scan.panDim, "tiltDim": scan.tiltDim,
+				"maxInt": scan.maxInt, "boxcarN": scan.boxcarN, "darkRep": scan.darkRep,
+				"step": self.step, "keyEvery": self.keyEvery, "scale": seriesScale(hspec),
+			}
+			arrays["meta"] = np.array(json.dumps(self.meta))
+			arrays["header"] = np.array(",".join(scan.header).strip())
+			arrays["hspecPan"] = np.asarray(scan.hspecPan, dtype=np.float64)
+			arrays["hspecTilt"] = np.asarray(scan.hspecTilt, dtype=np.float64)
+			arrays["wavelength"] = np.asarray(scan.wavelengthBoxcar, dtype=np.float64)
+		elif hspec.shape != (self.meta["tiltDim"], self.meta["panDim"], hspec.shape[2]) or scan.panStart != self.meta["panStart"] or scan.tiltStart != self.meta["tiltStart"]:
+			raise ValueError("frame doesn't match the grid of " + self.path)
+		n = "%04d" % self.frames
+		scale = self.meta["scale"]
+		if self.frames % self.keyEvery == 0:
+			arrays["key" + n] = hspec
+			self.prevY = np.arcsinh(hspec.astype(np.float64)/scale)
+		else:
+			arrays["delta" + n], self.prevY = encodeResiduals(hspec, self.prevY, scale, self.step)
+		arrays["time" + n] = np.array(float(t))
+		arrays["lum" + n] = np.asarray(scan.imLum, dtype=np.float32)
+		if self.keepRaw and rawLines is not None:
+			arrays["raw" + n] = np.frombuffer("".join(rawLines).encode('utf-8'), dtype=np.uint8)
+		writeMembers(self.path, arrays)
+		self.frames += 1
+		return self.frames - 1
+
+
+class SeriesArchive:
+	## Read-only view of a series file. Frames are decoded from the key frame before them,
+	## and the last one decoded is kept so reading them in order is quick.
+
+	def __init__(self, path):
+		self.path = path
+		recoverMembers(path) # a frame that was cut off
+		with zipfile.ZipFile(path) as z:
+			self.names = set(name[:-4] for name in z.namelist())
+		self.meta = json.loads(str(self._read("meta")))
+		self.header = str(self._read("header")).split(',')
+		self.nFrames = sum(1 for name in self.names if name.startswith("time"))
+		self._last = None # (frame, asinh values)
+
+	def __len__(self):
+		return self.nFrames
+
+	def _read(self, name):
+		with zipfile.ZipFile(self.path) as z:
+			with z.open(name + ".npy") as f:
+				return np.lib.format.read_array(f, allow_pickle=False)
+
+	def times(self):
+		return np.array([float(self._read("time%04d" % i)) for i in range(self.nFrames)])
+
+	def luminance(self, i=None):
+		# luminance image of frame i, or (frames, tiltDim, panDim) for all of them
+		if i is not None:
+			return self._read("lum%04d" % i)
+		return np.stack([self._read("lum%04d" % k) for k in range(self.nFrames)])
+
+	def frame(self, i):
+		# (tiltDim, panDim, specLength) le values of frame i
+		return (self.meta["scale"]*np.sinh(self._decode(i))).astype(np.float32)
+
+	def _decode(self, i):
+		# asinh(le/scale) of frame i, as the writer had it
+		if i < 0 or i >= self.nFrames:
+			raise IndexError("frame %d of %d" % (i, self.nFrames))
+		scale = self.meta["scale"]
+		k = i
+		while "key%04d" % k not in self.names:
+			k -= 1
+		if self._last is not None and k <= self._last[0] <= i: # carry on from the last one decoded
+			k, y = self._last
+		else:
+			y = np.arcsinh(self._read("key%04d" % k).astype(np.float64)/scale)
+		for j in range(k+1, i+1):
+			y = y + self._read("delta%04d" % j)*self.meta["step"]
+		self._last = (i, y)
+		return y
+
+	def raw(self, i):
+		# raw transcript lines of frame i (empty if they weren't kept)
+		if "raw%04d" % i not in self.names:
+			return []
+		return self._read("raw%04d" % i).tobytes().decode('utf-8').splitlines(True)
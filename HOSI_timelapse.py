@@ -0,0 +1,172 @@
+##
+##_________________________HOSI time-lapse_____________________________
+##
+## License: GNU General Public License v3.0
+##
+## Repeats the same scan every few minutes, e.g. all night for artificial light at night
+## (ALAN) monitoring, and keeps the frames in one series file (HOSI_storage.SeriesWriter)
+## rather than a csv per scan: a key frame now and then, and quantised residuals of the
+## frames in between. As each frame arrives these maps are updated (ChangeMaps) and
+## saved, so the night can be looked at before it's over:
+##
+##	<output>_series.npz	every frame: le values, luminance image, time & raw data
+##	<output>_change.tif	log10 change in luminance since the frame before
+##	<output>_total.tif	log10 change in luminance since the first frame
+##	<output>_mean.tif	mean log10 luminance over the frames so far
+##	<output>_sd.tif		standard deviation of log10 luminance over the frames so far
+##	<output>_sRGB.png	the latest frame
+##
+## Running it again with the same output carries on with the series.
+##
+
+import argparse, os, sys, time
+import numpy as np
+import HOSI_core as core
+import HOSI_serial as hserial
+import HOSI_storage as storage
+
+
+bootDelay = 2.5 # s, the Arduino resets when its port is opened
+
+
+class ChangeMaps:
+	## Per-pixel statistics of log10 luminance, updated one frame at a time (Welford's
+	## running mean & variance), so nothing is reloaded as the series grows.
+
+	def __init__(self):
+		self.n = 0
+		self.floor = None # luminance below this counts as this, so dark pixels don't swamp the logs
+		self.first = None
+		self.last = None
+		self.mean = None
+		self.m2 = None
+		self.change = None
+
+	def add(self, lum):
+		lum = np.asarray(lum, dtype=np.float64)
+		if self.floor is None:
+			pos = lum[lum > 0]
+			self.floor = float(np.median(pos)*1E-3) if pos.size > 0 else 1E-12
+		v = np.log10(np.maximum(lum, self.floor))
+		self.n += 1
+		if self.n == 1:
+			self.first = v
+			self.mean = v.copy()
+			self.m2 = np.zeros_like(v)
+			self.change = np.zeros_like(v)
+		else:
+			self.change = v - self.last
+			d = v - self.mean
+			self.mean += d/self.n
+			self.m2 += d*(v - self.mean)
+		self.last = v
+
+	def maps(self):
+		return {
+			"change": self.change,
+			"total": self.last - self.first,
+			"mean": self.mean,
+			"sd": np.sqrt(self.m2/max(self.n-1, 1)),
+		}
+
+	def save(self, basePath):
+		# one float tif per map, replaced whole so a reader never sees half a file
+		from PIL import Image
+		saved = []
+		for name, im in self.maps().items():
+			path = basePath + "_" + name + ".tif"
+			Image.fromarray(im.astype(np.float32)).save(path + ".tmp", format="TIFF")
+			os.replace(path + ".tmp", path)
+			saved.append(path)
+		return saved
+
+
+def timeLapse(reader, command, basePath, frames, every, hints=False, keepRaw=True, step=storage.seriesStep, keyEvery=storage.seriesKeyEvery, engine=None, calPath="./calibration_data.txt", sensPath="./sensitivity_data.csv", clock=time.time, wait=time.sleep, log=print):
+	# scan every `every` seconds (straight away if a scan ran over), adding each frame to the
+	# series and updating the maps. clock & wait can be swapped for a simulated device's.
+	# Returns the SeriesWriter and ChangeMaps
+	from PIL import Image
+	writer = storage.SeriesWriter(basePath + "_series.npz", step, keyEvery, keepRaw)
+	maps = ChangeMaps()
+	if writer.frames > 0: # carrying on with a series, catch the maps up
+		series = storage.SeriesArchive(writer.path)
+		for i in range(len(series)):
+			maps.add(series.luminance(i))
+		log("Carrying on from frame %d of %s" % (writer.frames, writer.path))
+	start = clock()
+	for k in range(frames):
+		due = start + k*every
+		if clock() < due:
+			wait(due - clock())
+		t = clock()
+		lines, exposure = reader.collect(command, 'x', hints)
+		scan = core.replayScan(lines, engine, calPath, sensPath)
+		if scan is None:
+			raise ValueError("no scan header in the HOSI's reply")
+		if engine is None:
+			engine = core.makeEngine(scan.unitNumber, scan.boxcarN, calPath, sensPath)
+		i = writer.add(scan, t, lines)
+		maps.add(scan.imLum)
+		maps.save(basePath)
+		Image.fromarray(core.srgbImage(scan), "RGB").save(basePath + "_sRGB.png")
+		change = np.abs(maps.change)
+		log("frame %d: scan %.0f s, median change %.3f, %.1f%% of pixels changed by more than 2x, series %.1f MB" % (i, clock() - t, np.median(change), 100.0*(change > np.log10(2)).mean(), os.path.getsize(writer.path)/1E6))
+	return writer, maps
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Repeat a HOSI scan and keep the frames as one series")
+	parser.add_argument("--scan", required=True, help="h command repeated for each frame, e.g. \"h-1024,1024,24,480,1024,24,2000000,2,120000,\"")
+	parser.add_argument("-o", "--output", required=True, help="base path of the saved files")
+	parser.add_argument("-p", "--port", help="serial port of the HOSI")
+	parser.add_argument("--simulate", action="store_true", help="scan the virtual HOSI (HOSI_simulator) instead, on its clock")
+	parser.add_argument("--replay", help="with --simulate, recorded scan csv to play back")
+	parser.add_argument("--brightness", type=float, default=1.0, help="with --simulate, scale the synthetic scene")
+	parser.add_argument("-e", "--every", type=float, default=15, help="minutes from the start of one scan to the next (default 15)")
+	parser.add_argument("-n", "--frames", type=int, default=32, help="number of scans (default 32)")
+	parser.add_argument("--hints", action="store_true", help="send exposure hints for each row")
+	parser.add_argument("--no-raw", action="store_true", help="don't keep the raw data of each frame (much smaller)")
+	parser.add_argument("--step", type=float, default=storage.seriesStep, help="residual step, about the relative precision kept (default %g)" % storage.seriesStep)
+	parser.add_argument("--key-every", type=int, default=storage.seriesKeyEvery, help="frames between key frames (default %d)" % storage.seriesKeyEvery)
+	parser.add_argument("-c", "--calibration", default="./calibration_data.txt")
+	parser.add_argument("-s", "--sensitivities", default="./sensitivity_data.csv")
+	args = parser.parse_args(argv)
+
+	command = args.scan.strip()
+	if not command.startswith('h'):
+		command = "h" + command
+	clock, wait = time.time, time.sleep
+	if args.simulate:
+		import HOSI_simulator as sim
+		if args.replay:
+			scene = sim.ReplayScene(args.replay, args.calibration)
+		else:
+			wavCoef, radSens, linCoefs = sim.unitCalibration(sim.unitNumber, args.calibration)
+			scene = sim.SyntheticScene(wavCoef, radSens, brightness=args.brightness)
+		device = sim.VirtualHOSI(scene, speed=0, calPath=args.calibration)
+		ser = sim.LoopbackSerial(device)
+		clock = lambda: device.clock
+		wait = device.wait
+	elif args.port:
+		import serial
+		ser = serial.Serial(args.port, 115200)
+		time.sleep(bootDelay)
+	else:
+		parser.error("give a serial port (-p) or --simulate")
+
+	outDir = os.path.dirname(args.output)
+	if outDir != "":
+		os.makedirs(outDir, exist_ok=True)
+	reader = hserial.SerialReader(ser)
+	reader.start()
+	try:
+		writer, maps = timeLapse(reader, command, args.output, args.frames, args.every*60, args.hints, not args.no_raw, args.step, args.key_every, None, args.calibration, args.sensitivities, clock, wait)
+	finally:
+		reader.stop()
+		ser.close()
+	print("%d frames in %s (%.1f MB)" % (writer.frames, writer.path, os.path.getsize(writer.path)/1E6))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())